@@ -13,14 +13,24 @@ running multiple build commands in parallel, confusion can occur).
 """
 
 import argparse
+import contextlib
 import fnmatch
+import hashlib
+import io
+import json
 import logging
 import os
+import shutil
 import sys
+import tarfile
+import tempfile
+import threading
 import time
+from pathlib import Path
 from contextlib import contextmanager
 
 from tools import cache
+from tools import config
 from tools import shared
 from tools import system_libs
 from tools import ports
@@ -155,6 +165,14 @@ Available targets:
         %s
 
 Issuing 'embuilder build ALL' causes each task to be built.
+
+  export BUNDLE TARGETS...
+        Builds the given targets if needed, and packs them along with the
+        sysroot headers into the .tar(.gz|.xz) file BUNDLE.
+
+  import BUNDLE [TARGETS...]
+        Unpacks a bundle created by "export" into the cache. If targets are
+        given, only those targets are imported from the bundle.
 ''' % '\n        '.join(all_tasks)
 
 
@@ -198,6 +216,310 @@ def handle_port_error(target, message):
   utils.exit_with_error(f'error building port `{target}` | {message}')
 
 
+def format_time(time_taken):
+  return '%s(%.2fs)' % (('%02d:%02d mins ' % (time_taken // 60, time_taken % 60) if time_taken >= 60 else ''), time_taken)
+
+
+def run_task(what, system_libraries, do_build, do_clear):
+  """Builds and/or clears a single target. Returns False if the target is not
+  known."""
+  if do_build:
+    logger.info('building ' + what)
+  else:
+    logger.info('clearing ' + what)
+  start_time = time.time()
+  if what in system_libraries:
+    library = system_libraries[what]
+    if do_clear:
+      library.erase()
+    if do_build:
+      if USE_NINJA:
+        library.generate()
+      else:
+        library.build()
+  elif what == 'sysroot':
+    if do_clear:
+      cache.erase_file('sysroot_install.stamp')
+    if do_build:
+      system_libs.ensure_sysroot()
+  elif what in PORTS:
+    if do_clear:
+      clear_port(what)
+    if do_build:
+      build_port(what)
+  elif ':' in what or what.endswith('.py'):
+    name = ports.handle_use_port_arg(settings, what, lambda message: handle_port_error(what, message))
+    if do_clear:
+      clear_port(name)
+    if do_build:
+      build_port(name)
+  else:
+    logger.error('unfamiliar build target: ' + what)
+    return False
+
+  logger.info('...success%s. Took %s' % ('' if threading.current_thread() is threading.main_thread() else ' (%s)' % what, format_time(time.time() - start_time)))
+  return True
+
+
+BUNDLE_MANIFEST = 'emscripten_cache_bundle.json'
+
+# Cache entries installed by ensure_sysroot(), which are part of every bundle.
+SYSROOT_ENTRIES = [
+  'sysroot_install.stamp',
+  'sysroot/include',
+  'sysroot/lib/pkgconfig',
+  'sysroot/bin',
+]
+
+
+def get_bundle_files(entries):
+  """Returns the files under the given cache entries, relative to the cache
+  root."""
+  files = []
+  for entry in entries:
+    path = Path(cache.cachedir, entry)
+    if path.is_dir():
+      files += [f.relative_to(cache.cachedir).as_posix() for f in sorted(path.rglob('*')) if f.is_file()]
+    elif path.is_file():
+      files.append(entry)
+  return files
+
+
+def hash_file(filename):
+  h = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def get_tarfile_mode(bundle):
+  if bundle.endswith(('.tar.gz', '.tgz')):
+    return 'gz'
+  if bundle.endswith('.tar.xz'):
+    return 'xz'
+  if bundle.endswith('.tar'):
+    return ''
+  utils.exit_with_error(f'unsupported bundle file type: {bundle} (expected .tar, .tar.gz, .tgz or .tar.xz)')
+
+
+def get_bundle_settings():
+  """The settings that select which variants of the libraries are built, and
+  which therefore must match between the exporting and importing caches."""
+  return {
+    'LTO': settings.LTO,
+    'RELOCATABLE': int(settings.RELOCATABLE),
+    'MEMORY64': settings.MEMORY64,
+  }
+
+
+def export_bundle(bundle, tasks, system_libraries, jobs):
+  """Builds the given targets and packs their cache entries into `bundle`,
+  along with a manifest that describes the configuration they were built
+  for."""
+  mode = get_tarfile_mode(bundle)
+  if jobs > 1 and len(tasks) > 1 and not USE_NINJA:
+    if build_tasks_in_parallel(tasks, system_libraries, jobs):
+      return 1
+
+  # Build each target (which is a no-op if it is already in the cache) while
+  # recording which cache entries it uses.
+  targets = {'sysroot': SYSROOT_ENTRIES}
+  for what in tasks:
+    cache.accessed_entries = set()
+    try:
+      if not run_task(what, system_libraries, do_build=True, do_clear=False):
+        return 1
+    finally:
+      entries = cache.accessed_entries
+      cache.accessed_entries = None
+    targets[what] = sorted(entries - set(SYSROOT_ENTRIES))
+  if USE_NINJA:
+    system_libs.build_deferred()
+
+  # A frozen cache cannot be locked, but also won't change while we read it.
+  with contextlib.nullcontext() if config.FROZEN_CACHE else cache.lock('export'):
+    files = {f: hash_file(Path(cache.cachedir, f)) for f in get_bundle_files(sorted({e for entries in targets.values() for e in entries}))}
+    manifest = {
+      'emscripten_version': utils.EMSCRIPTEN_VERSION,
+      'sanity': shared.generate_sanity().strip(),
+      'settings': get_bundle_settings(),
+      'targets': targets,
+      'files': files,
+    }
+    manifest_data = json.dumps(manifest, indent=2).encode('utf-8')
+    # Write to a temporary file first, so that an interrupted export does not
+    # leave a truncated bundle behind.
+    with tarfile.open(bundle + '.tmp', 'w:' + mode) as tar:
+      info = tarfile.TarInfo(BUNDLE_MANIFEST)
+      info.size = len(manifest_data)
+      info.mtime = int(time.time())
+      tar.addfile(info, io.BytesIO(manifest_data))
+      for f in files:
+        tar.add(Path(cache.cachedir, f), arcname=f, recursive=False)
+    os.replace(bundle + '.tmp', bundle)
+
+  logger.info(f'exported {len(files)} files for {len(tasks)} targets to {bundle}')
+  return 0
+
+
+def import_bundle(bundle, tasks, force):
+  """Unpacks the cache entries of the given targets (or of all targets if
+  `tasks` is empty) from `bundle` into the cache.
+
+  All files are extracted to a temporary directory and verified against the
+  manifest before any of them are moved into place."""
+  get_tarfile_mode(bundle)
+  with tarfile.open(bundle, 'r:*') as tar:
+    try:
+      manifest = json.load(tar.extractfile(BUNDLE_MANIFEST))
+    except KeyError:
+      utils.exit_with_error(f'{bundle} is not an emscripten cache bundle (missing {BUNDLE_MANIFEST})')
+
+    if manifest['emscripten_version'] != utils.EMSCRIPTEN_VERSION:
+      message = f'{bundle} was created by emscripten {manifest["emscripten_version"]} but this is emscripten {utils.EMSCRIPTEN_VERSION}'
+      if not force:
+        utils.exit_with_error(message + ' (pass --force to import it anyway)')
+      logger.warning(message)
+    elif manifest['sanity'] != shared.generate_sanity().strip():
+      # The libraries themselves don't depend on where LLVM is installed.
+      logger.warning(f'{bundle} was created with a different LLVM_ROOT ({manifest["sanity"]})')
+
+    current_settings = get_bundle_settings()
+    mismatched = [f'{key}={value} (currently {current_settings.get(key)})' for key, value in manifest['settings'].items() if current_settings.get(key) != value]
+    if mismatched:
+      message = f'{bundle} was created with different settings: {", ".join(mismatched)}'
+      if not force:
+        utils.exit_with_error(message + ' (pass --force to import it anyway)')
+      logger.warning(message)
+
+    missing = [t for t in tasks if t not in manifest['targets']]
+    if missing:
+      utils.exit_with_error(f'targets not found in {bundle}: {" ".join(missing)}')
+    entries = set(SYSROOT_ENTRIES)
+    for what in tasks or manifest['targets']:
+      entries.update(manifest['targets'][what])
+    files = [f for f in manifest['files'] if any(f == e or f.startswith(e + '/') for e in entries)]
+
+    for f in files:
+      if os.path.isabs(f) or '..' in Path(f).parts:
+        utils.exit_with_error(f'invalid file name in {bundle}: {f}')
+
+    with cache.lock('import'):
+      tmpdir = tempfile.mkdtemp(prefix='import-', dir=cache.cachedir)
+      try:
+        for f in files:
+          try:
+            member = tar.getmember(f)
+          except KeyError:
+            utils.exit_with_error(f'{bundle} is missing file: {f}')
+          if not member.isfile():
+            utils.exit_with_error(f'invalid file in {bundle}: {f}')
+          dest = Path(tmpdir, f)
+          dest.parent.mkdir(parents=True, exist_ok=True)
+          with tar.extractfile(member) as src, open(dest, 'wb') as out:
+            shutil.copyfileobj(src, out)
+          os.chmod(dest, member.mode & 0o777 | 0o600)
+          if hash_file(dest) != manifest['files'][f]:
+            utils.exit_with_error(f'hash mismatch for {f} in {bundle}')
+        for f in files:
+          dest = Path(cache.cachedir, f)
+          dest.parent.mkdir(parents=True, exist_ok=True)
+          os.replace(Path(tmpdir, f), dest)
+      finally:
+        utils.delete_dir(tmpdir)
+
+  logger.info(f'imported {len(files)} files from {bundle}')
+  return 0
+
+
+def get_port_deps(what):
+  """Returns the names of all ports that the given target transitively depends
+  on."""
+  if what not in ports.ports_by_name:
+    return []
+  deps = []
+  todo = [what]
+  while todo:
+    for dep in ports.get_port_by_name(todo.pop()).deps:
+      dep, _ = ports.split_port_options(dep)
+      if dep not in deps:
+        deps.append(dep)
+        todo.append(dep)
+  return deps
+
+
+def build_tasks_in_parallel(tasks, system_libraries, jobs):
+  """Builds the given targets concurrently, running at most `jobs` compiler
+  subprocesses at any one time across all targets.
+
+  Ports are only built after the ports they depend on. Targets that need to
+  change the global settings (port variants and ports with options) are built
+  on their own, while no other targets are being built."""
+  # Ports that are not explicitly requested still get built first, so that
+  # two ports with a common dependency don't both try to build it.
+  deps = {}
+  for what in tasks:
+    deps[what] = get_port_deps(what)
+  for what in list(deps):
+    for dep in deps[what]:
+      if dep not in deps:
+        deps[dep] = get_port_deps(dep)
+  order = [t for t in deps if t not in tasks] + list(tasks)
+
+  def is_exclusive(what):
+    return what not in system_libraries and what not in ports.ports_by_name
+
+  # All libraries need the sysroot headers, install them before starting any
+  # concurrent builds.
+  system_libs.ensure_sysroot()
+
+  shared.JOB_SLOTS = threading.BoundedSemaphore(jobs)
+  condition = threading.Condition()
+  running = set()
+  done = set()
+  errors = []
+
+  def worker(what):
+    try:
+      if not run_task(what, system_libraries, do_build=True, do_clear=False):
+        errors.append(1)
+    except BaseException as e:
+      # exit_with_error() raises SystemExit, which would otherwise only end
+      # this thread.
+      errors.append(e)
+    finally:
+      with condition:
+        running.remove(what)
+        done.add(what)
+        condition.notify()
+
+  def get_next_task():
+    if any(is_exclusive(r) for r in running) or len(running) >= jobs:
+      return None
+    for what in order:
+      if all(d in done for d in deps[what]) and (not running or not is_exclusive(what)):
+        return what
+    return None
+
+  try:
+    with condition:
+      while (order and not errors) or running:
+        what = get_next_task() if not errors else None
+        if what is None:
+          condition.wait()
+          continue
+        order.remove(what)
+        running.add(what)
+        threading.Thread(target=worker, args=(what,), daemon=True).start()
+  finally:
+    shared.JOB_SLOTS = None
+  for e in errors:
+    if isinstance(e, BaseException):
+      raise e
+  return 1 if errors else 0
+
+
 def main():
   all_build_start_time = time.time()
 
@@ -214,11 +536,19 @@ def main():
                       help='show build commands')
   parser.add_argument('--wasm64', action='store_true',
                       help='use wasm64 architecture')
-  parser.add_argument('operation', choices=['build', 'clear', 'rebuild'])
+  parser.add_argument('-j', '--jobs', type=int, default=utils.get_num_cores(),
+                      help='maximum number of compiler processes to run at once when building multiple targets (default: number of cores)')
+  parser.add_argument('operation', choices=['build', 'clear', 'rebuild', 'export', 'import'])
   parser.add_argument('targets', nargs='*', help='see below')
   args = parser.parse_args()
 
-  if args.operation != 'rebuild' and len(args.targets) == 0:
+  bundle = None
+  if args.operation in ('export', 'import'):
+    if not args.targets:
+      shared.exit_with_error('no bundle file specified')
+    bundle = args.targets.pop(0)
+
+  if args.operation not in ('rebuild', 'import') and len(args.targets) == 0:
     shared.exit_with_error('no build targets specified')
 
   if args.operation == 'rebuild' and not USE_NINJA:
@@ -293,53 +623,35 @@ def main():
   if USE_NINJA:
     os.environ['EMBUILDER_PORT_BUILD_DEFERRED'] = '1'
 
-  for what in tasks:
+  for i, what in enumerate(tasks):
     for old, new in legacy_prefixes.items():
       if what.startswith(old):
-        what = what.replace(old, new)
-    if do_build:
-      logger.info('building ' + what)
-    else:
-      logger.info('clearing ' + what)
-    start_time = time.time()
-    if what in system_libraries:
-      library = system_libraries[what]
-      if do_clear:
-        library.erase()
-      if do_build:
-        if USE_NINJA:
-          library.generate()
-        else:
-          library.build()
-    elif what == 'sysroot':
-      if do_clear:
-        cache.erase_file('sysroot_install.stamp')
-      if do_build:
-        system_libs.ensure_sysroot()
-    elif what in PORTS:
-      if do_clear:
-        clear_port(what)
-      if do_build:
-        build_port(what)
-    elif ':' in what or what.endswith('.py'):
-      name = ports.handle_use_port_arg(settings, what, lambda message: handle_port_error(what, message))
-      if do_clear:
-        clear_port(name)
-      if do_build:
-        build_port(name)
-    else:
-      logger.error('unfamiliar build target: ' + what)
+        tasks[i] = what.replace(old, new)
+
+  if args.operation == 'export':
+    return export_bundle(bundle, tasks, system_libraries, args.jobs)
+  if args.operation == 'import':
+    return import_bundle(bundle, tasks, args.force)
+
+  if do_build and not USE_NINJA and args.jobs > 1 and len(tasks) > 1:
+    # Clear everything first, then build the targets concurrently.
+    if do_clear:
+      for what in tasks:
+        if not run_task(what, system_libraries, do_build=False, do_clear=True):
+          return 1
+    if build_tasks_in_parallel(tasks, system_libraries, args.jobs):
       return 1
-
-    time_taken = time.time() - start_time
-    logger.info('...success. Took %s(%.2fs)' % (('%02d:%02d mins ' % (time_taken // 60, time_taken % 60) if time_taken >= 60 else ''), time_taken))
+  else:
+    for what in tasks:
+      if not run_task(what, system_libraries, do_build, do_clear):
+        return 1
 
   if USE_NINJA and args.operation != 'clear':
     system_libs.build_deferred()
 
   if len(tasks) > 1 or USE_NINJA:
     all_build_time_taken = time.time() - all_build_start_time
-    logger.info('Built %d targets in %s(%.2fs)' % (len(tasks), ('%02d:%02d mins ' % (all_build_time_taken // 60, all_build_time_taken % 60) if all_build_time_taken >= 60 else ''), all_build_time_taken))
+    logger.info('Built %d targets in %s' % (len(tasks), format_time(all_build_time_taken)))
 
   return 0
 
@@ -20,6 +20,7 @@ See emrun --help for more information
 # standalone outside Emscripten directory tree.
 import argparse
 import atexit
+import heapq
 import json
 import math
 import os
@@ -35,7 +36,6 @@ import sys
 import tempfile
 import threading
 import time
-from operator import itemgetter
 
 if sys.version_info.major == 2:
   import SocketServer as socketserver
@@ -450,11 +450,21 @@ def detect_browser_processes():
 class HTTPWebServer(socketserver.ThreadingMixIn, HTTPServer):
   """Log messaging arriving via HTTP can come in out of sequence. Implement a
   sequencing mechanism to enforce ordered transmission."""
+  # Browsers keep connections alive between requests, so do not wait for the
+  # connection handler threads on shutdown.
+  daemon_threads = True
+  block_on_close = False
   expected_http_seq_num = 1
   # Stores messages that have arrived out of order, pending for a send as soon
-  # as the missing message arrives.  Kept in sorted order, first element is the
-  # oldest message received.
+  # as the missing message arrives.  Kept as a heap of (seq_num, arrival index,
+  # message, log function) tuples, first element is the oldest message
+  # received.
   http_message_queue = []
+  http_message_count = 0
+  # How often to check whether the browser process is still alive, in seconds.
+  # Detecting the browser processes is expensive, so this is not done after
+  # every served request.
+  liveness_check_interval = 1
 
   def handle_incoming_message(self, seq_num, log, data):
     global have_received_messages
@@ -471,8 +481,8 @@ class HTTPWebServer(socketserver.ThreadingMixIn, HTTPServer):
       elif seq_num < self.expected_http_seq_num:
         log(data)
       else:
-        self.http_message_queue += [(seq_num, data, log)]
-        self.http_message_queue.sort(key=itemgetter(0))
+        self.http_message_count += 1
+        heapq.heappush(self.http_message_queue, (seq_num, self.http_message_count, data, log))
         if len(self.http_message_queue) > 16:
           self.print_next_message()
 
@@ -508,9 +518,9 @@ class HTTPWebServer(socketserver.ThreadingMixIn, HTTPServer):
       while len(self.http_message_queue):
         msg = self.http_message_queue[0]
         if msg[0] == self.expected_http_seq_num:
-          msg[2](msg[1])
+          msg[3](msg[2])
           self.expected_http_seq_num += 1
-          self.http_message_queue.pop(0)
+          heapq.heappop(self.http_message_queue)
         else:
           return
 
@@ -520,15 +530,18 @@ class HTTPWebServer(socketserver.ThreadingMixIn, HTTPServer):
     self.timeout = timeout
     logi('Now listening at http://%s/' % ':'.join(map(str, self.socket.getsockname())))
     logv("Entering web server loop.")
+    next_liveness_check = tick()
     while self.is_running:
       now = tick()
       # Did user close browser?
-      if emrun_options.run_browser and not is_browser_process_alive():
-        logv("Shutting down because browser is no longer alive")
-        delete_emrun_safe_firefox_profile()
-        if not emrun_options.serve_after_close:
-          logv("Browser process has shut down, quitting web server.")
-          self.is_running = False
+      if emrun_options.run_browser and now >= next_liveness_check:
+        next_liveness_check = now + self.liveness_check_interval
+        if not is_browser_process_alive():
+          logv("Shutting down because browser is no longer alive")
+          delete_emrun_safe_firefox_profile()
+          if not emrun_options.serve_after_close:
+            logv("Browser process has shut down, quitting web server.")
+            self.is_running = False
 
       # Serve HTTP
       self.handle_request()
@@ -576,6 +589,62 @@ class HTTPWebServer(socketserver.ThreadingMixIn, HTTPServer):
     return 1
 
 
+# Returns a tuple (content_encoding, uncompressed_path) for a file that is
+# stored precompressed on disk, or (None, path) for other files.
+# All files of type x.gz are served as gzip-compressed, which means the browser
+# will transparently decode the file before passing the uncompressed bytes to
+# the JS page.
+# Note: In a slightly silly manner, detect files ending with "gz" and not
+# ".gz", since both Unity and UE4 generate multiple files with .jsgz, .datagz,
+# .memgz, .symbolsgz suffixes and so on, so everything goes.
+# Note 2: If the JS application would like to receive the actual bits of a
+# gzipped file, instead of having the browser decompress it immediately, then
+# it can't use the suffix .gz when using emrun.
+# To work around, one can use the suffix .gzip instead.
+def get_content_encoding(path):
+  for suffix, encoding in (('gz', 'gzip'), ('br', 'br')):
+    if path.lower().endswith(suffix):
+      path = path[:-2]
+      if path.endswith('.'):
+        path = path[:-1]
+      return (encoding, path)
+  return (None, path)
+
+
+# Returns the set of content codings that an Accept-Encoding request header
+# allows, e.g. "gzip, deflate, br;q=0" -> {'gzip', 'deflate'}.
+def parse_accept_encoding(header):
+  accepted = set()
+  for coding in header.split(','):
+    params = coding.strip().split(';')
+    name = params[0].strip().lower()
+    q = 1.0
+    for param in params[1:]:
+      key, _, value = param.strip().partition('=')
+      if key.strip().lower() == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    if name and q > 0:
+      accepted.add(name)
+  return accepted
+
+
+# Returns true if an If-None-Match/If-Range header value matches the given
+# entity tag.
+def etag_matches(header, etag):
+  if not header:
+    return False
+  for tag in header.split(','):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    if tag in ('*', etag):
+      return True
+  return False
+
+
 # Processes HTTP request back to the browser.
 class HTTPHandler(SimpleHTTPRequestHandler):
   protocol_version = 'HTTP/1.1'  # noqa: DC01
@@ -584,6 +653,7 @@ class HTTPHandler(SimpleHTTPRequestHandler):
     global page_last_served_time
     path = self.translate_path(self.path)
     f = None
+    self.send_range = None
 
     # A browser has navigated to this page - check which PID got spawned for
     # the browser
@@ -608,60 +678,151 @@ class HTTPHandler(SimpleHTTPRequestHandler):
         # Manually implement directory listing support.
         return self.list_directory(path)
 
+    # Files ending in "gz" or "br" are served as precompressed content, see
+    # get_content_encoding(). Otherwise, if the browser accepts it, transparently
+    # serve a precompressed sibling file "path.br" or "path.gz" in place of the
+    # uncompressed file. Range requests address the bytes of the file on disk,
+    # so those always get the identity encoding.
+    content_encoding, guess_file_type = get_content_encoding(path)
+    negotiated = False
+    if not content_encoding and 'Range' not in self.headers:
+      accepted = parse_accept_encoding(self.headers.get('Accept-Encoding', ''))
+      for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in accepted and os.path.isfile(path + suffix):
+          logv('Serving ' + path + suffix + ' in place of ' + path + '.')
+          path += suffix
+          content_encoding = encoding
+          negotiated = True
+          break
+
     try:
       f = open(path, 'rb')
     except IOError:
       self.send_error(404, "File not found: " + path)
       return None
 
-    self.send_response(200)
-    guess_file_type = path
-    # All files of type x.gz are served as gzip-compressed, which means the
-    # browser will transparently decode the file before passing the
-    # uncompressed bytes to the JS page.
-    # Note: In a slightly silly manner, detect files ending with "gz" and not
-    # ".gz", since both Unity and UE4 generate multiple files with .jsgz,
-    # .datagz, .memgz, .symbolsgz suffixes and so on, so everything goes.
-    # Note 2: If the JS application would like to receive the actual bits of a
-    # gzipped file, instead of having the browser decompress it immediately,
-    # then it can't use the suffix .gz when using emrun.
-    # To work around, one can use the suffix .gzip instead.
-    if path.lower().endswith('gz'):
-      self.send_header('Content-Encoding', 'gzip')
-      logv('Serving ' + path + ' as gzip-compressed.')
-      guess_file_type = guess_file_type[:-2]
-      if guess_file_type.endswith('.'):
-        guess_file_type = guess_file_type[:-1]
-    elif path.lower().endswith('br'):
-      self.send_header('Content-Encoding', 'br')
-      logv('Serving ' + path + ' as brotli-compressed.')
-      guess_file_type = guess_file_type[:-2]
-      if guess_file_type.endswith('.'):
-        guess_file_type = guess_file_type[:-1]
-
-    ctype = self.guess_type(guess_file_type)
-    if guess_file_type.lower().endswith('.wasm'):
-      ctype = 'application/wasm'
-    if guess_file_type.lower().endswith('.js'):
-      ctype = 'application/javascript'
-    self.send_header('Content-type', ctype)
-    fs = os.fstat(f.fileno())
-    self.send_header("Content-Length", str(fs.st_size))
-    self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+    try:
+      fs = os.fstat(f.fileno())
+      size = fs.st_size
+      etag = '"%x-%x%s"' % (int(fs.st_mtime * 1000000), size, '-' + content_encoding if content_encoding else '')
+
+      if etag_matches(self.headers.get('If-None-Match'), etag):
+        f.close()
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_common_headers()
+        self.end_headers()
+        return None
+
+      byte_range = self.parse_range(size, etag)
+      if byte_range == 'unsatisfiable':
+        f.close()
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */%d' % size)
+        self.send_header('Content-Length', '0')
+        self.send_common_headers()
+        self.end_headers()
+        return None
+
+      if byte_range:
+        start, end = byte_range
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+      else:
+        start, end = 0, size - 1
+        self.send_response(200)
+      self.send_range = (start, end - start + 1)
+
+      if content_encoding:
+        self.send_header('Content-Encoding', content_encoding)
+        if not negotiated:
+          logv('Serving ' + path + ' as ' + content_encoding + '-compressed.')
+      if negotiated or os.path.isfile(path + '.br') or os.path.isfile(path + '.gz'):
+        self.send_header('Vary', 'Accept-Encoding')
+
+      ctype = self.guess_type(guess_file_type)
+      if guess_file_type.lower().endswith('.wasm'):
+        ctype = 'application/wasm'
+      if guess_file_type.lower().endswith('.js'):
+        ctype = 'application/javascript'
+      self.send_header('Content-type', ctype)
+      self.send_header("Content-Length", str(end - start + 1))
+      self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+      self.send_header('ETag', etag)
+      self.send_header('Accept-Ranges', 'bytes')
+      self.send_common_headers()
+      self.end_headers()
+    except Exception:
+      f.close()
+      raise
+    page_last_served_time = tick()
+    return f
+
+  # Headers that are sent on all responses to file requests.
+  def send_common_headers(self):
     self.send_header('Cache-Control', 'no-cache, must-revalidate')
-    self.send_header('Connection', 'close')
     self.send_header('Expires', '-1')
     self.send_header('Access-Control-Allow-Origin', '*')
     self.send_header('Cross-Origin-Opener-Policy', 'same-origin')
     self.send_header('Cross-Origin-Embedder-Policy', 'require-corp')
     self.send_header('Cross-Origin-Resource-Policy', 'cross-origin')
-    self.end_headers()
-    page_last_served_time = tick()
-    return f
+
+  # Parses a single "Range: bytes=start-end" request header. Returns the
+  # inclusive (start, end) byte range to serve, None if the whole file should
+  # be served, or 'unsatisfiable' if the range lies outside the file.
+  # Multipart ranges are not supported, and are answered with the whole file.
+  def parse_range(self, size, etag):
+    header = self.headers.get('Range')
+    if not header:
+      return None
+    # Only honor the range if the client's copy is still current.
+    if_range = self.headers.get('If-Range')
+    if if_range and not etag_matches(if_range, etag):
+      return None
+    m = re.match(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', header)
+    if not m or (not m.group(1) and not m.group(2)):
+      return None
+    if m.group(1):
+      start = int(m.group(1))
+      if m.group(2) and int(m.group(2)) < start:
+        return None
+      if start >= size:
+        return 'unsatisfiable'
+      end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    else:
+      # Suffix range "bytes=-n" addresses the last n bytes of the file.
+      suffix_length = int(m.group(2))
+      if suffix_length == 0 or size == 0:
+        return 'unsatisfiable'
+      start = max(0, size - suffix_length)
+      end = size - 1
+    return (start, end)
+
+  # Writes the file body (or the requested byte range of it) to the socket.
+  # Uses sendfile() where available so that large .wasm and .data files do not
+  # need to be copied through Python.
+  def copyfile(self, source, outputfile):
+    if self.send_range is None:
+      # Directory listings and other in-memory responses
+      return SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+    offset, count = self.send_range
+    if count <= 0:
+      return
+    if hasattr(self.connection, 'sendfile'):
+      outputfile.flush()
+      self.connection.sendfile(source, offset, count)
+      return
+    source.seek(offset)
+    while count > 0:
+      buf = source.read(min(count, 1024 * 1024))
+      if not buf:
+        break
+      outputfile.write(buf)
+      count -= len(buf)
 
   def log_request(self, code):
-    # Filter out 200 OK messages to remove noise.
-    if code != 200:
+    # Filter out successful responses to remove noise.
+    if code not in (200, 206, 304):
       SimpleHTTPRequestHandler.log_request(self, code)
 
   def log_message(self, format, *args):  # noqa: DC04
@@ -670,8 +831,47 @@ class HTTPHandler(SimpleHTTPRequestHandler):
     if 'favicon.ico' not in msg:
       sys.stderr.write(msg)
 
-  def do_POST(self):  # # noqa: DC04
+  # Processes a single message POSTed by the page. Returns False if the web
+  # server is shutting down.
+  def handle_message_record(self, data):
     global page_exit_code, have_received_messages
+    data = data.replace("+", " ")
+    data = unquote_u(data)
+
+    if data == '^pageload^': # Browser is just notifying that it has successfully launched the page.
+      have_received_messages = True
+    elif data.startswith('^exit^'):
+      if not emrun_options.serve_after_exit:
+        page_exit_code = int(data[6:])
+        logv('Web page has quit with a call to exit() with return code ' + str(page_exit_code) + '. Shutting down web server. Pass --serve-after-exit to keep serving even after the page terminates with exit().')
+        # Set server socket to nonblocking on shutdown to avoid sporadic deadlocks
+        self.server.socket.setblocking(False)
+        self.server.shutdown()
+        return False
+    else:
+      # The user page sent a message with POST. Parse the message and log it to stdout/stderr.
+      is_stdout = False
+      is_stderr = False
+      seq_num = -1
+      # The html shell is expected to send messages of form ^out^(number)^(message) or ^err^(number)^(message).
+      if data.startswith('^err^'):
+        is_stderr = True
+      elif data.startswith('^out^'):
+        is_stdout = True
+      if is_stderr or is_stdout:
+        try:
+          i = data.index('^', 5)
+          seq_num = int(data[5:i])
+          data = data[i + 1:]
+        except ValueError:
+          pass
+
+      log = browser_loge if is_stderr else browser_logi
+      self.server.handle_incoming_message(seq_num, log, data)
+    return True
+
+  def do_POST(self):  # # noqa: DC04
+    global have_received_messages
 
     (_, _, path, query, _) = urlsplit(self.path)
     logv('POST: "' + self.path + '" (path: "' + path + '", query: "' + query + '")')
@@ -708,44 +908,16 @@ class HTTPHandler(SimpleHTTPRequestHandler):
       data = self.rfile.read(int(self.headers['Content-Length']))
       if str is not bytes and isinstance(data, bytes):
         data = data.decode('utf-8')
-      data = data.replace("+", " ")
-      data = unquote_u(data)
-
-      if data == '^pageload^': # Browser is just notifying that it has successfully launched the page.
-        have_received_messages = True
-      elif data.startswith('^exit^'):
-        if not emrun_options.serve_after_exit:
-          page_exit_code = int(data[6:])
-          logv('Web page has quit with a call to exit() with return code ' + str(page_exit_code) + '. Shutting down web server. Pass --serve-after-exit to keep serving even after the page terminates with exit().')
-          # Set server socket to nonblocking on shutdown to avoid sporadic deadlocks
-          self.server.socket.setblocking(False)
-          self.server.shutdown()
+      # The page may batch several messages into one POST, separated by
+      # newlines. Newlines inside the messages themselves are URI-encoded.
+      for record in data.split('\n'):
+        if not self.handle_message_record(record):
           return
-      else:
-        # The user page sent a message with POST. Parse the message and log it to stdout/stderr.
-        is_stdout = False
-        is_stderr = False
-        seq_num = -1
-        # The html shell is expected to send messages of form ^out^(number)^(message) or ^err^(number)^(message).
-        if data.startswith('^err^'):
-          is_stderr = True
-        elif data.startswith('^out^'):
-          is_stdout = True
-        if is_stderr or is_stdout:
-          try:
-            i = data.index('^', 5)
-            seq_num = int(data[5:i])
-            data = data[i + 1:]
-          except ValueError:
-            pass
-
-        log = browser_loge if is_stderr else browser_logi
-        self.server.handle_incoming_message(seq_num, log, data)
 
     self.send_response(200)
     self.send_header('Content-type', 'text/plain')
+    self.send_header('Content-Length', '2')
     self.send_header('Cache-Control', 'no-cache, must-revalidate')
-    self.send_header('Connection', 'close')
     self.send_header('Expires', '-1')
     self.end_headers()
     self.wfile.write(b'OK')
@@ -15,6 +15,9 @@ if (globalThis.window && (typeof ENVIRONMENT_IS_PTHREAD == 'undefined' || !ENVIR
     // communication is done, after which we can close.
     var emrun_num_post_messages_in_flight = 0;
     var emrun_should_close_itself = false;
+    // stdout and stderr messages that are waiting for the previous POST to
+    // finish. These are then sent as a single batch, one message per line.
+    var emrun_pending_messages = [];
     var postExit = (msg) => {
       var http = new XMLHttpRequest();
       // Don't do this immediately, this may race with the notification about
@@ -34,7 +37,11 @@ if (globalThis.window && (typeof ENVIRONMENT_IS_PTHREAD == 'undefined' || !ENVIR
       ++emrun_num_post_messages_in_flight;
       http.onreadystatechange = () => {
         if (http.readyState == 4 /*DONE*/) {
-          if (--emrun_num_post_messages_in_flight == 0 && emrun_should_close_itself) {
+          --emrun_num_post_messages_in_flight;
+          if (emrun_pending_messages.length) {
+            post(emrun_pending_messages.join('\n'));
+            emrun_pending_messages = [];
+          } else if (emrun_num_post_messages_in_flight == 0 && emrun_should_close_itself) {
             postExit('^exit^'+EXITSTATUS);
           }
         }
@@ -42,6 +49,15 @@ if (globalThis.window && (typeof ENVIRONMENT_IS_PTHREAD == 'undefined' || !ENVIR
       http.open("POST", "stdio.html", true);
       http.send(msg);
     };
+    // Sends a log message right away if the server is idle, otherwise queues it
+    // up to be sent in the next batch.
+    var postLog = (msg) => {
+      if (emrun_num_post_messages_in_flight) {
+        emrun_pending_messages.push(msg);
+      } else {
+        post(msg);
+      }
+    };
     // If the address contains localhost, or we are running the page from port
     // 6931, we can assume we're running the test runner and should post stdout
     // logs.
@@ -57,11 +73,11 @@ if (globalThis.window && (typeof ENVIRONMENT_IS_PTHREAD == 'undefined' || !ENVIR
         }
       });
       out = (text) => {
-        post('^out^'+(emrun_http_sequence_number++)+'^'+encodeURIComponent(text));
+        postLog('^out^'+(emrun_http_sequence_number++)+'^'+encodeURIComponent(text));
         prevPrint(text);
       };
       err = (text) => {
-        post('^err^'+(emrun_http_sequence_number++)+'^'+encodeURIComponent(text));
+        postLog('^err^'+(emrun_http_sequence_number++)+'^'+encodeURIComponent(text));
         prevErr(text);
       };
 
@@ -468,10 +468,10 @@ var LibraryEmbind = {
         def.printJs(out);
       }
       out.push('}\n');
-      return JSON.stringify({
+      return {
         'invokers': out.join(''),
         publicSymbols,
-      });
+      };
     }
   },
 
@@ -848,7 +848,8 @@ var LibraryEmbind = {
   $emitOutput__deps: ['$awaitingDependencies', '$throwBindingError', '$getTypeName', '$moduleDefinitions',
 #if EMBIND_AOT
     '$JsPrinter',
-#else
+#endif
+#if EMIT_TSD
     '$TsPrinter',
 #endif
   ],
@@ -857,14 +858,17 @@ var LibraryEmbind = {
     for (const typeId in awaitingDependencies) {
       throwBindingError(`Missing binding for type: '${getTypeName(typeId)}' typeId: ${typeId}`);
     }
+    // Both the AOT invokers and the TypeScript definitions can be generated
+    // by a single run.
+    const output = {};
 #if EMBIND_AOT
-    const printer = new JsPrinter(moduleDefinitions);
-#else
-    const printer = new TsPrinter(moduleDefinitions);
+    Object.assign(output, new JsPrinter(moduleDefinitions).print());
+#endif
+#if EMIT_TSD
+    output['tsd'] = new TsPrinter(moduleDefinitions).print();
 #endif
-    const output = printer.print();
     var fs = require('fs');
-    fs.writeFileSync(process.argv[2], output + '\n');
+    fs.writeFileSync(process.argv[2], JSON.stringify(output) + '\n');
   },
 
   // Stub functions used by eval, but not needed for TS generation:
@@ -1718,6 +1718,53 @@ FS.staticInit();`;
         }
       }
     },
+    // Creates a file whose contents are provided by `getContents`, which is
+    // called synchronously the first time the file is opened (or truncated to
+    // a non-zero size) and must return a Uint8Array.  Until then, stat()
+    // reports `size` as the size of the file.
+    createLazyDataFile(parent, name, size, getContents, canRead, canWrite) {
+      var path = name;
+      if (parent) {
+        parent = typeof parent == 'string' ? parent : FS.getPath(parent);
+        path = name ? PATH.join2(parent, name) : parent;
+      }
+      var node = FS.create(path, FS_getMode(canRead, canWrite));
+      node.usedBytes = size;
+      var load = () => {
+        if (!getContents) return;
+        try {
+          var contents = getContents();
+        } catch (e) {
+          err(`failed to load contents of ${path}: ${e}`);
+          throw new FS.ErrnoError({{{ cDefs.EIO }}});
+        }
+        getContents = null;
+        node.contents = contents;
+        node.usedBytes = contents.length;
+      };
+      node.stream_ops = {
+        ...node.stream_ops,
+        open(stream) {
+          load();
+        },
+      };
+      var setattr = node.node_ops.setattr;
+      node.node_ops = {
+        ...node.node_ops,
+        setattr(node, attr) {
+          if (attr.size !== undefined) {
+            // Truncating to zero does not need the old contents.
+            if (attr.size) {
+              load();
+            } else {
+              getContents = null;
+            }
+          }
+          return setattr(node, attr);
+        },
+      };
+      return node;
+    },
     // Creates a file record for lazy-loading from a URL. XXX This requires a synchronous
     // XHR, which is not possible in browsers except in a web worker! Use preloading,
     // either --preload-file in emcc or FS.createPreloadedFile
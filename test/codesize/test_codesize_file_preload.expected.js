@@ -139,7 +139,7 @@ Module["expectedDataFileDownloads"]++;
       if (!fetched) {
         fetched = await fetchPromise;
       }
-      processPackageData(fetched);
+      await processPackageData(fetched);
     }
     if (Module["calledRun"]) {
       runWithFS(Module);
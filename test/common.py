@@ -41,7 +41,7 @@ from tools.shared import EMCC, EMXX, DEBUG, exe_suffix
 from tools.shared import get_canonical_temp_dir, path_from_root
 from tools.utils import MACOS, WINDOWS, read_file, read_binary, write_binary, exit_with_error
 from tools.settings import COMPILE_TIME_SETTINGS
-from tools import shared, feature_matrix, building, config, utils
+from tools import shared, feature_matrix, building, config, filelock, utils
 
 logger = logging.getLogger('common')
 
@@ -84,6 +84,13 @@ EMTEST_CAPTURE_STDIO = int(os.getenv('EMTEST_CAPTURE_STDIO', '0'))
 if 'EM_BUILD_VERBOSE' in os.environ:
   exit_with_error('EM_BUILD_VERBOSE has been renamed to EMTEST_BUILD_VERBOSE')
 
+# Third party libraries built by the tests (see `RunnerCore.get_library`) are
+# cached in this directory, which is shared by all the test runner processes
+# and kept between runs.  Set EMTEST_LIBRARY_CACHE=0 to disable this cache.
+EMTEST_LIBRARY_CACHE = os.getenv('EMTEST_LIBRARY_CACHE', path_from_root('out/library_cache'))
+if EMTEST_LIBRARY_CACHE == '0':
+  EMTEST_LIBRARY_CACHE = None
+
 # If we are drawing a parallel swimlane graph of test output, we need to use a temp
 # file to track which tests were flaky so they can be graphed in orange color to
 # visually stand out.
@@ -165,7 +172,9 @@ def errlog(*args):
   print(*args, file=sys.stderr)
 
 
-def load_previous_test_run_results():
+def load_previous_test_run_results(filename=None):
+  if filename:
+    return json.load(open(filename))
   try:
     return json.load(open(PREVIOUS_TEST_RUN_RESULTS_FILE))
   except FileNotFoundError:
@@ -1853,13 +1862,18 @@ class RunnerCore(unittest.TestCase, metaclass=RunnerMeta):
       # try to pass linker settings when compiling).
       cflags = self.get_cflags(compile_only=True)
 
-    hash_input = (str(cflags) + ' $ ' + str(env_init)).encode('utf-8')
+    # The build arguments are part of the key, so that the same library built
+    # in different ways (e.g. with cmake and with configure), or after the
+    # arguments are changed, does not reuse the results of another build (which
+    # may be cached on disk, see below).
+    build_args = [configure, configure_args, make, make_args, generated_libs, native]
+    hash_input = (str(cflags) + ' $ ' + str(env_init) + ' $ ' + str(build_args)).encode('utf-8')
     cache_name = name + ','.join([opt for opt in cflags if len(opt) < 7]) + '_' + hashlib.md5(hash_input).hexdigest() + cache_name_extra
 
     valid_chars = "_%s%s" % (string.ascii_letters, string.digits)
     cache_name = ''.join([(c if c in valid_chars else '_') for c in cache_name])
 
-    if not force_rebuild and self.library_cache.get(cache_name):
+    def load_from_cache():
       errlog('<load %s from cache> ' % cache_name)
       generated_libs = []
       for basename, contents in self.library_cache[cache_name]:
@@ -1868,18 +1882,32 @@ class RunnerCore(unittest.TestCase, metaclass=RunnerMeta):
         generated_libs.append(bc_file)
       return generated_libs
 
-    errlog(f'<building and saving {cache_name} into cache>')
-    if configure and configure_args:
-      # Make to copy to avoid mutating default param
-      configure = list(configure)
-      configure += configure_args
-
-    cflags = ' '.join(cflags)
-    env_init.setdefault('CFLAGS', cflags)
-    env_init.setdefault('CXXFLAGS', cflags)
-    return build_library(name, build_dir, generated_libs, configure,
-                         make, make_args, self.library_cache,
-                         cache_name, env_init=env_init, native=native)
+    if not force_rebuild and self.library_cache.get(cache_name):
+      return load_from_cache()
+
+    def build():
+      errlog(f'<building and saving {cache_name} into cache>')
+      full_configure = configure
+      if configure and configure_args:
+        # Make to copy to avoid mutating default param
+        full_configure = list(configure) + configure_args
+
+      cflags_str = ' '.join(cflags)
+      env_init.setdefault('CFLAGS', cflags_str)
+      env_init.setdefault('CXXFLAGS', cflags_str)
+      return build_library(name, build_dir, generated_libs, full_configure,
+                           make, make_args, self.library_cache,
+                           cache_name, env_init=env_init, native=native)
+
+    if force_rebuild or not EMTEST_LIBRARY_CACHE:
+      return build()
+
+    cache_dir = os.path.join(EMTEST_LIBRARY_CACHE, cache_name)
+    fingerprint = get_library_fingerprint(test_file(name.replace('_native', '')))
+    libs = load_or_build_library(cache_dir, fingerprint, self.library_cache, cache_name, build)
+    if libs is None:
+      return load_from_cache()
+    return libs
 
   def clear(self):
     force_delete_contents(self.get_dir())
@@ -2871,6 +2899,67 @@ class BrowserCore(RunnerCore):
 ###################################################################################################
 
 
+@utils.memoize
+def get_library_fingerprint(source_dir):
+  """Returns a hash of the things that the libraries cached on disk by
+  `RunnerCore.get_library` depend on, other than the flags they are built
+  with: the library sources, the compiler, and emscripten's headers and
+  tools."""
+  h = hashlib.sha256()
+  h.update(utils.EMSCRIPTEN_VERSION.encode())
+
+  def add_file(filename):
+    st = os.stat(filename)
+    h.update(f'{filename}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+
+  for root in (source_dir, path_from_root('system/include'), path_from_root('tools')):
+    for dirpath, dirnames, filenames in os.walk(root):
+      dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+      for filename in sorted(filenames):
+        add_file(os.path.join(dirpath, filename))
+  add_file(shared.CLANG_CC)
+  add_file(path_from_root('emcc.py'))
+  return h.hexdigest()
+
+
+def load_or_build_library(cache_dir, fingerprint, cache, cache_name, build):
+  """Loads the library cached on disk in `cache_dir` into `cache`, unless it
+  is missing or its fingerprint does not match, in which case it is built (by
+  calling `build`) and saved there.  Returns the result of `build`, or None if
+  the library was loaded.
+
+  The library is only built by one of the test runner processes, while any
+  others that need it wait for it to be done and then load the result.
+  """
+  ensure_dir(os.path.dirname(cache_dir))
+  with filelock.FileLock(cache_dir + '.lock'):
+    if load_library_from_disk(cache_dir, fingerprint, cache, cache_name):
+      return None
+    libs = build()
+    save_library_to_disk(cache_dir, fingerprint, cache[cache_name])
+    return libs
+
+
+def load_library_from_disk(cache_dir, fingerprint, cache, cache_name):
+  fingerprint_file = os.path.join(cache_dir, 'fingerprint')
+  if not os.path.exists(fingerprint_file) or read_file(fingerprint_file) != fingerprint:
+    return False
+  cache[cache_name] = []
+  for basename in read_file(os.path.join(cache_dir, 'files')).splitlines():
+    cache[cache_name].append((basename, read_binary(os.path.join(cache_dir, basename))))
+  return True
+
+
+def save_library_to_disk(cache_dir, fingerprint, files):
+  utils.delete_dir(cache_dir)
+  ensure_dir(cache_dir)
+  for basename, contents in files:
+    write_binary(os.path.join(cache_dir, basename), contents)
+  utils.write_file(os.path.join(cache_dir, 'files'), '\n'.join(basename for basename, _ in files))
+  # The fingerprint is written last, to mark the entry as complete.
+  utils.write_file(os.path.join(cache_dir, 'fingerprint'), fingerprint)
+
+
 def build_library(name,
                   build_dir,
                   generated_libs,
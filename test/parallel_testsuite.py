@@ -51,6 +51,8 @@ def run_test(test, failfast_event, lock, progress_counter, num_tests):
 
   olddir = os.getcwd()
   result = BufferedParallelTestResult(lock, progress_counter, num_tests)
+  result.worker_id = common.worker_id
+  result.run_start_time = time.perf_counter()
   temp_dir = tempfile.mkdtemp(prefix='emtest_')
   test.set_temp_dir(temp_dir)
   try:
@@ -72,6 +74,7 @@ def run_test(test, failfast_event, lock, progress_counter, num_tests):
   # working directory is not within it.
   os.chdir(olddir)
   common.force_delete_dir(temp_dir)
+  result.run_end_time = time.perf_counter()
   return result
 
 
@@ -87,6 +90,73 @@ def tear_down():
   return True
 
 
+def predict_test_durations(tests, results_file=None):
+  """Returns a dict of the predicted duration of each test, keyed by test name.
+
+  Predictions are the durations recorded by previous test runs, read from
+  `results_file` if given and from the results of the last local run
+  otherwise.  Tests that
+  have not been run before are assumed to take as long as the median known
+  test, or as long as the slowest known test if they are marked as slow.
+  """
+  previous_test_run_results = common.load_previous_test_run_results(results_file)
+  known = sorted(r['duration'] for r in previous_test_run_results.values() if r.get('duration'))
+  median = known[len(known) // 2] if known else 1
+  slowest = known[-1] if known else 2
+
+  def predict(test):
+    test_name = str(test)
+    # Fall back to the duration of the same test in another suite
+    for name in (test_name, test_name.split(' ')[0]):
+      if previous_test_run_results.get(name, {}).get('duration'):
+        return previous_test_run_results[name]['duration']
+    testMethod = getattr(test, test._testMethodName)
+    return slowest if getattr(testMethod, 'is_slow', False) else median
+
+  return {str(test): predict(test) for test in tests}
+
+
+def shard_tests(tests, index, count, results_file=None):
+  """Returns the tests that belong to shard `index` (1-based) of `count`.
+
+  Tests are assigned longest first to the shard with the least predicted
+  duration so far, so that the shards take about the same time to run.  All
+  shards must be computed from the same previous test run results for them
+  to be disjoint, so when the shards run on different machines pass the same
+  `results_file` to each of them.
+  """
+  durations = predict_test_durations(tests, results_file)
+  totals = [0] * count
+  selected = set()
+  for test_name in sorted(set(durations), key=lambda name: (-durations[name], name)):
+    shard = totals.index(min(totals))
+    totals[shard] += durations[test_name]
+    if shard == index - 1:
+      selected.add(test_name)
+  return [t for t in tests if str(t) in selected]
+
+
+def report_idle_time(results, num_workers, run_time):
+  """Reports how much of the run the workers spent waiting for the slowest
+  workers to finish."""
+  busy = {}
+  finished = {}
+  for r in results:
+    busy[r.worker_id] = busy.get(r.worker_id, 0) + r.run_end_time - r.run_start_time
+    if r.run_end_time > finished.get(r.worker_id, (0, None))[0]:
+      finished[r.worker_id] = (r.run_end_time, r)
+  if not busy or run_time <= 0:
+    return
+  total_time = num_workers * run_time
+  idle_time = total_time - sum(busy.values())
+  errlog(f'Worker idle time: {idle_time:.2f}s of {total_time:.2f}s ({idle_time * 100 / total_time:.1f}%)')
+  first_done = min(end for end, _ in finished.values())
+  last_done, last = max(finished.values(), key=lambda f: f[0])
+  if len(finished) > 1:
+    errlog(f'Last test to finish: {last.test_name} ({last.run_end_time - last.run_start_time:.2f}s), '
+           f'{last_done - first_done:.2f}s after the first worker ran out of tests')
+
+
 class ParallelTestSuite(unittest.BaseTestSuite):
   """Runs a suite of tests in parallel.
 
@@ -98,6 +168,9 @@ class ParallelTestSuite(unittest.BaseTestSuite):
     self.max_cores = max_cores
     self.failfast = options.failfast
     self.failing_and_slow_first = options.failing_and_slow_first
+    # Sharded runs see only part of the tests and must keep splitting them the
+    # same way, so they do not record their results.
+    self.record_results = not options.shard
 
   def addTest(self, test):
     super().addTest(test)
@@ -135,7 +208,9 @@ class ParallelTestSuite(unittest.BaseTestSuite):
           failfast_event = manager.Event() if self.failfast else None
           progress_counter = manager.Value('i', 0)
           lock = manager.Lock()
+        run_start_time = time.perf_counter()
         results = pool.starmap(run_test, ((t, failfast_event, lock, progress_counter, len(tests)) for t in tests), chunksize=1)
+        run_time = time.perf_counter() - run_start_time
         # Send a task to each worker to tear down the browser and server. This
         # relies on the implementation detail in the worker pool that all workers
         # are cycled through once.
@@ -148,47 +223,51 @@ class ParallelTestSuite(unittest.BaseTestSuite):
     if self.failfast:
       results = [r for r in results if r is not None]
 
-    if self.failing_and_slow_first:
-      previous_test_run_results = common.load_previous_test_run_results()
-      for r in results:
-        # Save a test result record with the specific suite name (e.g. "core0.test_foo")
-        test_failed = r.test_result not in ['success', 'skipped']
-
-        def update_test_results_to(test_name):
-          fail_frequency = previous_test_run_results[test_name]['fail_frequency'] if test_name in previous_test_run_results else int(test_failed)
-          # Apply exponential moving average with 50% weighting to merge previous fail frequency with new fail frequency
-          fail_frequency = (fail_frequency + int(test_failed)) / 2
-          previous_test_run_results[test_name] = {
-            'result': r.test_result,
-            'duration': r.test_duration,
-            'fail_frequency': fail_frequency,
-          }
-
-        update_test_results_to(r.test_name)
-        # Also save a test result record without suite name (e.g. just "test_foo"). This enables different suite runs to order tests
-        # for quick --failfast termination, in case a test fails in multiple suites
-        update_test_results_to(r.test_name.split(' ')[0])
-
-      json.dump(previous_test_run_results, open(common.PREVIOUS_TEST_RUN_RESULTS_FILE, 'w'), indent=2)
+    report_idle_time(results, use_cores, run_time)
+
+    if self.record_results:
+      self.record_test_run_results(results)
 
     return self.combine_results(result, results)
 
+  def record_test_run_results(self, results):
+    # Record the results of this run, which are used to schedule the next one.
+    previous_test_run_results = common.load_previous_test_run_results()
+    for r in results:
+      # Save a test result record with the specific suite name (e.g. "core0.test_foo")
+      test_failed = r.test_result not in ['success', 'skipped']
+
+      def update_test_results_to(test_name):
+        fail_frequency = previous_test_run_results[test_name]['fail_frequency'] if test_name in previous_test_run_results else int(test_failed)
+        # Apply exponential moving average with 50% weighting to merge previous fail frequency with new fail frequency
+        fail_frequency = (fail_frequency + int(test_failed)) / 2
+        previous_test_run_results[test_name] = {
+          'result': r.test_result,
+          'duration': r.test_duration,
+          'fail_frequency': fail_frequency,
+        }
+
+      update_test_results_to(r.test_name)
+      # Also save a test result record without suite name (e.g. just "test_foo"). This enables different suite runs to order tests
+      # for quick --failfast termination, in case a test fails in multiple suites
+      update_test_results_to(r.test_name.split(' ')[0])
+
+    os.makedirs(os.path.dirname(common.PREVIOUS_TEST_RUN_RESULTS_FILE), exist_ok=True)
+    json.dump(previous_test_run_results, open(common.PREVIOUS_TEST_RUN_RESULTS_FILE, 'w'), indent=2)
+
   def get_sorted_tests(self):
-    """A list of this suite's tests, sorted with the @is_slow_test tests first.
+    """A list of this suite's tests, sorted with the longest running tests first.
 
-    Future work: measure and store the speed of tests each test sort more accurately.
+    Starting the longest tests first means that the workers run out of tests at
+    about the same time, rather than waiting for a slow test started at the end.
     """
     if self.failing_and_slow_first:
       # If we are running with --failing-and-slow-first, then the test list has been
       # pre-sorted based on previous test run results (see `runner.py`)
       return list(self)
 
-    def test_key(test):
-      testMethod = getattr(test, test._testMethodName)
-      is_slow = getattr(testMethod, 'is_slow', False)
-      return (is_slow, str(test))
-
-    return sorted(self, key=test_key, reverse=True)
+    durations = predict_test_durations(self)
+    return sorted(self, key=lambda test: (durations[str(test)], str(test)), reverse=True)
 
   def combine_results(self, result, buffered_results):
     errlog('')
@@ -238,6 +317,9 @@ class BufferedParallelTestResult:
   def __init__(self, lock, progress_counter, num_tests):
     self.buffered_result = None
     self.test_duration = 0
+    self.worker_id = None
+    self.run_start_time = 0
+    self.run_end_time = 0
     self.test_result = 'errored'
     self.test_name = ''
     self.lock = lock
@@ -294,6 +376,9 @@ class BufferedParallelTestResult:
     self.start_time = time.perf_counter()
 
   def stopTest(self, test):
+    # addDuration is only called by python 3.12 and above.
+    if not self.test_duration:
+      self.test_duration = self.calculateElapsed()
     # TODO(sbc): figure out a way to display this duration information again when
     # these results get passed back to the TextTestRunner/TextTestResult.
     self.buffered_result.duration = self.test_duration
@@ -93,6 +93,7 @@ misc_test_modes = [
   'sockets',
   'interactive',
   'benchmark',
+  'toolchain_benchmark',
   'wasm2ss',
   'posixtest',
   'posixtest_browser',
@@ -355,7 +356,7 @@ def load_test_suites(args, modules, options):
   unmatched_test_names = set(args)
   suites = []
 
-  total_tests = 0
+  module_tests = []
   for m in modules:
     names_in_module = []
     for name in list(unmatched_test_names):
@@ -367,7 +368,18 @@ def load_test_suites(args, modules, options):
         pass
     if names_in_module:
       loaded_tests = loader.loadTestsFromNames(sorted(names_in_module), m)
-      tests = flattened_tests(loaded_tests)
+      module_tests.append((m, flattened_tests(loaded_tests)))
+
+  if options.shard:
+    index, count = options.shard
+    all_tests = [t for _, tests in module_tests for t in tests]
+    shard = {str(t) for t in parallel_testsuite.shard_tests(all_tests, index, count, options.shard_durations)}
+    errlog(f'Running shard {index}/{count}: {len(shard)} of {len(all_tests)} tests')
+    module_tests = [(m, [t for t in tests if str(t) in shard]) for m, tests in module_tests]
+
+  total_tests = 0
+  for m, tests in module_tests:
+    if tests:
       suite = suite_for_module(m, tests, options)
       if options.failing_and_slow_first:
         tests = sorted(tests, key=cmp_to_key(create_test_run_sorter(options.failfast)))
@@ -457,6 +469,16 @@ def run_tests(options, suites):
   return num_failures
 
 
+def parse_shard(arg):
+  try:
+    index, count = (int(x) for x in arg.split('/'))
+  except ValueError:
+    raise argparse.ArgumentTypeError(f'expected I/N, got: {arg}') from None
+  if not 1 <= index <= count:
+    raise argparse.ArgumentTypeError(f'shard index must be between 1 and {count}: {arg}')
+  return index, count
+
+
 def parse_args():
   parser = argparse.ArgumentParser(prog='runner.py', description=__doc__)
   parser.add_argument('--save-dir', action='store_true',
@@ -490,6 +512,15 @@ def parse_args():
   parser.add_argument('--crossplatform-only', action='store_true')
   parser.add_argument('--repeat', type=int, default=1,
                       help='Repeat each test N times (default: 1).')
+  parser.add_argument('--shard', metavar='I/N', type=parse_shard,
+                      help='Run only the I-th of N parts of the selected tests. '
+                           'The parts are split by the durations of previous test runs, '
+                           'so that they take about the same time.  Sharded runs do not '
+                           'update the recorded durations.')
+  parser.add_argument('--shard-durations', metavar='FILE',
+                      help='Split --shard parts by the test durations in FILE instead of those of '
+                           'the last local run.  Pass the same file to every shard when they run '
+                           'on different machines.')
   parser.add_argument('--bell', action='store_true', help='Play a sound after the test suite finishes.')
   return parser.parse_args()
 
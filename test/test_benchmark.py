@@ -7,6 +7,7 @@ import math
 import os
 import re
 import shutil
+import statistics
 import sys
 import time
 import unittest
@@ -35,7 +36,25 @@ from tools import building, utils, shared
 # 5: 10 seconds
 DEFAULT_ARG = '4'
 
+# The minimum number of times to run each benchmark.  More runs are done, up to
+# EMTEST_BENCHMARK_MAX_REPS, until the 95% confidence interval of the mean is
+# within EMTEST_BENCHMARK_CI (as a fraction of the mean).
 TEST_REPS = 5
+MAX_REPS = int(os.getenv('EMTEST_BENCHMARK_MAX_REPS', '20'))
+CI_THRESHOLD = float(os.getenv('EMTEST_BENCHMARK_CI', '0.02'))
+
+# Runs of each benchmark that are done before the measured ones, and not
+# counted.
+WARMUP_REPS = int(os.getenv('EMTEST_BENCHMARK_WARMUP', '1'))
+
+# Where to write the measured times of all benchmarks, as JSON.
+BENCHMARK_OUTPUT = os.getenv('EMTEST_BENCHMARK_OUTPUT', 'benchmark_results.json')
+
+# A file written to BENCHMARK_OUTPUT by an earlier run.  When set, benchmarks
+# fail if they are significantly slower than in that run, by more than
+# EMTEST_BENCHMARK_THRESHOLD (as a fraction of the baseline mean).
+BENCHMARK_BASELINE = os.getenv('EMTEST_BENCHMARK_BASELINE')
+REGRESSION_THRESHOLD = float(os.getenv('EMTEST_BENCHMARK_THRESHOLD', '0.02'))
 
 # by default, run just core benchmarks
 CORE_BENCHMARKS = True
@@ -56,6 +75,65 @@ LLVM_FEATURE_FLAGS = ['-mnontrapping-fptoint']
 EMTEST_BENCHMARKERS = os.getenv('EMTEST_BENCHMARKERS', 'clang,v8,v8-lto,v8-ctors')
 
 
+# Two-sided 95% critical values of Student's t distribution, by degrees of
+# freedom.
+T_TABLE_95 = [
+  12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+  2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+  2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]
+
+
+def t_critical_95(df):
+  if df <= len(T_TABLE_95):
+    return T_TABLE_95[max(int(df), 1) - 1]
+  # A close approximation for larger degrees of freedom
+  return 1.96 + 2.4 / df
+
+
+def compute_stats(times):
+  mean = statistics.mean(times)
+  std = statistics.stdev(times) if len(times) > 1 else 0
+  # Half width of the 95% confidence interval of the mean
+  ci = t_critical_95(len(times) - 1) * std / math.sqrt(len(times)) if len(times) > 1 else None
+  return {
+    'mean': mean,
+    'median': statistics.median(times),
+    'std': std,
+    'min': min(times),
+    'max': max(times),
+    'ci95': ci,
+  }
+
+
+def is_precise_enough(times, reps, max_reps=MAX_REPS):
+  """Whether a benchmark that ran for `times` needs no more runs."""
+  if len(times) < reps:
+    return False
+  if len(times) >= max_reps:
+    return True
+  stats = compute_stats(times)
+  return stats['ci95'] is not None and stats['ci95'] <= CI_THRESHOLD * stats['mean']
+
+
+def is_significantly_slower(times, baseline_times, threshold):
+  """Whether `times` are slower than `baseline_times` by more than `threshold`
+  (as a fraction of the baseline mean), according to Welch's t-test."""
+  if len(times) < 2 or len(baseline_times) < 2:
+    return False
+  mean = statistics.mean(times)
+  base_mean = statistics.mean(baseline_times)
+  if mean <= base_mean * (1 + threshold):
+    return False
+  v1 = statistics.variance(times) / len(times)
+  v2 = statistics.variance(baseline_times) / len(baseline_times)
+  if v1 + v2 == 0:
+    return True
+  t = (mean - base_mean * (1 + threshold)) / math.sqrt(v1 + v2)
+  df = (v1 + v2) ** 2 / (v1 ** 2 / (len(times) - 1) + v2 ** 2 / (len(baseline_times) - 1))
+  return t > t_critical_95(df)
+
+
 class Benchmarker:
   # Whether to record statistics. Set by SizeBenchmarker.
   record_stats = False
@@ -71,22 +149,29 @@ class Benchmarker:
 
   def bench(self, args, output_parser=None, reps=TEST_REPS, expected_output=None):
     self.times = []
-    self.reps = reps
-    for _ in range(reps):
-      start = time.time()
-      output = self.run(args)
-      if expected_output is not None and expected_output not in output:
-        raise ValueError('Incorrect benchmark output:\n' + output)
-
-      if not output_parser or args == ['0']: # if arg is 0, we are not running code, and have no output to parse
-        curr = time.time() - start
-      else:
-        try:
-          curr = output_parser(output)
-        except Exception as e:
-          print(str(e))
-          print('Parsing benchmark results failed, output was: ' + output)
-      self.times.append(curr)
+    self.warmup_times = []
+    for _ in range(WARMUP_REPS if reps else 0):
+      self.warmup_times.append(self.measure(args, output_parser, expected_output))
+    # Repeat until the confidence interval is narrow enough, which needs more
+    # runs of noisier benchmarks.
+    while reps and not is_precise_enough(self.times, reps):
+      self.times.append(self.measure(args, output_parser, expected_output))
+    self.reps = len(self.times)
+
+  def measure(self, args, output_parser, expected_output):
+    start = time.perf_counter_ns()
+    output = self.run(args)
+    if expected_output is not None and expected_output not in output:
+      raise ValueError('Incorrect benchmark output:\n' + output)
+
+    if not output_parser or args == ['0']: # if arg is 0, we are not running code, and have no output to parse
+      return (time.perf_counter_ns() - start) / 1e9
+    try:
+      return output_parser(output)
+    except Exception as e:
+      print(str(e))
+      print('Parsing benchmark results failed, output was: ' + output)
+      raise
 
   def display(self, baseline=None):
     # speed
@@ -94,18 +179,11 @@ class Benchmarker:
     if self.times:
       if baseline == self:
         baseline = None
-      mean = sum(self.times) / len(self.times)
-      squared_times = [x * x for x in self.times]
-      mean_of_squared = sum(squared_times) / len(self.times)
-      std = math.sqrt(mean_of_squared - mean * mean)
-      sorted_times = sorted(self.times)
-      count = len(sorted_times)
-      if count % 2 == 0:
-        median = sum(sorted_times[count // 2 - 1:count // 2 + 1]) / 2
-      else:
-        median = sorted_times[count // 2]
+      stats = compute_stats(self.times)
+      mean = stats['mean']
+      std = stats['std']
 
-      print('   %10s: mean: %4.3f (+-%4.3f) secs  median: %4.3f  range: %4.3f-%4.3f  (noise: %4.3f%%)  (%d runs)' % (self.name, mean, std, median, min(self.times), max(self.times), 100 * std / mean, self.reps), end=' ')
+      print('   %10s: mean: %4.3f (+-%4.3f) secs  median: %4.3f  range: %4.3f-%4.3f  (noise: %4.3f%%)  (95%% CI: +-%4.3f%%)  (%d runs)' % (self.name, mean, std, stats['median'], stats['min'], stats['max'], 100 * std / mean, 100 * (stats['ci95'] or 0) / mean, self.reps), end=' ')
 
       if baseline:
         mean_baseline = sum(baseline.times) / len(baseline.times)
@@ -383,6 +461,8 @@ for name in EMTEST_BENCHMARKERS.split(','):
 class benchmark(common.RunnerCore):
   save_dir = True
   stats = [] # type: ignore
+  results = [] # type: ignore
+  baseline_results = {} # type: ignore
 
   @classmethod
   def setUpClass(cls):
@@ -403,6 +483,12 @@ class benchmark(common.RunnerCore):
       pass
     fingerprint.append('llvm: ' + config.LLVM_ROOT)
     print('Running Emscripten benchmarks... [ %s ]' % ' | '.join(fingerprint))
+    cls.fingerprint = fingerprint
+
+    if BENCHMARK_BASELINE:
+      baseline = json.loads(read_file(BENCHMARK_BASELINE))
+      for result in baseline['results']:
+        cls.baseline_results[(result['benchmark'], result['benchmarker'])] = result
 
   @classmethod
   def tearDownClass(cls):
@@ -414,6 +500,14 @@ class benchmark(common.RunnerCore):
         'results': cls.stats,
       }
       utils.write_file('stats.json', json.dumps(output, indent=2) + '\n')
+    if cls.results:
+      output = {
+        'version': 1,
+        'fingerprint': cls.fingerprint,
+        'results': cls.results,
+      }
+      utils.write_file(BENCHMARK_OUTPUT, json.dumps(output, indent=2) + '\n')
+      print('Wrote benchmark results to ' + os.path.abspath(BENCHMARK_OUTPUT))
 
   # avoid depending on argument reception from the commandline
   def hardcode_arguments(self, code):
@@ -451,6 +545,7 @@ class benchmark(common.RunnerCore):
 
     print()
     baseline = None
+    regressions = []
     for b in benchmarkers:
       if skip_benchmarkers and b.name in skip_benchmarkers:
         continue
@@ -464,6 +559,37 @@ class benchmark(common.RunnerCore):
       recorded_stats = b.display(baseline)
       if recorded_stats:
         self.add_stats(name, recorded_stats)
+      if b.times:
+        self.add_result(name, b)
+        regression = self.compare_to_baseline(name, b)
+        if regression:
+          regressions.append(regression)
+
+    if regressions:
+      self.fail('benchmark regressed:\n' + '\n'.join(regressions))
+
+  def add_result(self, name, benchmarker):
+    self.results.append({
+      'benchmark': name,
+      'benchmarker': benchmarker.name,
+      'units': 'seconds',
+      'times': benchmarker.times,
+      'warmup_times': benchmarker.warmup_times,
+      **compute_stats(benchmarker.times),
+    })
+
+  def compare_to_baseline(self, name, benchmarker):
+    baseline = self.baseline_results.get((name, benchmarker.name))
+    if not baseline:
+      return None
+    mean = statistics.mean(benchmarker.times)
+    change = 100 * (mean / baseline['mean'] - 1)
+    if is_significantly_slower(benchmarker.times, baseline['times'], REGRESSION_THRESHOLD):
+      msg = '%s (%s): %4.3f -> %4.3f secs (%+.1f%%)' % (name, benchmarker.name, baseline['mean'], mean, change)
+      print('   REGRESSION: ' + msg)
+      return msg
+    print('   %10s: %+.1f%% compared to baseline' % (benchmarker.name, change))
+    return None
 
   def add_stats(self, name, stats):
     self.stats.append({
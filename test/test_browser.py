@@ -4,6 +4,7 @@
 # found in the LICENSE file.
 
 import argparse
+import http.client
 import os
 import random
 import shlex
@@ -27,7 +28,7 @@ from common import HttpServerThread, requires_dev_dependency
 from tools import shared
 from tools import ports
 from tools.shared import EMCC, WINDOWS, FILE_PACKAGER, PIPE, DEBUG
-from tools.utils import delete_dir
+from tools.utils import delete_dir, write_binary
 
 
 def make_test_chunked_synchronous_xhr_server(support_byte_ranges, data, port):
@@ -589,6 +590,40 @@ window.close = () => {
     self.compile_btest('main.c', args + ['-sENVIRONMENT=web'], reporting=Reporting.JS_ONLY)
     self.run_browser('page.html', '/report_result?exit:0')
 
+  def test_preload_caching_shards(self):
+    self.clear_indexed_db()
+    self.set_setting('EXIT_RUNTIME')
+    ensure_dir('level1')
+    ensure_dir('level2')
+    create_file('level1/a.txt', 'level1')
+    create_file('level2/b.txt', 'level2')
+    create_file('main.c', r'''
+      #include <assert.h>
+      #include <stdio.h>
+      #include <string.h>
+      #include <emscripten.h>
+
+      int main(int argc, char** argv) {
+        char buf[7] = {0};
+        FILE *f = fopen("level2/b.txt", "r");
+        fread(buf, 1, 6, f);
+        fclose(f);
+        assert(strcmp("level2", buf) == 0);
+        return EM_ASM_INT(return Module['preloadResults']['page.data']['cachedShards']);
+      }
+    ''')
+
+    args = ['--use-preload-cache', '--preload-file', 'level1', '--preload-file', 'level2', '--preload-shard-by-directory', '-o', 'page.html']
+    self.compile_btest('main.c', args, reporting=Reporting.JS_ONLY)
+    self.assertEqual(len([f for f in os.listdir('.') if f.startswith('page.') and f.endswith('.data')]), 2)
+    self.run_browser('page.html', '/report_result?exit:0')
+    self.run_browser('page.html', '/report_result?exit:2')
+
+    # Only the shard that changed needs to be downloaded again.
+    create_file('level1/a.txt', 'level1 changed')
+    self.compile_btest('main.c', args, reporting=Reporting.JS_ONLY)
+    self.run_browser('page.html', '/report_result?exit:1')
+
   def test_preload_caching_indexeddb_name(self):
     self.set_setting('EXIT_RUNTIME')
     create_file('somefile.txt', 'load me right before running the code please')
@@ -5615,6 +5650,95 @@ class emrun(RunnerCore):
       proc.terminate()
       proc.wait()
 
+  def test_no_browser_http(self):
+    # Test the HTTP features of the emrun web server: byte ranges, ETag
+    # revalidation and serving precompressed siblings.
+    create_file('data.bin', 'abcdefghij' * 1000)
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    compressed = compressor.compress(b'abcdefghij' * 1000) + compressor.flush()
+    write_binary('data.bin.gz', compressed)
+    proc = subprocess.Popen([EMRUN, '--no-browser', '.', '--port=3334'], stdout=PIPE)
+    try:
+      for _ in range(100):
+        try:
+          conn = http.client.HTTPConnection('localhost', 3334)
+          conn.connect()
+          break
+        except OSError:
+          time.sleep(0.1)
+
+      # All requests below go over the same keep-alive connection.
+      def get(headers):
+        conn.request('GET', '/data.bin', headers=headers)
+        response = conn.getresponse()
+        return response, response.read()
+
+      response, body = get({'Accept-Encoding': 'identity'})
+      self.assertEqual(response.status, 200)
+      self.assertEqual(body, b'abcdefghij' * 1000)
+      self.assertEqual(response.getheader('Vary'), 'Accept-Encoding')
+      etag = response.getheader('ETag')
+
+      response, body = get({'If-None-Match': etag})
+      self.assertEqual(response.status, 304)
+      self.assertEqual(body, b'')
+
+      response, body = get({'Range': 'bytes=5-14'})
+      self.assertEqual(response.status, 206)
+      self.assertEqual(response.getheader('Content-Range'), 'bytes 5-14/10000')
+      self.assertEqual(body, b'fghijabcde')
+
+      response, body = get({'Range': 'bytes=-3'})
+      self.assertEqual(response.status, 206)
+      self.assertEqual(body, b'hij')
+
+      response, body = get({'Range': 'bytes=10000-'})
+      self.assertEqual(response.status, 416)
+
+      response, body = get({'Accept-Encoding': 'gzip, deflate'})
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+      self.assertEqual(body, compressed)
+      conn.close()
+    finally:
+      proc.terminate()
+      proc.wait()
+
+  def test_no_browser_message_order(self):
+    # Messages POSTed by the page may arrive out of order and batched several
+    # records to a request; emrun must print them in sequence order and exit
+    # with the code of the ^exit^ record.
+    proc = subprocess.Popen([EMRUN, '--no-browser', '.', '--port=3335'], stdout=PIPE, stderr=PIPE)
+    try:
+      for _ in range(100):
+        try:
+          conn = http.client.HTTPConnection('localhost', 3335)
+          conn.connect()
+          break
+        except OSError:
+          time.sleep(0.1)
+
+      def post(body):
+        conn.request('POST', '/stdio.html', body=body)
+        response = conn.getresponse()
+        self.assertEqual(response.read(), b'OK')
+
+      post('^pageload^')
+      post('^out^3^third\n^err^4^fourth\n^out^5^fifth')
+      post('^out^2^second')
+      post('^out^1^first')
+      post('^out^6^sixth')
+      conn.request('POST', '/stdio.html', body='^exit^3')
+      stdout, stderr = proc.communicate(timeout=30)
+      conn.close()
+    finally:
+      if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+    self.assertEqual(proc.returncode, 3)
+    self.assertContained('first\nsecond\nthird\nfifth\nsixth\n', stdout.decode())
+    self.assertContained('fourth\n', stderr.decode())
+
   def test_program_arg_separator(self):
     # Verify that trying to pass argument to the page without the `--` separator will
     # generate an actionable error message
@@ -12,6 +12,7 @@ import importlib
 import itertools
 import json
 import os
+import psutil
 import random
 import re
 import select
@@ -20,7 +21,9 @@ import shutil
 import subprocess
 import sys
 import tarfile
+import threading
 import time
+import unittest
 from pathlib import Path
 from subprocess import PIPE, STDOUT
 
@@ -47,6 +50,7 @@ import common
 import jsrun
 import clang_native
 import line_endings
+import parallel_testsuite
 from tools import webassembly
 from tools.settings import settings
 from tools.system_libs import DETERMINISTIC_PREFIX
@@ -2966,6 +2970,23 @@ More info: https://emscripten.org
     actual = read_file(name + '.js.jsopt.js')
     self.assertFileContents(test_file('js_optimizer', name + '-output.js'), actual)
 
+  @crossplatform
+  def test_js_optimizer_cache(self):
+    # Optimized functions are cached, so that a second run doesn't need to
+    # optimize any of them again, and produces the same output
+    shutil.copy(test_file('js_optimizer', 'wasm2js.js'), '.')
+    cmd = [PYTHON, path_from_root('tools/js_optimizer.py'), 'wasm2js.js', 'minifyNames']
+    with env_modify({'EM_CACHE': os.path.abspath('cache'), 'EMCC_DEBUG': '1'}):
+      err = self.run_process(cmd, stderr=PIPE).stderr
+      self.assertContained('function cache: hits: 0', err)
+      err = self.run_process(cmd, stderr=PIPE).stderr
+      self.assertContained('misses: 0', err)
+    self.assertFileContents(test_file('js_optimizer', 'wasm2js-output.js'), read_file('wasm2js.js.jsopt.js'))
+
+    with env_modify({'EM_CACHE': os.path.abspath('cache'), 'EMCC_DEBUG': '1', 'EMCC_JSOPT_CACHE': '0'}):
+      err = self.run_process(cmd, stderr=PIPE).stderr
+      self.assertNotContained('function cache:', err)
+
   def test_m_mm(self):
     create_file('foo.c', '#include <emscripten.h>')
     for opt in ('M', 'MM'):
@@ -3656,6 +3677,22 @@ More info: https://emscripten.org
                      self.get_cflags())
     self.assertFileContents(test_file('other/embind_tsgen.d.ts'), read_file('embind_tsgen.d.ts'))
 
+  def test_embind_tsgen_aot_combined(self):
+    # A link that uses both --emit-tsd and EMBIND_AOT generates both from a
+    # single run of the embind generator, whose output is cached for relinks.
+    args = [EMXX, test_file('other/embind_tsgen.cpp'), '-lembind', '-sEMBIND_AOT',
+            '--emit-tsd', 'embind_tsgen.d.ts'] + self.get_cflags()
+    self.run_process(args)
+    self.assertFileContents(test_file('other/embind_tsgen.d.ts'), read_file('embind_tsgen.d.ts'))
+    outputs = [json.loads(read_file(f)) for f in glob.glob(os.path.join(cache.get_path('embind_gen'), '*.json'))]
+    self.assertTrue(any('tsd' in out and 'invokers' in out for out in outputs))
+    js = read_file('a.out.js')
+
+    delete_file('embind_tsgen.d.ts')
+    self.run_process(args)
+    self.assertFileContents(test_file('other/embind_tsgen.d.ts'), read_file('embind_tsgen.d.ts'))
+    self.assertIdentical(js, read_file('a.out.js'))
+
   def test_embind_jsgen_method_pointer_stability(self):
     self.cflags += ['-lembind', '-sEMBIND_AOT']
     # Test that when method pointers are allocated at different addresses that
@@ -3851,6 +3888,189 @@ More info: https://emscripten.org
     ''')
     self.do_runf('src.c', cflags=['--pre-js=immutable.js', '-sFORCE_FILESYSTEM'])
 
+  @parameterized({
+    '': ('--compress', 'deflate'),
+    'gzip': ('--compress=gzip', 'gzip'),
+  })
+  def test_file_packager_compress(self, flag, codec):
+    create_file('small.txt', 'small')
+    create_file('big.txt', 'hello world\n' * 1000)
+    with open('random.dat', 'wb') as f:
+      f.write(os.urandom(4096))
+
+    self.run_process([FILE_PACKAGER, 'test.data', '--quiet', '--preload', 'small.txt', 'big.txt', 'random.dat', '--js-output=data.js', '--separate-metadata', flag])
+    metadata = json.loads(read_file('data.js.metadata'))
+    files = {f['filename']: f for f in metadata['files']}
+    # Only files that are large enough and compress well are compressed.
+    self.assertEqual(files['/big.txt']['codec'], codec)
+    self.assertLess(files['/big.txt']['end'] - files['/big.txt']['start'], 1000)
+    self.assertNotIn('codec', files['/small.txt'])
+    self.assertNotIn('codec', files['/random.dat'])
+
+    create_file('src.c', r'''
+    #include <assert.h>
+    #include <stdio.h>
+    #include <sys/stat.h>
+
+    int main() {
+      struct stat buf;
+      assert(stat("big.txt", &buf) == 0);
+      assert(buf.st_size == 12000);
+      assert(stat("random.dat", &buf) == 0);
+      assert(buf.st_size == 4096);
+      FILE* f = fopen("small.txt", "r");
+      char data[16] = {0};
+      fread(data, 1, sizeof(data) - 1, f);
+      fclose(f);
+      printf("%s\n", data);
+      return 0;
+    }
+    ''')
+    self.do_runf('src.c', 'small\n', cflags=['--pre-js=data.js', '-sFORCE_FILESYSTEM'])
+
+  def test_file_packager_compress_corrupt(self):
+    # A failure to decompress the data rejects the promise returned by the
+    # loader, rather than leaving it pending (with an unhandled rejection).
+    create_file('big.txt', 'hello world\n' * 1000)
+    self.run_process([FILE_PACKAGER, 'test.data', '--quiet', '--preload', 'big.txt', '--js-output=dataFileLoader.js', '--export-es6', '--compress'])
+    with open('test.data', 'r+b') as f:
+      f.write(b'\0' * 16)
+
+    self.run_process([EMCC, test_file('hello_world.c'), '-sFORCE_FILESYSTEM', '-sMODULARIZE', '-sEXPORT_ES6', '-o', 'moduleFile.js'])
+    create_file('run.js', '''
+    import loadDataFile from './dataFileLoader.js'
+    import {default as loadModule} from './moduleFile.js'
+
+    var module = await loadModule();
+    try {
+      await loadDataFile(module);
+      console.log('loaded');
+    } catch (e) {
+      console.log('rejected');
+    }
+    ''')
+    self.assertContained('rejected', self.run_js('run.js'))
+
+  @is_slow_test
+  def test_file_packager_large_tree(self):
+    # The directories are created from the metadata, so the size of the
+    # generated loader does not depend on the number of directories.
+    def package(num_dirs):
+      for i in range(num_dirs):
+        d = os.path.join('tree', str(i % 10), str(i))
+        ensure_dir(d)
+        create_file(os.path.join(d, 'file.txt'), str(i))
+      self.run_process([FILE_PACKAGER, 'test.data', '--quiet', '--preload', 'tree', '--js-output=data.js', '--separate-metadata'])
+      metadata = json.loads(read_file('data.js.metadata'))
+      self.assertEqual(len(metadata['directories']), num_dirs + 11)
+      self.assertEqual(metadata['directories'][0], [-1, 'tree'])
+      js = read_file('data.js')
+      self.assertEqual(js.count('FS_createPath'), 1)
+      return len(js)
+
+    small = package(10)
+    shutil.rmtree('tree')
+    self.assertEqual(package(1000), small)
+
+  def test_file_packager_compress_lz4(self):
+    create_file('data.txt', 'data')
+    err = self.expect_fail([FILE_PACKAGER, 'test.data', '--preload', 'data.txt', '--compress', '--lz4'])
+    self.assertContained('error: --compress cannot be used together with --lz4', err)
+
+  def test_file_packager_lazy(self):
+    ensure_dir('level1')
+    ensure_dir('level2')
+    create_file('level1/small.txt', 'small1')
+    create_file('level1/small2.txt', 'small2')
+    create_file('level2/big.txt', 'b' * (2 * 1024 * 1024))
+    create_file('main.c', r'''
+    #include <assert.h>
+    #include <stdio.h>
+    #include <sys/stat.h>
+
+    int main() {
+      struct stat buf;
+      // The size of a lazy file is known before it is loaded.
+      assert(stat("level2/big.txt", &buf) == 0);
+      assert(buf.st_size == 2 * 1024 * 1024);
+      FILE* f = fopen("level1/small2.txt", "r");
+      char data[16] = {0};
+      fread(data, 1, sizeof(data) - 1, f);
+      fclose(f);
+      printf("%s\n", data);
+      f = fopen("level2/big.txt", "r");
+      fseek(f, -1, SEEK_END);
+      printf("%c\n", fgetc(f));
+      fclose(f);
+      return 0;
+    }
+    ''')
+    self.do_runf('main.c', 'small2\nb\n', cflags=['--preload-file', 'level1', '--preload-file', 'level2', '--lazy-preload-files'])
+
+    self.run_process([FILE_PACKAGER, 'test.data', '--quiet', '--preload', 'level1', 'level2', '--js-output=data.js', '--separate-metadata', '--lazy'])
+    metadata = json.loads(read_file('data.js.metadata'))
+    # The small files are fetched together, and the big one separately.
+    self.assertEqual(metadata['chunks'], [[0, 12], [12, 12 + 2 * 1024 * 1024]])
+    self.assertEqual([f['chunk'] for f in metadata['files']], [0, 0, 1])
+
+    err = self.expect_fail([FILE_PACKAGER, 'test.data', '--preload', 'level1', '--lazy', '--use-preload-cache'])
+    self.assertContained('error: --lazy cannot be used together with --use-preload-cache', err)
+
+  def test_file_packager_shards(self):
+    ensure_dir('level1')
+    ensure_dir('level2')
+    create_file('level1/a.txt', 'a' * 100)
+    create_file('level1/b.txt', 'b' * 100)
+    create_file('level2/c.txt', 'c' * 100)
+
+    def get_shards():
+      self.run_process([FILE_PACKAGER, 'test.data', '--quiet', '--preload', 'level1', 'level2', '--js-output=data.js', '--separate-metadata', '--shard-size=150', '--shard-by-directory'])
+      metadata = json.loads(read_file('data.js.metadata'))
+      for shard in metadata['shards']:
+        self.assertExists(shard['name'])
+        self.assertEqual(os.path.getsize(shard['name']), shard['end'] - shard['start'])
+      return [shard['name'] for shard in metadata['shards']]
+
+    shards = get_shards()
+    self.assertEqual(len(shards), 3)
+    self.assertNotExists('test.data')
+
+    # Modifying a file only changes the name of the shard that contains it.
+    create_file('level1/b.txt', 'B' * 100)
+    new_shards = get_shards()
+    self.assertEqual(new_shards[0], shards[0])
+    self.assertNotEqual(new_shards[1], shards[1])
+    self.assertEqual(new_shards[2], shards[2])
+    # The shard that is no longer used is removed
+    self.assertNotExists(shards[1])
+
+    create_file('main.c', r'''
+    #include <stdio.h>
+
+    int main() {
+      char data[4] = {0};
+      FILE* f = fopen("level1/b.txt", "r");
+      fread(data, 1, 3, f);
+      fclose(f);
+      printf("%s\n", data);
+      f = fopen("level2/c.txt", "r");
+      fread(data, 1, 3, f);
+      fclose(f);
+      printf("%s\n", data);
+      return 0;
+    }
+    ''')
+    self.do_runf('main.c', 'BBB\nccc\n', cflags=['--pre-js=data.js', '-sFORCE_FILESYSTEM'])
+
+  def test_file_packager_shards_compress(self):
+    # Shards are split by the compressed size of the files
+    ensure_dir('files')
+    for i in range(4):
+      create_file(f'files/{i}.txt', str(i) * 2000)
+    self.run_process([FILE_PACKAGER, 'test.data', '--quiet', '--preload', 'files', '--js-output=data.js', '--separate-metadata', '--shard-size=2000', '--compress'])
+    metadata = json.loads(read_file('data.js.metadata'))
+    self.assertEqual(len(metadata['shards']), 1)
+
   def test_file_packager_unicode(self):
     unicode_name = 'unicode…☃'
     try:
@@ -5519,6 +5739,25 @@ int main() {
       self.assertContained(UNMINIFIED_HEAP8, js)
       self.assertContained(UNMINIFIED_MIDDLE, js)
 
+  @parameterized({
+    '': (['--closure=1', '-sWASM=2'], 'hello.js', ['hello.js', 'hello.wasm', 'hello.wasm.js', 'hello.symbols']),
+    # The ESM wrapper rewrites the wasm once the JS is done
+    'esm': (['-sWASM_ESM_INTEGRATION', '-Wno-experimental'], 'hello.mjs', ['hello.mjs', 'hello.support.mjs', 'hello.wasm', 'hello.symbols']),
+  })
+  def test_post_link_tasks_determinism(self, args, output, filenames):
+    # The post-link steps on the wasm (e.g. the symbol map and the WASM=2
+    # fallback) can run concurrently with the steps on the JS, which must not
+    # affect the output.
+    args = [EMCC, test_file('hello_world.c'), '-O2', '--emit-symbol-map'] + args
+    ensure_dir('serial')
+    ensure_dir('parallel')
+    with env_modify({'EMCC_CORES': '1'}):
+      self.run_process(args + ['-o', 'serial/' + output])
+    with env_modify({'EMCC_CORES': '4'}):
+      self.run_process(args + ['-o', 'parallel/' + output])
+    for filename in filenames:
+      self.assertEqual(read_binary(os.path.join('serial', filename)), read_binary(os.path.join('parallel', filename)), filename)
+
   @parameterized({
     '': [[]],
     # bigint support is interesting to test here because it changes which
@@ -9394,6 +9633,14 @@ int main() {
     self.assertExists('hello_world.js')
     self.assertFileContents('hello_world.wasm', 'not wasm')
 
+  def test_single_file_shell_no_script(self):
+    # The program is streamed into the HTML in place of {{{ SCRIPT }}}, so a
+    # shell without it is an error, rather than an HTML file without the program.
+    create_file('shell.html', '<html><body></body></html>\n')
+    err = self.expect_fail([EMCC, test_file('hello_world.c'), '-sSINGLE_FILE', '--shell-file', 'shell.html', '-o', 'out.html'])
+    self.assertContained('{{{ SCRIPT }}}', err)
+    self.assertNotExists('out.html')
+
   def test_single_file_disables_source_map(self):
     cmd = [EMCC, test_file('hello_world.c'), '-sSINGLE_FILE', '-gsource-map']
     stderr = self.run_process(cmd, stderr=PIPE).stderr
@@ -9700,9 +9947,60 @@ end
     self.run_process([EMCC, test_file('hello_world.c')])
     self.assertEqual('hello, world!', self.run_js('a.out.js').strip())
 
+    self.run_process([emprofile, '--trace-out=trace.json', '--no-clear'])
+    events = json.loads(read_file('trace.json'))['traceEvents']
+    self.assertIn(('B', 'main'), [(e['ph'], e['name']) for e in events])
+    self.assertIn('subprocess', [e.get('cat') for e in events])
+
+    out = self.run_process([emprofile, '--report', '--report-json=report.json', '--no-clear'], stdout=PIPE).stdout
+    self.assertContained('Time per profile block', out)
+    self.assertContained('Critical path', out)
+    report = json.loads(read_file('report.json'))
+    self.assertIn('main', [b['name'] for b in report['blocks']])
+    self.assertTrue(report['critical_path'])
+
     self.run_process([emprofile, '--graph'])
     self.assertTrue(glob.glob('toolchain_profiler.results*.html'))
 
+  def test_toolchain_profiler_threads(self):
+    # Blocks that are profiled concurrently on different threads (e.g. the
+    # tasks of a TaskGraph) are recorded on their own threads, rather than as
+    # wrongly nested blocks on the main one.
+    create_file('tasks.py', f'''
+import sys
+import threading
+sys.path.insert(0, {path_from_root()!r})
+from tools.task_graph import TaskGraph
+from tools.toolchain_profiler import ToolchainProfiler
+
+# Both tasks wait for each other, so that they overlap
+barrier = threading.Barrier(2)
+tasks = TaskGraph(2)
+with ToolchainProfiler.profile_block('main'):
+  tasks.add('task_a', barrier.wait)
+  tasks.add('task_b', barrier.wait)
+  tasks.wait()
+''')
+    with env_modify({'EMPROFILE': '1', 'TMPDIR': self.get_dir(), 'TEMP': self.get_dir(), 'TMP': self.get_dir()}):
+      self.run_process([PYTHON, 'tasks.py'])
+      self.run_process([emprofile, '--trace-out=trace.json', '--report-json=report.json'])
+
+    events = [e for e in json.loads(read_file('trace.json'))['traceEvents'] if e.get('cat') == 'block']
+    tids = {e['name']: e['tid'] for e in events}
+    self.assertEqual(len({tids['main'], tids['task_a'], tids['task_b']}), 3)
+    # The begin and end events on each thread are properly nested
+    stacks = {}
+    for e in events:
+      stack = stacks.setdefault(e['tid'], [])
+      if e['ph'] == 'B':
+        stack.append(e['name'])
+      else:
+        self.assertEqual(stack.pop(), e['name'])
+    self.assertEqual(list(stacks.values()), [[], [], []])
+
+    blocks = {b['name']: b['count'] for b in json.loads(read_file('report.json'))['blocks']}
+    self.assertEqual(blocks, {'main': 1, 'task_a': 1, 'task_b': 1})
+
   @with_env_modify({'EMPROFILE': '2'})
   def test_toolchain_profiler_stderr(self):
     stderr = self.run_process([EMCC, test_file('hello_world.c')], stderr=PIPE).stderr
@@ -12869,6 +13167,36 @@ exec "$@"
       self.run_process([PYTHON, path_from_root('tools/gen_struct_info.py'), '--wasm64', '-o', 'out.json'])
       self.assertFileContents(path_from_root('src/struct_info_generated_wasm64.json'), read_file('out.json'))
 
+  @crossplatform
+  def test_gen_struct_info_object(self):
+    # Reading the values from an object file should give the same results as
+    # running a program that prints them.
+    self.run_process([PYTHON, path_from_root('tools/gen_struct_info.py'), '--object', '--no-cache', '-o', 'out.json'])
+    self.assertFileContents(path_from_root('src/struct_info_generated.json'), read_file('out.json'))
+    self.run_process([PYTHON, path_from_root('tools/gen_struct_info.py'), '--object', '--no-cache', '--wasm64', '-o', 'out.json'])
+    self.assertFileContents(path_from_root('src/struct_info_generated_wasm64.json'), read_file('out.json'))
+
+  def test_gen_struct_info_cache(self):
+    shutil.copy(test_file('other/test_extra_struct_info.h'), '.')
+    cmd = [PYTHON, path_from_root('tools/gen_struct_info.py'), test_file('other/test_extra_struct_info.json'), '-o', 'out.json', '-I.']
+    self.run_process(cmd)
+    self.assertEqual(json.loads(read_file('out.json'))['defines']['AF_INET'], 42)
+    err = self.run_process(cmd, stderr=PIPE).stderr
+    self.assertContained('Using cached results', err)
+    self.assertEqual(json.loads(read_file('out.json'))['defines']['AF_INET'], 42)
+
+    # Changing an included header invalidates the cached results
+    create_file('test_extra_struct_info.h', '#define AF_INET 43\n')
+    self.run_process(cmd)
+    self.assertEqual(json.loads(read_file('out.json'))['defines']['AF_INET'], 43)
+
+    # The same relative include path in another directory finds another header
+    ensure_dir('other')
+    create_file('other/test_extra_struct_info.h', '#define AF_INET 44\n')
+    err = self.run_process(cmd, stderr=PIPE, cwd='other').stderr
+    self.assertNotContained('Using cached results', err)
+    self.assertEqual(json.loads(read_file('other/out.json'))['defines']['AF_INET'], 44)
+
   @crossplatform
   def test_gen_sig_info(self):
     # This tests is fragile and will need updating any time a JS library
@@ -14863,6 +15191,22 @@ w:0,t:0x[0-9a-fA-F]+: formatted: 42
     self.assertExists('glue.js')
     self.emcc('glue.cpp', ['-c', '-Wall', '-Werror'])
 
+  def test_webidl_unchanged_output(self):
+    create_file('test.idl', 'interface Foo { void Foo(); };')
+    self.run_process([WEBIDL_BINDER, 'test.idl', 'glue'])
+    # Outputs that are unchanged are not written again
+    os.utime('glue.cpp', (0, 0))
+    os.utime('glue.js', (0, 0))
+    self.run_process([WEBIDL_BINDER, 'test.idl', 'glue'])
+    self.assertEqual(os.path.getmtime('glue.cpp'), 0)
+    self.assertEqual(os.path.getmtime('glue.js'), 0)
+    # Outputs that changed are
+    create_file('test.idl', 'interface Foo { void Foo(); void bar(); };')
+    self.run_process([WEBIDL_BINDER, 'test.idl', 'glue'])
+    self.assertNotEqual(os.path.getmtime('glue.cpp'), 0)
+    self.assertNotEqual(os.path.getmtime('glue.js'), 0)
+    self.assertContained('emscripten_bind_Foo_bar_0', read_file('glue.cpp'))
+
   def test_noExitRuntime(self):
     onexit_called = 'onExit called'
     create_file('pre.js', f'Module.onExit = () => console.log("${onexit_called}");\n')
@@ -15701,3 +16045,94 @@ addToLibrary({
     self.assertIn('main.cpp', out)
     self.assertIn('foo.cpp', out)
     self.assertIn('/emsdk/emscripten/system/lib/libc/musl/src/string/strcmp.c', out)
+
+  def test_shard_tests(self):
+    # Every test must run in exactly one shard, and the shards must be split by
+    # the given durations, not by the results of the last local run.
+    class Tests(unittest.TestCase):
+      pass
+
+    for i in range(30):
+      setattr(Tests, f'test_{i}', lambda _: None)
+    tests = [Tests(f'test_{i}') for i in range(30)]
+    durations = {f'test_{i}': {'duration': (i * 7) % 11 + 1} for i in range(20)}
+    create_file('durations.json', json.dumps(durations))
+
+    for count in (1, 3, 4, 30, 40):
+      shards = [parallel_testsuite.shard_tests(tests, i, count, 'durations.json') for i in range(1, count + 1)]
+      names = [str(t) for shard in shards for t in shard]
+      self.assertEqual(sorted(names), sorted(str(t) for t in tests))
+      self.assertEqual(len(names), len(set(names)))
+      # The shards do not depend on the order of the tests
+      self.assertEqual(shards[0], parallel_testsuite.shard_tests(tests[::-1], 1, count, 'durations.json')[::-1])
+
+    predicted = parallel_testsuite.predict_test_durations(tests, 'durations.json')
+    totals = [sum(predicted[str(t)] for t in parallel_testsuite.shard_tests(tests, i, 3, 'durations.json')) for i in (1, 2, 3)]
+    self.assertLessEqual(max(totals) - min(totals), max(predicted.values()))
+
+  def test_library_cache(self):
+    # Test the on-disk cache of the third party libraries that are built by
+    # the tests (see RunnerCore.get_library).  Each call below stands for a
+    # different test runner process, each with its own in-memory cache.
+    cache_dir = os.path.abspath('library_cache/lib')
+    builds = []
+
+    def get_library(fingerprint, contents, build_started=None, finish_build=None):
+      library_cache = {}
+
+      def build():
+        if build_started:
+          build_started.set()
+          finish_build.wait()
+        builds.append(contents)
+        library_cache['lib'] = [('libfoo.a', contents)]
+        return ['libfoo.a']
+
+      built = common.load_or_build_library(cache_dir, fingerprint, library_cache, 'lib', build) is not None
+      return built, library_cache['lib']
+
+    self.assertEqual(get_library('a', b'1'), (True, [('libfoo.a', b'1')]))
+    # The library that was built by one process is loaded by the others
+    self.assertEqual(get_library('a', b'2'), (False, [('libfoo.a', b'1')]))
+    self.assertEqual(builds, [b'1'])
+
+    # When the fingerprint changes the library is built again
+    self.assertEqual(get_library('b', b'3'), (True, [('libfoo.a', b'3')]))
+    self.assertEqual(read_binary(os.path.join(cache_dir, 'libfoo.a')), b'3')
+
+    # While one process is building the library, the others wait for it to be
+    # done and then load it, rather than building it too.
+    build_started = threading.Event()
+    finish_build = threading.Event()
+    results = {}
+    builder = threading.Thread(target=lambda: results.update(builder=get_library('c', b'4', build_started, finish_build)))
+    waiter = threading.Thread(target=lambda: results.update(waiter=get_library('c', b'5')))
+    builder.start()
+    build_started.wait()
+    waiter.start()
+    waiter.join(timeout=1)
+    self.assertTrue(waiter.is_alive())
+    finish_build.set()
+    builder.join()
+    waiter.join()
+    self.assertEqual(results['builder'], (True, [('libfoo.a', b'4')]))
+    self.assertEqual(results['waiter'], (False, [('libfoo.a', b'4')]))
+    self.assertEqual(builds, [b'1', b'3', b'4'])
+
+  def test_run_multiple_processes_failure(self):
+    # When one of the processes fails, the others are stopped before their job
+    # slots are released, so that the processes that share the slots never
+    # run more than there are slots.
+    create_file('slow.py', 'import os, time\nopen("slow.pid", "w").write(str(os.getpid()))\ntime.sleep(60)\n')
+    create_file('fail.py', 'import os, sys, time\nwhile not os.path.exists("slow.pid"):\n  time.sleep(0.1)\nsys.exit(1)\n')
+    slots = threading.BoundedSemaphore(4)
+    old_slots = shared.JOB_SLOTS
+    shared.JOB_SLOTS = slots
+    try:
+      with env_modify({'EMCC_CORES': '2'}), self.assertRaises(SystemExit):
+        shared.run_multiple_processes([[PYTHON, 'slow.py'], [PYTHON, 'fail.py']], cwd=self.get_dir())
+    finally:
+      shared.JOB_SLOTS = old_slots
+    self.assertFalse(psutil.pid_exists(int(read_file('slow.pid'))))
+    for _ in range(4):
+      self.assertTrue(slots.acquire(blocking=False))
@@ -431,7 +431,67 @@ fi
       self.assertExists(cache.cachedir)
       output = self.do([EMCC])
       self.assertIn('clearing cache', output)
-      self.assertCacheEmpty()
+      # Only the installed system headers are kept
+      self.assertEqual(sorted(set(os.listdir(cache.cachedir)) - {'cache.lock'}), ['sysroot'])
+      self.assertExists(cache.get_include_dir('stdio.h'))
+      self.assertNotExists(cache.get_lib_dir(absolute=True))
+
+  def test_cache_clearing_auto_headers(self):
+    # The system headers are not rewritten when they are installed again after
+    # the cache is cleared, unless they changed
+    restore_and_set_up()
+    self.ensure_cache()
+    stdio_h = cache.get_include_dir('stdio.h')
+    stdlib_h = cache.get_include_dir('stdlib.h')
+    mtime = os.stat(stdio_h).st_mtime_ns
+    utils.write_file(stdlib_h, 'modified')
+    utils.write_file(SANITY_FILE, 'outdated')
+    output = self.do([EMCC, '-O2', test_file('hello_world.c')])
+    self.assertIn('clearing cache', output)
+    self.assertExists(cache.get_lib_dir(absolute=True))
+    self.assertEqual(os.stat(stdio_h).st_mtime_ns, mtime)
+    self.assertNotEqual(utils.read_file(stdlib_h), 'modified')
+
+  def test_cache_gc(self):
+    restore_and_set_up()
+    self.clear_cache()
+    self.ensure_cache()
+    libname = cache.get_lib_name('libemmalloc.a')
+    self.do([EMBUILDER, 'build', 'libemmalloc'])
+    # Make the library the least recently used entry
+    os.utime(os.path.join(cache.cachedir, libname), (0, 0))
+    output = self.do([EMCC, '--cache-gc-dry-run=0'])
+    self.assertContained('would evict cache entry: ' + libname, output)
+    self.assertExists(os.path.join(cache.cachedir, libname))
+    output = self.do([EMCC, '--cache-gc=0'])
+    self.assertContained('evicting cache entry: ' + libname, output)
+    self.assertNotExists(os.path.join(cache.cachedir, libname))
+    # Headers and the sanity file are kept, and evicted libraries are rebuilt
+    # on demand.
+    self.assertExists(os.path.join(cache.cachedir, 'sanity.txt'))
+    self.assertExists(os.path.join(cache.cachedir, 'sysroot', 'include'))
+    output = self.do([EMCC, test_file('hello_world.c'), '-sMALLOC=emmalloc'])
+    self.assertContained('generating system library: ' + libname, output)
+    self.assertContained('hello, world!', self.run_js('a.out.js'))
+
+  def test_partial_libs(self):
+    restore_and_set_up()
+    self.clear_cache()
+    self.ensure_cache()
+    # The non-debug variation of libc was built above, so only the objects of
+    # the debug variation that are needed are compiled.
+    libname = cache.get_lib_name('libc-debug.a')
+    with env_modify({'EMCC_PARTIAL_LIBS': '1'}):
+      output = self.do([EMCC, '-O0', test_file('hello_world.c')])
+      self.assertContained('partially building system library: libc-debug.a', output)
+      self.assertNotContained('generating system library: ' + libname, output)
+      self.assertContained('hello, world!', self.run_js('a.out.js'))
+      self.assertNotExists(os.path.join(cache.cachedir, libname))
+      self.assertExists(cache.get_lib_name('libc-debug.partial.a', absolute=True))
+      # Nothing more needs to be compiled the second time
+      output = self.do([EMCC, '-O0', test_file('hello_world.c')])
+      self.assertNotContained('partially building system library: libc-debug.a', output)
+      self.assertContained('hello, world!', self.run_js('a.out.js'))
 
   # FROZEN_CACHE prevents cache clears, and prevents building
   def test_FROZEN_CACHE(self):
@@ -447,6 +507,26 @@ fi
     output = self.do([EMBUILDER, 'build', 'libemmalloc'])
     self.assertContained('FROZEN_CACHE is set, but cache file is missing', output)
 
+  def test_readonly_cache(self):
+    restore_and_set_up()
+    self.clear_cache()
+    self.ensure_cache()
+    readonly_cache = cache.cachedir
+    writable_cache = self.in_dir('writable_cache')
+    with env_modify({'EM_CACHE': writable_cache, 'EM_READONLY_CACHES': str(readonly_cache)}):
+      # Everything that is already in the read-only layer is used from there
+      output = self.do([EMCC, '-O2', test_file('hello_world.c')])
+      self.assertNotContained('generating system', output)
+      self.assertContained('hello, world!', self.run_js('a.out.js'))
+      self.assertNotExists(os.path.join(writable_cache, 'sysroot_install.stamp'))
+      # Missing libraries are built in the writable layer
+      libname = cache.get_lib_name('libemmalloc.a')
+      output = self.do([EMCC, '-O2', test_file('hello_world.c'), '-sMALLOC=emmalloc'])
+      self.assertContained('generating system library: ' + libname, output)
+      self.assertContained('hello, world!', self.run_js('a.out.js'))
+      self.assertExists(os.path.join(writable_cache, libname))
+      self.assertNotExists(os.path.join(readonly_cache, libname))
+
   # Test that if multiple processes attempt to access or build stuff to the
   # cache on demand, that exactly one of the processes will, and the other
   # processes will block to wait until that process finishes.
@@ -596,6 +676,40 @@ fi
       first_use()
       second_use()
 
+  def test_ports_mirror(self):
+    restore_and_set_up()
+    PORTS_DIR = ports.Ports.get_dir()
+    self.do([EMCC, '--clear-ports'])
+    self.do([EMBUILDER, 'build', 'zlib'])
+    archive = os.path.join(PORTS_DIR, 'zlib.tar.gz')
+    self.assertExists(archive)
+
+    # Populate a mirror with the archive and check that it is used in
+    # preference to the upstream URL.
+    version = ports.get_port_by_name('zlib').VERSION
+    mirror = os.path.abspath('mirror')
+    ensure_dir(os.path.join(mirror, 'zlib'))
+    shutil.copy(archive, os.path.join(mirror, 'zlib', f'v{version}.tar.gz'))
+    self.do([EMCC, '--clear-ports'])
+    with env_modify({'EM_PORTS_MIRROR': mirror}):
+      output = self.do([EMBUILDER, 'build', 'zlib', '--force'])
+    self.assertContained('retrieving port: zlib from mirror file://', output)
+
+    # A mirror that lacks the archive falls back to the upstream URL
+    self.do([EMCC, '--clear-ports'])
+    with env_modify({'EM_PORTS_MIRROR': self.in_dir('empty_mirror')}):
+      output = self.do([EMBUILDER, 'build', 'zlib', '--force'])
+    self.assertContained('unable to retrieve port zlib from mirror', output)
+    self.assertContained('retrieving port: zlib from https://', output)
+
+    # So does a mirror with a corrupt archive
+    utils.write_file(os.path.join(mirror, 'zlib', f'v{version}.tar.gz'), 'corrupt')
+    self.do([EMCC, '--clear-ports'])
+    with env_modify({'EM_PORTS_MIRROR': mirror}):
+      output = self.do([EMBUILDER, 'build', 'zlib', '--force'])
+    self.assertContained('unable to retrieve port zlib from mirror (Unexpected hash:', output)
+    self.assertContained('retrieving port: zlib from https://', output)
+
   def test_js_engine_path(self):
     # Test that running JS commands works for node, d8, and jsc and is not path dependent
     restore_and_set_up()
@@ -730,6 +844,19 @@ fi
     # Unless --force is specified
     self.assertContained('generating system library', self.do([EMBUILDER, 'build', 'libemmalloc', '--force']))
 
+  def test_embuilder_force_sysroot(self):
+    restore_and_set_up()
+    self.do([EMBUILDER, 'build', 'sysroot'])
+    stdio_h = cache.get_include_dir('stdio.h')
+    mtime = os.stat(stdio_h).st_mtime_ns
+    # Reinstalling the headers only touches the files that changed
+    self.assertContained('generating system headers', self.do([EMBUILDER, 'build', 'sysroot', '--force']))
+    self.assertEqual(os.stat(stdio_h).st_mtime_ns, mtime)
+    # Installed files that were modified are restored
+    utils.write_file(stdio_h, 'modified')
+    self.do([EMBUILDER, 'build', 'sysroot', '--force'])
+    self.assertNotEqual(utils.read_file(stdio_h), 'modified')
+
   def test_embuilder_force_port(self):
     restore_and_set_up()
     self.do([EMBUILDER, 'build', 'zlib'])
@@ -765,6 +892,40 @@ fi
     self.run_process([EMBUILDER, 'build', 'libwebgpu*'])
     self.assertGreater(len(glob.glob(glob_match)), 3)
 
+  def test_embuilder_parallel(self):
+    restore_and_set_up()
+    self.clear_cache()
+    # libpng depends on zlib, which is not requested explicitly but must still
+    # be built before it.
+    output = self.do([EMBUILDER, 'build', 'libemmalloc', 'libstubs', 'crt1', 'libpng', '-j4'])
+    self.assertLess(output.index('libz.a... '), output.index('libpng.a... '))
+    lib_dir = os.path.join(config.CACHE, 'sysroot', 'lib', 'wasm32-emscripten')
+    for lib in ('libemmalloc.a', 'libstubs.a', 'crt1.o', 'libz.a', 'libpng.a'):
+      self.assertExists(os.path.join(lib_dir, lib))
+
+  def test_embuilder_export_import(self):
+    restore_and_set_up()
+    self.clear_cache()
+    self.run_process([EMBUILDER, 'export', 'bundle.tar.gz', 'libemmalloc', 'zlib'])
+    self.clear_cache()
+    lib_dir = os.path.join(config.CACHE, 'sysroot', 'lib', 'wasm32-emscripten')
+    self.run_process([EMBUILDER, 'import', 'bundle.tar.gz', 'libemmalloc'])
+    self.assertExists(os.path.join(lib_dir, 'libemmalloc.a'))
+    self.assertExists(os.path.join(config.CACHE, 'sysroot', 'include', 'stdio.h'))
+    self.assertNotExists(os.path.join(lib_dir, 'libz.a'))
+    self.run_process([EMBUILDER, 'import', 'bundle.tar.gz'])
+    self.assertExists(os.path.join(lib_dir, 'libz.a'))
+    # Nothing needs to be rebuilt once the bundle has been imported.
+    output = self.do([EMBUILDER, 'build', 'libemmalloc', 'zlib'])
+    self.assertNotContained('generating system library', output)
+    self.assertNotContained('retrieving port', output)
+    self.assertContained('targets not found in bundle.tar.gz: libdlmalloc', self.do([EMBUILDER, 'import', 'bundle.tar.gz', 'libdlmalloc']))
+    # The bundle was built without --pic
+    err = self.expect_fail([EMBUILDER, 'import', 'bundle.tar.gz', '--pic'])
+    self.assertContained('bundle.tar.gz was created with different settings: RELOCATABLE=0 (currently 1) (pass --force to import it anyway)', err)
+    err = self.run_process([EMBUILDER, 'import', 'bundle.tar.gz', '--pic', '--force'], stderr=PIPE).stderr
+    self.assertContained('bundle.tar.gz was created with different settings: RELOCATABLE=0 (currently 1)', err)
+
   def test_embuilder_with_use_port_syntax(self):
     restore_and_set_up()
     self.run_process([EMBUILDER, 'build', 'sdl2_image:formats=png,jpg', '--force'])
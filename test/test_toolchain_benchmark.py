@@ -0,0 +1,240 @@
+# Copyright 2025 The Emscripten Authors.  All rights reserved.
+# Emscripten is available under two separate licenses, the MIT license and the
+# University of Illinois/NCSA Open Source License.  Both these licenses can be
+# found in the LICENSE file.
+
+"""Benchmarks of the speed of the toolchain itself (compiling, linking and
+packaging), as opposed to test_benchmark.py which measures the speed and size of
+the generated code.
+
+Each benchmark reports the time each run took and the peak memory use of the
+whole process tree, and then runs once more with EMPROFILE=1 to report the time
+spent in each ToolchainProfiler block and in each tool that emcc ran.
+"""
+
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import psutil
+
+if __name__ == '__main__':
+  raise Exception('do not run this file directly; do something like: test/runner.py toolchain_benchmark')
+
+from common import RunnerCore, test_file, read_file, parameterized
+from test_benchmark import TEST_REPS, WARMUP_REPS, MAX_REPS, REGRESSION_THRESHOLD
+from test_benchmark import compute_stats, is_precise_enough, is_significantly_slower
+from tools.shared import EMCC, EMXX, FILE_PACKAGER, config
+from tools import emprofile, utils
+
+# Where to write the results of all toolchain benchmarks, as JSON.
+BENCHMARK_OUTPUT = os.getenv('EMTEST_TOOLCHAIN_BENCHMARK_OUTPUT', 'toolchain_benchmark_results.json')
+
+# A file written to BENCHMARK_OUTPUT by an earlier run, to compare against.
+# See EMTEST_BENCHMARK_BASELINE in test_benchmark.py.
+BENCHMARK_BASELINE = os.getenv('EMTEST_TOOLCHAIN_BENCHMARK_BASELINE')
+
+# How often to sample the memory use of a running benchmark, in seconds.
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def get_tree_rss(proc):
+  rss = 0
+  try:
+    procs = [proc] + proc.children(recursive=True)
+  except psutil.NoSuchProcess:
+    return 0
+  for p in procs:
+    try:
+      rss += p.memory_info().rss
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+      # The process exited while we were looking at it
+      pass
+  return rss
+
+
+def run_and_measure(cmd, env):
+  """Runs a command, and returns the time it took in seconds and the peak
+  resident set size of it and all its subprocesses together, in bytes."""
+  with tempfile.TemporaryFile() as output:
+    start = time.perf_counter_ns()
+    proc = subprocess.Popen(cmd, env=env, stdout=output, stderr=subprocess.STDOUT)
+    ps_proc = psutil.Process(proc.pid)
+    peak_rss = 0
+    while proc.poll() is None:
+      peak_rss = max(peak_rss, get_tree_rss(ps_proc))
+      time.sleep(RSS_SAMPLE_INTERVAL)
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+    if proc.returncode:
+      output.seek(0)
+      raise Exception(f'benchmark command failed ({proc.returncode}): {cmd}\n{output.read().decode(errors="replace")}')
+  return elapsed, peak_rss
+
+
+def profile_phases(cmd, env):
+  """Runs a command with the toolchain profiler enabled, and returns the time
+  spent in each profile block and in each tool that it ran."""
+  with tempfile.TemporaryDirectory(prefix='emprofile_') as tmpdir:
+    env = dict(env, EMPROFILE='1', TMPDIR=tmpdir)
+    subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    emprofile.profiler_logs_path = os.path.join(tmpdir, 'emscripten_toolchain_profiler_logs')
+    all_results = emprofile.load_profiler_logs()
+    if not all_results:
+      return [], []
+    report = emprofile.create_report(all_results)
+    return report['blocks'], report['tools']
+
+
+class toolchain_benchmark(RunnerCore):
+  results = [] # type: ignore
+  baseline_results = {} # type: ignore
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    if BENCHMARK_BASELINE:
+      baseline = json.loads(read_file(BENCHMARK_BASELINE))
+      for result in baseline['results']:
+        cls.baseline_results[result['benchmark']] = result
+
+  @classmethod
+  def tearDownClass(cls):
+    super().tearDownClass()
+    if cls.results:
+      output = {
+        'version': 1,
+        'results': cls.results,
+      }
+      utils.write_file(BENCHMARK_OUTPUT, json.dumps(output, indent=2) + '\n')
+      print('Wrote toolchain benchmark results to ' + os.path.abspath(BENCHMARK_OUTPUT))
+
+  def do_toolchain_benchmark(self, name, cmd, env=None, setup=None,
+                             reps=TEST_REPS, warmup=WARMUP_REPS, max_reps=MAX_REPS):
+    """Runs `cmd` repeatedly and records how long it takes.  `setup`, if given,
+    is called before each run, and is not timed."""
+    env = env or os.environ.copy()
+    warmup_times = []
+    times = []
+    peak_rss = 0
+
+    def run():
+      if setup:
+        setup()
+      elapsed, rss = run_and_measure(cmd, env)
+      nonlocal peak_rss
+      peak_rss = max(peak_rss, rss)
+      return elapsed
+
+    for _ in range(warmup):
+      warmup_times.append(run())
+    while not is_precise_enough(times, reps, max_reps):
+      times.append(run())
+
+    if setup:
+      setup()
+    blocks, tools = profile_phases(cmd, env)
+
+    stats = compute_stats(times)
+    print()
+    print('   %s: mean: %4.3f (+-%4.3f) secs  median: %4.3f  range: %4.3f-%4.3f  (95%% CI: +-%4.3f%%)  (%d runs)  peak RSS: %d MB' % (
+          name, stats['mean'], stats['std'], stats['median'], stats['min'], stats['max'], 100 * (stats['ci95'] or 0) / stats['mean'], len(times), peak_rss // (1024 * 1024)))
+    for block in blocks[:10]:
+      print('      %8.3fs  %s (%d)' % (block['total'], block['name'], block['count']))
+
+    self.results.append({
+      'benchmark': name,
+      'units': 'seconds',
+      'cmd': [str(c) for c in cmd],
+      'times': times,
+      'warmup_times': warmup_times,
+      **stats,
+      'peak_rss': peak_rss,
+      'blocks': blocks,
+      'tools': tools,
+    })
+
+    baseline = self.baseline_results.get(name)
+    if baseline:
+      change = 100 * (stats['mean'] / baseline['mean'] - 1)
+      if is_significantly_slower(times, baseline['times'], REGRESSION_THRESHOLD):
+        self.fail('benchmark regressed: %s: %4.3f -> %4.3f secs (%+.1f%%)' % (name, baseline['mean'], stats['mean'], change))
+      print('   %+.1f%% compared to baseline' % change)
+
+  def build_box2d(self, cflags):
+    """Compiles the box2d benchmark, and returns the object files and libraries
+    to link it."""
+    libs = self.get_library(os.path.join('third_party', 'box2d'), ['box2d.a'], configure=None,
+                            env_init={'CFLAGS': ' '.join(cflags)}, cache_name_extra='_toolchain_benchmark')
+    self.run_process([EMXX, '-c', test_file('benchmark/test_box2d_benchmark.cpp'), '-I' + test_file('third_party/box2d'), '-o', 'main.o'] + cflags)
+    return ['main.o'] + libs
+
+  def test_compile_single_tu(self):
+    utils.write_file('hello.c', read_file(test_file('hello_world.c')))
+    self.do_toolchain_benchmark('compile_single_tu', [EMCC, '-c', 'hello.c', '-o', 'hello.o'])
+
+  def test_compile_many_tus(self):
+    files = []
+    for i in range(200):
+      filename = f'tu_{i}.c'
+      utils.write_file(filename, f'''
+        #include <stdio.h>
+        #include <string.h>
+        int func_{i}(const char* str) {{
+          int result = 0;
+          for (size_t j = 0; j < strlen(str); j++) {{
+            result += str[j] * {i};
+          }}
+          printf("%d\\n", result);
+          return result;
+        }}
+      ''')
+      files.append(filename)
+    self.do_toolchain_benchmark('compile_many_tus', [EMCC, '-c', '-O2'] + files)
+
+  @parameterized({
+    'O0': (['-O0'],),
+    'O2': (['-O2'],),
+    'O3': (['-O3'],),
+    'O2_closure': (['-O2', '--closure=1'],),
+    'O3_closure': (['-O3', '--closure=1'],),
+  })
+  def test_link(self, link_flags):
+    inputs = self.build_box2d(['-O2'])
+    name = 'link' + '_'.join([''] + [f.lstrip('-').replace('=1', '') for f in link_flags])
+    self.do_toolchain_benchmark(name, [EMXX, '-o', 'box2d.js'] + inputs + link_flags)
+
+  def test_link_source_map(self):
+    inputs = self.build_box2d(['-O2', '-g'])
+    self.do_toolchain_benchmark('link_source_map', [EMXX, '-o', 'box2d.js', '-O2', '-gsource-map'] + inputs)
+
+  def test_file_packager_100k(self):
+    for i in range(100):
+      os.makedirs(f'files/dir_{i}')
+      for j in range(1000):
+        utils.write_file(f'files/dir_{i}/file_{j}.txt', f'file {i} {j}\n')
+    self.do_toolchain_benchmark('file_packager_100k', [FILE_PACKAGER, 'files.data', '--preload', 'files', '--js-output=files.js'])
+
+  @parameterized({
+    'cold': (True,),
+    'warm': (False,),
+  })
+  def test_system_libs(self, cold):
+    if config.FROZEN_CACHE:
+      self.skipTest('system libraries cannot be built with FROZEN_CACHE')
+    cache_dir = os.path.abspath('cache')
+    env = os.environ.copy()
+    env['EM_CACHE'] = cache_dir
+    env.pop('EM_READONLY_CACHES', None)
+    utils.write_file('hello.cpp', read_file(test_file('hello_libcxx.cpp')))
+    cmd = [EMXX, 'hello.cpp', '-o', 'hello.js']
+
+    if cold:
+      # Each run builds all the system libraries from scratch, so only do a few.
+      def setup():
+        utils.delete_dir(cache_dir)
+      self.do_toolchain_benchmark('system_libs_cold', cmd, env=env, setup=setup, reps=3, warmup=0, max_reps=3)
+    else:
+      self.run_process(cmd, env=env)
+      self.do_toolchain_benchmark('system_libs_warm', cmd, env=env)
@@ -4909,13 +4909,14 @@ class Parser(Tokenizer):
         else:
             raise WebIDLError("invalid syntax", [Location(self.lexer, p.lineno, p.lexpos, self._filename)])
 
-    def __init__(self, outputdir='', lexer=None):
+    def __init__(self, outputdir='', lexer=None, picklefile=None):
         Tokenizer.__init__(self, outputdir, lexer)
         self.parser = yacc.yacc(debug=0,
                                 module=self,
                                 outputdir=outputdir,
                                 tabmodule='webidlyacc',
                                 write_tables=0,
+                                picklefile=picklefile,
                                 errorlog=yacc.NullLogger())
         self._globalScope = IDLScope(BuiltinLocation("<Global Scope>"), None, None)
         self._installBuiltins(self._globalScope)
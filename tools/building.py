@@ -15,7 +15,7 @@ import shutil
 import subprocess
 import sys
 from typing import Set, Dict
-from subprocess import PIPE
+from subprocess import PIPE, STDOUT
 
 from . import cache
 from . import diagnostics
@@ -63,10 +63,12 @@ def get_building_env():
   env['HOST_CXX'] = CLANG_CXX
   env['HOST_CFLAGS'] = '-W' # if set to nothing, CFLAGS is used, which we don't want
   env['HOST_CXXFLAGS'] = '-W' # if set to nothing, CXXFLAGS is used, which we don't want
-  env['PKG_CONFIG_LIBDIR'] = cache.get_sysroot_dir('local/lib/pkgconfig') + os.path.pathsep + cache.get_sysroot_dir('lib/pkgconfig')
+  pkgconfig_dirs = [cache.get_sysroot_dir('local/lib/pkgconfig')]
+  pkgconfig_dirs += [str(d) for d in cache.get_layer_paths(cache.get_sysroot(absolute=False), 'lib/pkgconfig')]
+  env['PKG_CONFIG_LIBDIR'] = os.path.pathsep.join(pkgconfig_dirs)
   env['PKG_CONFIG_PATH'] = os.environ.get('EM_PKG_CONFIG_PATH', '')
   env['EMSCRIPTEN'] = path_from_root()
-  env['PATH'] = cache.get_sysroot_dir('bin') + os.pathsep + env['PATH']
+  env['PATH'] = os.path.join(cache.get_installed_sysroot(), 'bin') + os.pathsep + env['PATH']
   env['ACLOCAL_PATH'] = cache.get_sysroot_dir('share/aclocal')
   env['CROSS_COMPILE'] = path_from_root('em') # produces /path/to/emscripten/em , which then can have 'cc', 'ar', etc appended to it
   return env
@@ -257,7 +259,9 @@ def lld_flags_for_executable(external_symbols):
   return cmd
 
 
-def link_lld(args, target, external_symbols=None):
+def link_lld(args, target, external_symbols=None, check=True):
+  """Links with wasm-ld.  With `check=False` a failing link is not fatal;
+  instead its output is only logged and False is returned."""
   if not os.path.exists(WASM_LD):
     exit_with_error('linker binary not found in LLVM directory: %s', WASM_LD)
   # runs lld to link things.
@@ -302,6 +306,14 @@ def link_lld(args, target, external_symbols=None):
     cmd += lld_flags_for_executable(external_symbols)
 
   cmd = get_command_with_possible_response_file(cmd)
+  if not check:
+    shared.print_compiler_stage(cmd)
+    if shared.SKIP_SUBPROCS:
+      return True
+    proc = run_process(cmd, check=False, stdout=PIPE, stderr=STDOUT)
+    if proc.returncode:
+      logger.debug(f'link failed: {proc.stdout}')
+    return proc.returncode == 0
   check_call(cmd)
 
 
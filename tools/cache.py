@@ -4,12 +4,26 @@
 # found in the LICENSE file.
 
 """Permanent cache for system libraries and ports.
+
+In addition to the writable cache directory, any number of read-only cache
+directories (e.g. a prebuilt cache on a shared network drive) can be configured
+using `READONLY_CACHES`.  These layers are searched first and are never locked
+or written to; anything missing from them gets built in the writable cache.
+
+The writable cache can be kept below a given size by evicting the least
+recently used entries, either explicitly (`emcc --cache-gc=<size>`) or
+automatically whenever something new is added to it (`CACHE_SIZE_LIMIT`).
+The modification time of an entry records when it was last used.
 """
 
 import contextlib
+import json
 import logging
 import os
+import threading
+import time
 from pathlib import Path
+from typing import List
 
 from . import filelock, config, utils
 from .settings import settings
@@ -18,9 +32,27 @@ logger = logging.getLogger('cache')
 
 
 acquired_count = 0
+# Guards acquired_count, for when the cache is used from multiple threads (e.g.
+# by embuilder). All threads of a process share the same cache lock.
+acquired_count_lock = threading.Lock()
 cachedir = None
+readonly_layers: List[Path] = []
 cachelock = None
 cachelock_name = None
+# The manifest of the files installed into the sysroot (see
+# `system_libs.InstallManifest`), relative to the sysroot.
+INSTALL_MANIFEST = 'install_manifest.json'
+# When set to a set, the cache entries that are requested via get() (and port
+# source directories) are recorded in it, relative to the cache root. This is
+# used by `embuilder export` to find out which files make up a target.
+accessed_entries = None
+# Entries that were used at or after this time may be in use by the current
+# process, so they are never evicted.
+process_start_time = time.time()
+# Entries used less than this many seconds ago are not evicted by the automatic
+# garbage collection, since other processes can use them without holding the
+# cache lock (e.g. a concurrent link that has just looked up a library).
+AUTO_GC_MIN_IDLE = 60 * 60
 
 
 def is_writable(path):
@@ -28,6 +60,11 @@ def is_writable(path):
 
 
 def acquire_cache_lock(reason):
+  with acquired_count_lock:
+    _acquire_cache_lock(reason)
+
+
+def _acquire_cache_lock(reason):
   global acquired_count
   if config.FROZEN_CACHE:
     # Raise an exception here rather than exit_with_error since in practice this
@@ -52,6 +89,11 @@ def acquire_cache_lock(reason):
 
 
 def release_cache_lock():
+  with acquired_count_lock:
+    _release_cache_lock()
+
+
+def _release_cache_lock():
   global acquired_count
   acquired_count -= 1
   assert acquired_count >= 0, "Called release more times than acquire"
@@ -81,13 +123,67 @@ def ensure():
       utils.exit_with_error(f'unable to create cache directory "{cachedir}": {e} (see https://emscripten.org/docs/tools_reference/emcc.html for info on setting the cache directory)')
 
 
-def erase():
+def erase(keep_system_headers=False):
+  """Deletes the contents of the cache.
+
+  With `keep_system_headers` the headers that were installed into the sysroot
+  from the emscripten tree (and have not been modified since) are kept, along
+  with the manifest that records them (see `system_libs.InstallManifest`), so
+  that installing them again only rewrites the ones that changed.
+  """
   ensure_setup()
   assert not config.FROZEN_CACHE, 'Cache cannot be erased when FROZEN_CACHE is set'
 
   with lock('erase'):
     # Delete everything except the lockfile itself
-    utils.delete_contents(cachedir, exclude=[os.path.basename(cachelock_name)])
+    keep = [os.path.basename(cachelock_name)]
+    if keep_system_headers:
+      keep += prune_install_manifest()
+    delete_contents_except(cachedir, keep)
+
+
+def prune_install_manifest():
+  """Removes the entries of the sysroot install manifest that were not
+  installed from the emscripten tree, or were modified since they were
+  installed.  Returns the files that remain (relative to the cache directory),
+  including the manifest itself."""
+  filename = os.path.join(cachedir, 'sysroot', INSTALL_MANIFEST)
+  try:
+    entries = json.loads(utils.read_file(filename))
+  except (OSError, ValueError):
+    return []
+  system_dir = utils.normalize_path(utils.path_from_root('system')) + '/'
+  kept = {}
+  for key, entry in entries.items():
+    try:
+      dest_stat = os.stat(os.path.join(cachedir, 'sysroot', key))
+    except OSError:
+      continue
+    if entry[0].startswith(system_dir) and entry[4:] == [dest_stat.st_size, dest_stat.st_mtime_ns]:
+      kept[key] = entry
+  utils.write_file(filename, json.dumps(kept, sort_keys=True))
+  return [f'sysroot/{key}' for key in kept] + [f'sysroot/{INSTALL_MANIFEST}']
+
+
+def delete_contents_except(dirname, keep):
+  """Deletes the contents of `dirname` except for the files in `keep` (paths
+  relative to `dirname`, separated by forward slashes)."""
+  nested = {}
+  for path in keep:
+    head, _, tail = path.partition('/')
+    nested.setdefault(head, set()).add(tail)
+  for entry in os.listdir(dirname):
+    kept = nested.get(entry)
+    if kept and '' in kept:
+      continue
+    path = os.path.join(dirname, entry)
+    if os.path.isdir(path) and not os.path.islink(path):
+      if kept:
+        delete_contents_except(path, kept)
+      else:
+        utils.delete_dir(path)
+    else:
+      utils.delete_file(path)
 
 
 def get_path(name):
@@ -102,6 +198,26 @@ def get_sysroot(absolute):
   return 'sysroot'
 
 
+def get_layer_paths(*parts):
+  """Returns the given path in each of the read-only layers that contain it,
+  followed by the path in the writable cache (which is always included since it
+  may be created later on)."""
+  ensure_setup()
+  paths = [Path(layer, *parts) for layer in readonly_layers]
+  return [p for p in paths if p.exists()] + [Path(cachedir, *parts)]
+
+
+def get_installed_sysroot():
+  """Returns the absolute path of the sysroot that the system headers are
+  installed in.  This is the sysroot of the first layer that has them, which
+  is the writable cache unless a read-only layer has already installed them."""
+  ensure_setup()
+  for layer in readonly_layers:
+    if Path(layer, 'sysroot_install.stamp').exists():
+      return os.path.join(layer, 'sysroot')
+  return get_sysroot(absolute=True)
+
+
 def get_include_dir(*parts):
   return str(get_sysroot_dir('include', *parts))
 
@@ -131,6 +247,12 @@ def get_lib_dir(absolute):
   return path
 
 
+def get_lib_dirs():
+  """Returns the system library directories of all cache layers, in lookup
+  order."""
+  return [str(p) for p in get_layer_paths(get_lib_dir(absolute=False))]
+
+
 def get_lib_name(name, absolute=False):
   return str(get_lib_dir(absolute=absolute).joinpath(name))
 
@@ -156,10 +278,18 @@ def get_lib(libname, *args, **kwargs):
 # the given creator function
 def get(shortname, creator, what=None, force=False, quiet=False):
   ensure_setup()
+  if not force:
+    # Read-only layers can be checked without any locking.
+    for layer in readonly_layers:
+      layername = Path(layer, shortname)
+      if layername.exists():
+        return str(layername)
   cachename = Path(cachedir, shortname)
+  record_access(cachename)
   # Check for existence before taking the lock in case we can avoid the
   # lock completely.
   if cachename.exists() and not force:
+    touch(cachename)
     return str(cachename)
 
   if config.FROZEN_CACHE:
@@ -187,14 +317,161 @@ def get(shortname, creator, what=None, force=False, quiet=False):
       assert cachename.is_file()
     if not quiet:
       logger.info(' - ok')
+    if config.CACHE_SIZE_LIMIT:
+      collect_garbage(utils.expand_byte_size_suffixes(str(config.CACHE_SIZE_LIMIT)), min_idle=AUTO_GC_MIN_IDLE)
 
   return str(cachename)
 
 
+def touch(path):
+  """Marks a cache entry as used now, for the least recently used eviction."""
+  try:
+    os.utime(path)
+  except OSError:
+    # The entry may have been evicted in the meantime, or the cache may not be
+    # writable (e.g. with FROZEN_CACHE).
+    pass
+
+
+class CacheEntry:
+  """A unit of eviction: one or more paths in the cache that are only useful
+  together (e.g. a port's source archive and the directory it is unpacked
+  into)."""
+
+  def __init__(self, name):
+    self.name = name
+    self.paths = []
+    self.size = 0
+    self.last_used = 0
+
+  def add(self, path):
+    self.paths.append(path)
+    self.last_used = max(self.last_used, path.stat().st_mtime)
+    if path.is_dir():
+      for root, _, files in os.walk(path):
+        for f in files:
+          self.size += os.lstat(os.path.join(root, f)).st_size
+    else:
+      self.size += path.stat().st_size
+
+
+def get_entries():
+  """Returns the evictable entries of the writable cache.
+
+  These are the system libraries and port libraries (each file in the library
+  directories of the sysroot), port sources, library build directories and
+  any other subdirectory of the cache (such as `symbol_lists`).  Installed
+  headers and the top level files (such as the sanity file and the lock) are
+  never evicted since other entries depend on them.
+  """
+  ensure_setup()
+  entries = {}
+
+  def add(name, path):
+    if name not in entries:
+      entries[name] = CacheEntry(name)
+    try:
+      entries[name].add(path)
+    except FileNotFoundError:
+      # Removed by a process that is not holding the cache lock, such as
+      # the pruning of `get_cached_file`.
+      pass
+
+  for top in sorted(os.listdir(cachedir)):
+    path = Path(cachedir, top)
+    if not path.is_dir():
+      continue
+    if top == 'sysroot':
+      for libdir in sorted(Path(path, 'lib').glob('wasm*-emscripten')):
+        for root, _, files in os.walk(libdir):
+          for f in files:
+            f = Path(root, f)
+            add(f.relative_to(cachedir).as_posix(), f)
+    else:
+      for child in sorted(os.listdir(path)):
+        if child.endswith('.lock'):
+          continue
+        name = child
+        if top == 'ports':
+          # Group the downloaded archive with the unpacked sources.
+          name = child.split('.', 1)[0]
+        add(f'{top}/{name}', Path(path, child))
+  return list(entries.values())
+
+
+def collect_garbage(max_size, dry_run=False, min_idle=0):
+  """Evicts the least recently used entries until the total size of the
+  evictable entries is at most `max_size` bytes.
+
+  Entries used by the current process, or less than `min_idle` seconds ago,
+  are kept even if that means the cache stays above the limit.  Returns the
+  list of entries that were (or with `dry_run`, would be) evicted.
+  """
+  ensure_setup()
+  assert not config.FROZEN_CACHE, 'Cache cannot be garbage collected when FROZEN_CACHE is set'
+  with lock('garbage collection'):
+    entries = get_entries()
+    total_size = sum(e.size for e in entries)
+    if total_size <= max_size:
+      logger.debug(f'cache size {total_size} is within the limit of {max_size} bytes')
+      return []
+    keep_after = min(process_start_time, time.time() - min_idle)
+    evicted = []
+    for entry in sorted(entries, key=lambda e: e.last_used):
+      if total_size <= max_size:
+        break
+      if entry.last_used >= keep_after:
+        continue
+      verb = 'would evict' if dry_run else 'evicting'
+      logger.info(f'{verb} cache entry: {entry.name} ({entry.size} bytes, last used {time.ctime(entry.last_used)})')
+      if not dry_run:
+        for path in entry.paths:
+          if path.is_dir():
+            utils.delete_dir(path)
+          else:
+            utils.delete_file(path)
+      total_size -= entry.size
+      evicted.append(entry)
+    if total_size > max_size:
+      logger.warning(f'unable to reduce the cache size below {max_size} bytes since the remaining entries were used recently ({total_size} bytes)')
+    return evicted
+
+
+def record_access(path):
+  if accessed_entries is None:
+    return
+  try:
+    accessed_entries.add(Path(path).resolve().relative_to(Path(cachedir).resolve()).as_posix())
+  except ValueError:
+    logger.debug(f'not recording access to {path} which is outside of the cache')
+
+
+def is_compatible_layer(layer):
+  """Read-only layers cannot be cleared when emscripten is updated, so instead
+  they are ignored if their sanity file shows that they were populated by a
+  different version.  The LLVM path is not compared since a shared cache may
+  well have been built on another machine."""
+  sanity_file = Path(layer, 'sanity.txt')
+  if not sanity_file.exists():
+    return True
+  version = utils.read_file(sanity_file).split('|')[0]
+  if version != utils.EMSCRIPTEN_VERSION:
+    logger.warning(f'ignoring read-only cache layer {layer} which was populated by emscripten {version} (this is {utils.EMSCRIPTEN_VERSION})')
+    return False
+  return True
+
+
 def setup():
-  global cachedir, cachelock, cachelock_name
+  global cachedir, readonly_layers, cachelock, cachelock_name
   # figure out the root directory for all caching
   cachedir = Path(config.CACHE).resolve()
+  readonly_layers = []
+  for layer in config.READONLY_CACHES:
+    layer = Path(layer).resolve()
+    if not layer.is_dir():
+      logger.debug(f'ignoring missing read-only cache layer: {layer}')
+    elif layer != cachedir and layer not in readonly_layers and is_compatible_layer(layer):
+      readonly_layers.append(layer)
 
   # since the lock itself lives inside the cache directory we need to ensure it
   # exists.
@@ -18,7 +18,7 @@ from tools import shared, utils, ports, diagnostics, config
 from tools import cache, feature_matrix, colored_logger
 from tools.shared import exit_with_error
 from tools.settings import settings, user_settings, MEM_SIZE_SETTINGS
-from tools.utils import removeprefix, read_file
+from tools.utils import removeprefix, read_file, expand_byte_size_suffixes
 
 SIMD_INTEL_FEATURE_TOWER = ['-msse', '-msse2', '-msse3', '-mssse3', '-msse4.1', '-msse4.2', '-msse4', '-mavx', '-mavx2']
 SIMD_NEON_FLAGS = ['-mfpu=neon']
@@ -82,6 +82,10 @@ class EmccOptions:
     self.memory_profiler = False
     self.use_preload_cache = False
     self.use_preload_plugins = False
+    self.compress_preload_files = False
+    self.lazy_preload_files = False
+    self.preload_shard_size = None
+    self.preload_shard_by_directory = False
     self.valid_abspaths = []
     # Specifies the line ending format to use for all generated text files.
     # Defaults to using the native EOL on each platform (\r\n on Windows, \n on
@@ -434,6 +438,16 @@ def parse_args(newargs):  # noqa: C901, PLR0912, PLR0915
       diagnostics.warning('legacy-settings', 'ignoring legacy flag --no-heap-copy (that is the only mode supported now)')
     elif check_flag('--use-preload-plugins'):
       options.use_preload_plugins = True
+    elif check_flag('--compress-preload-files'):
+      options.compress_preload_files = True
+    elif check_flag('--lazy-preload-files'):
+      options.lazy_preload_files = True
+    elif check_arg('--preload-shard-size'):
+      options.preload_shard_size = consume_arg()
+      if not is_int(options.preload_shard_size) or int(options.preload_shard_size) <= 0:
+        exit_with_error(f'invalid --preload-shard-size: {options.preload_shard_size}')
+    elif check_flag('--preload-shard-by-directory'):
+      options.preload_shard_by_directory = True
     elif check_flag('--ignore-dynamic-linking'):
       options.ignore_dynamic_linking = True
     elif arg == '-v':
@@ -455,6 +469,16 @@ def parse_args(newargs):  # noqa: C901, PLR0912, PLR0915
       diagnostics.warning('legacy-settings', '--remove-duplicates is deprecated as it is no longer needed. If you cannot link without it, file a bug with a testcase')
     elif check_flag('--jcache'):
       logger.error('jcache is no longer supported')
+    elif check_arg('--cache-gc-dry-run') or check_arg('--cache-gc'):
+      dry_run = arg.startswith('--cache-gc-dry-run')
+      max_size = expand_byte_size_suffixes(consume_arg())
+      evicted = cache.collect_garbage(max_size, dry_run=dry_run)
+      freed = sum(e.size for e in evicted)
+      if dry_run:
+        logger.info(f'--cache-gc-dry-run: would evict {len(evicted)} entries ({freed} bytes) from `{cache.cachedir}`')
+      else:
+        logger.info(f'--cache-gc: evicted {len(evicted)} entries ({freed} bytes) from `{cache.cachedir}`')
+      should_exit = True
     elif check_arg('--cache'):
       config.CACHE = os.path.abspath(consume_arg())
       cache.setup()
@@ -644,22 +668,6 @@ def parse_args(newargs):  # noqa: C901, PLR0912, PLR0915
   return options, settings_changes, user_js_defines, newargs
 
 
-def expand_byte_size_suffixes(value):
-  """Given a string with KB/MB size suffixes, such as "32MB", computes how
-  many bytes that is and returns it as an integer.
-  """
-  value = value.strip()
-  match = re.match(r'^(\d+)\s*([kmgt]?b)?$', value, re.I)
-  if not match:
-    exit_with_error("invalid byte size `%s`.  Valid suffixes are: kb, mb, gb, tb" % value)
-  value, suffix = match.groups()
-  value = int(value)
-  if suffix:
-    size_suffixes = {suffix: 1024 ** i for i, suffix in enumerate(['b', 'kb', 'mb', 'gb', 'tb'])}
-    value *= size_suffixes[suffix.lower()]
-  return value
-
-
 def parse_symbol_list_file(contents):
   """Parse contents of one-symbol-per-line response file.  This format can by used
   with, for example, -sEXPORTED_FUNCTIONS=@filename and avoids the need for any
@@ -85,7 +85,13 @@ def get_cflags(user_args):
   # Flags we pass to the compiler when building C/C++ code
   # We add these to the user's flags (newargs), but not when building .s or .S assembly files
   cflags = get_clang_flags(user_args)
-  cflags.append('--sysroot=' + cache.get_sysroot(absolute=True))
+  sysroot = cache.get_installed_sysroot()
+  cflags.append('--sysroot=' + sysroot)
+  # Headers that ports installed into other cache layers are searched after
+  # the system headers.
+  for include_dir in cache.get_layer_paths(cache.get_sysroot(absolute=False), 'include'):
+    if str(include_dir) != os.path.join(sysroot, 'include'):
+      cflags += ['-idirafter', str(include_dir)]
 
   if settings.EMSCRIPTEN_TRACING:
     cflags.append('-D__EMSCRIPTEN_TRACING__=1')
@@ -26,7 +26,10 @@ CLANG_ADD_VERSION = None
 CLOSURE_COMPILER = None
 FROZEN_CACHE = None
 CACHE = None
+READONLY_CACHES: List[str] = []
+CACHE_SIZE_LIMIT = None
 PORTS = None
+PORTS_MIRROR = None
 COMPILER_WRAPPER = None
 
 # Set by init()
@@ -59,7 +62,7 @@ def fix_js_engine(old, new):
 
 
 def normalize_config_settings():
-  global CACHE, PORTS, LLVM_ADD_VERSION, CLANG_ADD_VERSION, CLOSURE_COMPILER
+  global CACHE, READONLY_CACHES, PORTS, LLVM_ADD_VERSION, CLANG_ADD_VERSION, CLOSURE_COMPILER
   global NODE_JS, NODE_JS_TEST, V8_ENGINE, JS_ENGINES, SPIDERMONKEY_ENGINE, WASM_ENGINES
 
   SPIDERMONKEY_ENGINE = fix_js_engine(SPIDERMONKEY_ENGINE, listify(SPIDERMONKEY_ENGINE))
@@ -71,6 +74,7 @@ def normalize_config_settings():
   CLOSURE_COMPILER = listify(CLOSURE_COMPILER)
   if not CACHE:
     CACHE = path_from_root('cache')
+  READONLY_CACHES = listify(READONLY_CACHES) or []
   if not PORTS:
     PORTS = os.path.join(CACHE, 'ports')
 
@@ -116,7 +120,10 @@ def parse_config_file():
     'WASM_ENGINES',
     'FROZEN_CACHE',
     'CACHE',
+    'READONLY_CACHES',
+    'CACHE_SIZE_LIMIT',
     'PORTS',
+    'PORTS_MIRROR',
     'COMPILER_WRAPPER',
   )
 
@@ -130,6 +137,11 @@ def parse_config_file():
       # Unlike the other keys these two should always be lists.
       if env_var in ('EM_JS_ENGINES', 'EM_WASM_ENGINES'):
         env_value = env_value.split(',')
+      elif env_var == 'EM_READONLY_CACHES' and env_value:
+        env_value = env_value.split(os.pathsep)
+        for path in env_value:
+          if not os.path.isabs(path):
+            exit_with_error(f'environment variable {env_var} must be a list of absolute paths: {path}')
       if env_var in ('EM_CONFIG', 'EM_CACHE', 'EM_PORTS', 'EM_LLVM_ROOT', 'EM_BINARYEN_ROOT'):
         if not os.path.isabs(env_value):
           exit_with_error(f'environment variable {env_var} must be an absolute path: {env_value}')
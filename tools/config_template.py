@@ -47,3 +47,6 @@ NODE_JS = '{{{ NODE }}}' # executable
 # Other options
 #
 # FROZEN_CACHE = True # never clears the cache, and disallows building to the cache
+# READONLY_CACHES = ['/shared/emscripten/cache'] # prebuilt caches that are searched before CACHE
+# CACHE_SIZE_LIMIT = '10gb' # evict least recently used cache entries when the cache grows above this size
+# PORTS_MIRROR = '/shared/emscripten/ports-mirror' # directory or URL searched for port archives (as <mirror>/<port>/<archive>) before their upstream URL
@@ -32,7 +32,9 @@ def list_files_in_directory(d):
   return files
 
 
-def create_profiling_graph(outfile):
+# Loads all recorded profiler log files. Returns a list of the log entries
+# sorted by time, or None if the logs could not be read.
+def load_profiler_logs():
   log_files = [f for f in list_files_in_directory(profiler_logs_path) if 'toolchain_profiler.pid_' in f]
 
   all_results = []
@@ -53,12 +55,19 @@ def create_profiling_graph(outfile):
     except json.JSONDecodeError as e:
       print(str(e), file=sys.stderr)
       print('Failed to parse JSON file "' + f + '"!', file=sys.stderr)
-      return 1
+      return None
   if len(all_results) == 0:
     print(f'No profiler logs were found in path: ${profiler_logs_path}.\nTry setting the environment variable EMPROFILE=1 and run some emcc commands, then re-run "emprofile.py --graph".', file=sys.stderr)
-    return 1
+    return None
 
   all_results.sort(key=lambda x: x['time'])
+  return all_results
+
+
+def create_profiling_graph(outfile):
+  all_results = load_profiler_logs()
+  if all_results is None:
+    return 1
 
   emprofile_json_data = json.dumps(all_results, indent=2)
 
@@ -69,6 +78,279 @@ def create_profiling_graph(outfile):
   return 0
 
 
+# Returns a short display name for a process from its command line, e.g.
+# "emcc.py" or "wasm-opt".
+def command_name(cmdline):
+  if not cmdline:
+    return '(unknown)'
+  name = os.path.basename(cmdline[0])
+  # Python tools show up as "python3 /path/to/emcc.py ..."
+  if name.startswith('python') and len(cmdline) > 1:
+    name = os.path.basename(cmdline[1])
+  return name
+
+
+# Returns the thread that a log entry was recorded on. Logs from before threads
+# were recorded only have the process ID.
+def thread_id(e):
+  return e.get('tid', e.get('subprocessPid', e['pid']))
+
+
+# Converts the profiler log entries to the Trace Event Format that is understood
+# by Perfetto (https://ui.perfetto.dev) and chrome://tracing.
+# Each profiled process becomes a trace process. Threads within it correspond to
+# the threads of the process itself (e.g. those that run post-link tasks
+# concurrently) and to any subprocessing pool workers that ran on its behalf.
+# Profile blocks become nested duration events on the thread that ran them,
+# and spawned subprocesses become complete events on the thread that spawned
+# them.
+def create_trace_events(all_results):
+  def us(t):
+    return int(round(t * 1000000))
+
+  events = []
+  spawns = {}
+  starts = {}
+  for e in all_results:
+    pid = e['pid']
+    tid = thread_id(e)
+    op = e['op']
+    if op == 'start':
+      starts[pid] = e
+      events.append({'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': tid, 'args': {'name': f'{command_name(e["cmdLine"])} ({pid})'}})
+    elif op == 'exit':
+      start = starts.pop(pid, None)
+      if start:
+        events.append({'ph': 'X', 'name': command_name(start['cmdLine']), 'cat': 'process', 'pid': pid, 'tid': start.get('subprocessPid', pid),
+                       'ts': us(start['time']), 'dur': us(e['time']) - us(start['time']),
+                       'args': {'cmdLine': ' '.join(start['cmdLine']), 'returncode': e['returncode']}})
+    elif op == 'enterBlock':
+      events.append({'ph': 'B', 'name': e['name'], 'cat': 'block', 'pid': pid, 'tid': tid, 'ts': us(e['time'])})
+    elif op == 'exitBlock':
+      events.append({'ph': 'E', 'name': e['name'], 'cat': 'block', 'pid': pid, 'tid': tid, 'ts': us(e['time'])})
+    elif op == 'spawn':
+      spawns[(pid, e['targetPid'])] = e
+    elif op == 'finish':
+      spawn = spawns.pop((pid, e['targetPid']), None)
+      if spawn:
+        events.append({'ph': 'X', 'name': command_name(spawn['cmdLine']), 'cat': 'subprocess', 'pid': pid, 'tid': thread_id(spawn),
+                       'ts': us(spawn['time']), 'dur': us(e['time']) - us(spawn['time']),
+                       'args': {'cmdLine': ' '.join(spawn['cmdLine']), 'returncode': e['returncode']}})
+  return events
+
+
+def write_trace_file(trace_file, all_results):
+  trace = {'traceEvents': create_trace_events(all_results), 'displayTimeUnit': 'ms'}
+  with open(trace_file, 'w') as f:
+    json.dump(trace, f)
+  print(f'Wrote "{trace_file}"')
+
+
+# Spans of time where only a single tool process is running are reported as
+# serial phases of the build if they last at least this many seconds.
+SERIAL_PHASE_MIN_DURATION = 0.5
+
+
+class Span:
+  def __init__(self, name, start, end, args=None):
+    self.name = name
+    self.start = start
+    self.end = end
+    self.args = args or {}
+    self.children = []
+
+  @property
+  def duration(self):
+    return self.end - self.start
+
+
+# Pairs up the start/exit, enterBlock/exitBlock and spawn/finish log entries.
+# Returns a tuple (processes, blocks, subprocesses), where processes is a dict
+# from pid to the Span of each profiled process, blocks is a list of
+# (pid, Span) profile blocks, and subprocesses a list of (pid, target pid, Span)
+# spawned tools.
+def collect_spans(all_results):
+  processes = {}
+  blocks = []
+  subprocesses = []
+  open_processes = {}
+  open_blocks = {}
+  open_spawns = {}
+  real_pids = {}
+  for e in all_results:
+    pid = e['pid']
+    tid = thread_id(e)
+    op = e['op']
+    if op == 'start':
+      open_processes[pid] = e
+    elif op == 'exit':
+      start = open_processes.pop(pid, None)
+      if start:
+        processes[pid] = Span(command_name(start['cmdLine']), start['time'], e['time'], {'cmdLine': start['cmdLine']})
+    elif op == 'enterBlock':
+      # Each open block is tracked as [log entry, has nested blocks]
+      open_blocks.setdefault((pid, tid), []).append([e, False])
+    elif op == 'exitBlock':
+      stack = open_blocks.get((pid, tid), [])
+      for i in range(len(stack) - 1, -1, -1):
+        enter, has_children = stack[i]
+        if enter['name'] == e['name']:
+          # Blocks that have no other blocks nested inside them are leaf blocks.
+          block = Span(e['name'], enter['time'], e['time'], {'leaf': i == len(stack) - 1 and not has_children})
+          del stack[i]
+          if stack:
+            stack[-1][1] = True
+          blocks.append((pid, block))
+          break
+    elif op == 'spawn':
+      open_spawns[(pid, e['targetPid'])] = e
+      if e['targetPid'] >= 0:
+        real_pids.setdefault((pid, tid, tuple(e['cmdLine'])), []).append((e['time'], e['targetPid']))
+    elif op == 'finish':
+      spawn = open_spawns.pop((pid, e['targetPid']), None)
+      if spawn:
+        span = Span(command_name(spawn['cmdLine']), spawn['time'], e['time'], {'cmdLine': spawn['cmdLine'], 'tid': tid})
+        subprocesses.append((pid, e['targetPid'], span))
+
+  # The subprocess wrappers in toolchain_profiler.py record nested spawns for
+  # the same command (e.g. check_call() calling Popen()). Only keep the
+  # outermost one of each, but with the real process ID that only the
+  # innermost one (Popen) knows about. Note that Popen only records when the
+  # process finishes if communicate() is used.
+  subprocesses.sort(key=lambda x: (x[2].start, -x[2].end))
+  outermost = []
+  open_spans = {}
+  for pid, target_pid, span in subprocesses:
+    key = (pid, span.args['tid'], tuple(span.args['cmdLine']))
+    enclosing = open_spans.get(key)
+    if enclosing and enclosing[2].start <= span.start and span.end <= enclosing[2].end:
+      continue
+    if target_pid < 0:
+      for time, real_pid in real_pids.get(key, []):
+        if span.start <= time <= span.end:
+          target_pid = real_pid
+          break
+    open_spans[key] = (pid, target_pid, span)
+    outermost.append(open_spans[key])
+  return processes, blocks, outermost
+
+
+# Returns a list of dicts with the count and total duration of each distinct
+# name in the given spans, sorted by descending total duration.
+def aggregate_spans(spans):
+  totals = {}
+  for span in spans:
+    entry = totals.setdefault(span.name, {'name': span.name, 'count': 0, 'total': 0})
+    entry['count'] += 1
+    entry['total'] += span.duration
+  for entry in totals.values():
+    entry['total'] = round(entry['total'], 3)
+  return sorted(totals.values(), key=lambda x: -x['total'])
+
+
+# Creates an aggregate report of where the time went across all the profiled
+# tool invocations:
+#  - the total time spent in each profile block and in each spawned tool,
+#  - the critical path through the process/subprocess tree, starting from the
+#    last tool invocation to finish and at each level following the child that
+#    finished last,
+#  - serial phases, i.e. periods where only a single top level tool process
+#    was running.
+def create_report(all_results):
+  processes, blocks, subprocesses = collect_spans(all_results)
+
+  # Build the process tree. A spawned subprocess that was itself profiled is
+  # represented by its own process span.
+  roots = dict(processes)
+  for pid, target_pid, span in subprocesses:
+    if target_pid in processes:
+      span = processes[target_pid]
+      roots.pop(target_pid, None)
+    if pid in processes:
+      processes[pid].children.append(span)
+  roots = sorted(roots.values(), key=lambda x: x.start)
+
+  report = {
+    'wall_time': 0,
+    'process_count': len(processes),
+    'blocks': aggregate_spans(b for _, b in blocks),
+    'tools': aggregate_spans(s for _, _, s in subprocesses),
+    'critical_path': [],
+    'serial_phases': [],
+  }
+  if not roots:
+    return report
+  report['wall_time'] = round(max(r.end for r in roots) - roots[0].start, 3)
+
+  node = max(roots, key=lambda x: x.end)
+  while node:
+    last_child = max(node.children, key=lambda x: x.end) if node.children else None
+    report['critical_path'].append({
+      'name': node.name,
+      'start': round(node.start - roots[0].start, 3),
+      'duration': round(node.duration, 3),
+      'self': round(node.duration - (last_child.duration if last_child else 0), 3),
+    })
+    node = last_child
+
+  # Sweep over the start and end times of the top level processes to find the
+  # periods where only one of them was running.
+  pids = {id(span): pid for pid, span in processes.items()}
+  transitions = sorted([(r.start, 1, r) for r in roots] + [(r.end, -1, r) for r in roots], key=lambda x: (x[0], x[1]))
+  running = set()
+  for i, (t, delta, span) in enumerate(transitions):
+    if delta > 0:
+      running.add(span)
+    else:
+      running.discard(span)
+    if len(running) != 1 or i + 1 >= len(transitions):
+      continue
+    end = transitions[i + 1][0]
+    if end - t < SERIAL_PHASE_MIN_DURATION:
+      continue
+    only = next(iter(running))
+    pid = pids.get(id(only))
+    # Name the leaf blocks of that process that overlapped the phase the most.
+    overlaps = {}
+    for block_pid, block in blocks:
+      if block_pid == pid and block.args['leaf']:
+        overlap = min(block.end, end) - max(block.start, t)
+        if overlap > 0:
+          overlaps[block.name] = overlaps.get(block.name, 0) + overlap
+    report['serial_phases'].append({
+      'start': round(t - roots[0].start, 3),
+      'duration': round(end - t, 3),
+      'process': only.name,
+      'blocks': [{'name': name, 'total': round(total, 3)} for name, total in sorted(overlaps.items(), key=lambda x: -x[1])[:3]],
+    })
+  return report
+
+
+def print_report(report):
+  print(f'Total wall time: {report["wall_time"]:.3f}s across {report["process_count"]} profiled processes.')
+
+  def print_table(title, rows):
+    print(f'\n{title}:')
+    if not rows:
+      print('  (none)')
+    for row in rows:
+      print(f'  {row["total"]:10.3f}s {row["count"]:6d}x  {row["name"]}')
+
+  print_table('Time per profile block', report['blocks'])
+  print_table('Time per spawned tool', report['tools'])
+
+  print('\nCritical path:')
+  for i, step in enumerate(report['critical_path']):
+    print(f'  {"  " * i}{step["name"]}: {step["duration"]:.3f}s (self {step["self"]:.3f}s, starting at {step["start"]:.3f}s)')
+
+  print('\nSerial phases:')
+  if not report['serial_phases']:
+    print('  (none)')
+  for phase in report['serial_phases']:
+    blocks = ', '.join(f'{b["name"]} {b["total"]:.3f}s' for b in phase['blocks'])
+    print(f'  {phase["duration"]:.3f}s at {phase["start"]:.3f}s: only {phase["process"]} running' + (f' ({blocks})' if blocks else ''))
+
+
 def main(args):
   if '--help' in args:
     print('''\
@@ -87,6 +369,20 @@ Optional parameters:
 
         --outfile=x.html (or -o=x.html)
           Specifies the name of the results file to generate.
+
+        --trace-out=x.json
+          Instead of drawing a graph, writes the recorded
+          profiling data in the Trace Event Format, which can be
+          loaded into https://ui.perfetto.dev or chrome://tracing.
+
+        --report
+          Instead of drawing a graph, prints a report of the total
+          time spent per profile block and per spawned tool, the
+          critical path through the process tree, and the serial
+          phases of the build.
+
+        --report-json=x.json
+          Like --report, but writes the report in JSON format.
 ''')
     return 0
 
@@ -95,12 +391,31 @@ Optional parameters:
     return 0
   else:
     outfile = 'toolchain_profiler.results_' + time.strftime('%Y%m%d_%H%M')
+    trace_file = None
+    report_json_file = None
     for i, arg in enumerate(args):
       if arg.startswith(('--outfile=', '-o=')):
         outfile = arg.split('=', 1)[1].strip().replace('.html', '')
       elif arg == '-o':
         outfile = args[i + 1].strip().replace('.html', '')
-    if create_profiling_graph(outfile):
+      elif arg.startswith('--trace-out='):
+        trace_file = arg.split('=', 1)[1].strip()
+      elif arg.startswith('--report-json='):
+        report_json_file = arg.split('=', 1)[1].strip()
+    if trace_file or report_json_file or '--report' in args:
+      all_results = load_profiler_logs()
+      if all_results is None:
+        return 1
+      if trace_file:
+        write_trace_file(trace_file, all_results)
+      if report_json_file or '--report' in args:
+        report = create_report(all_results)
+        if '--report' in args:
+          print_report(report)
+        if report_json_file:
+          Path(report_json_file).write_text(json.dumps(report, indent=2))
+          print(f'Wrote "{report_json_file}"')
+    elif create_profiling_graph(outfile):
       return 1
     if '--no-clear' not in args:
       delete_profiler_logs()
@@ -21,7 +21,7 @@ data downloads.
 
 Usage:
 
-  file_packager TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--separate-metadata] [--lz4] [--use-preload-plugins] [--no-node] [--export-es6] [--help]
+  file_packager TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--separate-metadata] [--lz4] [--compress[=FORMAT]] [--lazy] [--shard-size=N] [--shard-by-directory] [--use-preload-plugins] [--no-node] [--export-es6] [--help]
 
   --preload  ,
   --embed    See emcc --help for more details on those options.
@@ -54,6 +54,23 @@ Usage:
   --lz4 Uses LZ4. This compresses the data using LZ4 when this utility is run, then the client decompresses chunks on the fly, avoiding storing
         the entire decompressed data in memory at once. See LZ4 in src/settings.js, you must build the main program with that flag.
 
+  --compress[=FORMAT] Compresses each preloaded file individually using zlib, where FORMAT is either `deflate` (the default) or `gzip`.
+                      Files that are too small, or that do not compress well, are stored uncompressed. The loader decompresses
+                      the files in parallel using `DecompressionStream`, so no decompressor needs to be linked into the program.
+
+  --lazy Does not download the data file before running the program. Instead, each preloaded file is fetched using an HTTP range
+         request when it is first opened, with adjacent small files fetched together. Synchronous fetching is only possible in
+         web workers and Node.js, so on the main thread files must be fetched in advance using
+         `Module.prefetchLazyFiles(paths)`, where a path ending in `/` matches all files under that directory. The main
+         program must export `FS_createLazyDataFile` (emcc does this automatically for `--lazy-preload-files`).
+
+  --shard-size=N Splits the data file into shards of at most N bytes (unless a single file is larger). Each shard is named after
+                 the hash of its contents (e.g. TARGET.0123456789abcdef.data), the shards are downloaded in parallel, and with
+                 `--use-preload-cache` each shard is cached separately, so that when the package changes only the modified
+                 shards need to be downloaded again. Shards of TARGET left over from earlier runs are removed.
+
+  --shard-by-directory Starts a new shard for each top-level directory in the package. Can be combined with --shard-size.
+
   --use-preload-plugins Tells the file packager to run preload plugins on the files as they are loaded. This performs tasks like decoding images
                         and audio using the browser's codecs.
 
@@ -74,8 +91,10 @@ import hashlib
 import json
 import os
 import posixpath
+import re
 import shutil
 import sys
+import zlib
 from dataclasses import dataclass
 from subprocess import PIPE
 from textwrap import dedent
@@ -91,6 +110,23 @@ from tools.response_file import substitute_response_files
 
 DEBUG = os.environ.get('EMCC_DEBUG')
 
+# Supported values for --compress, mapped to the zlib `wbits` that produce
+# them.  The names match the formats accepted by `DecompressionStream`.
+COMPRESSION_FORMATS = {
+  'deflate': zlib.MAX_WBITS,
+  'gzip': 16 + zlib.MAX_WBITS,
+}
+# Files smaller than this are never compressed, since the overhead of
+# decompressing them outweighs the savings.
+COMPRESS_MIN_SIZE = 1024
+# Compressed data is only used if it is at most this fraction of the original
+# size, which avoids spending time at runtime on already-compressed formats
+# such as images or audio.
+COMPRESS_MAX_RATIO = 0.9
+# With --lazy, adjacent files are fetched together in chunks of up to this
+# size.
+LAZY_CHUNK_SIZE = 1024 * 1024
+
 excluded_patterns: List[str] = []
 new_data_files = []
 walked = []
@@ -118,6 +154,17 @@ class Options:
     # which makes js-output file to mutate on each invocation of this packager tool.
     self.separate_metadata = False
     self.lz4 = False
+    # If set, the name of the format used to compress each preloaded file.
+    self.compress = None
+    # If set to True, preloaded files are fetched on demand using range
+    # requests rather than downloading the whole data file up front.
+    self.lazy = False
+    # If set, the data file is split into content-hashed shards of at most
+    # this many bytes.
+    self.shard_size = None
+    # If set to True, the data file is split into one shard per top-level
+    # directory.
+    self.shard_by_directory = False
     self.use_preload_plugins = False
     self.support_node = True
     self.wasm64 = False
@@ -144,6 +191,21 @@ def base64_encode(b):
   return b64.decode('ascii')
 
 
+def compress_data(data):
+  """Compress `data` in the format selected with --compress.
+
+  Returns None if the data is not worth compressing.
+  """
+  if len(data) < COMPRESS_MIN_SIZE:
+    return None
+  compressor = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED,
+                                COMPRESSION_FORMATS[options.compress])
+  compressed = compressor.compress(data) + compressor.flush()
+  if len(compressed) > len(data) * COMPRESS_MAX_RATIO:
+    return None
+  return compressed
+
+
 def has_hidden_attribute(filepath):
   """Win32 code to test whether the given file has the hidden property set."""
 
@@ -355,7 +417,7 @@ def main():  # noqa: C901, PLR0912, PLR0915
   To revalidate these numbers, run `ruff check --select=C901,PLR091`.
   """
   if len(sys.argv) == 1:
-    err('''Usage: file_packager TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--separate-metadata] [--lz4] [--use-preload-plugins] [--no-node] [--export-es6] [--help]
+    err('''Usage: file_packager TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--separate-metadata] [--lz4] [--compress[=FORMAT]] [--lazy] [--shard-size=N] [--shard-by-directory] [--use-preload-plugins] [--no-node] [--export-es6] [--help]
   Try 'file_packager --help' for more details.''')
     return 1
 
@@ -401,6 +463,25 @@ def main():  # noqa: C901, PLR0912, PLR0915
     elif arg == '--lz4':
       options.lz4 = True
       leading = ''
+    elif arg == '--compress' or arg.startswith('--compress='):
+      options.compress = arg.split('=', 1)[1] if '=' in arg else 'deflate'
+      if options.compress not in COMPRESSION_FORMATS:
+        diagnostics.error(f'invalid --compress format: {options.compress} (expected one of: {", ".join(COMPRESSION_FORMATS)})')
+      leading = ''
+    elif arg == '--lazy':
+      options.lazy = True
+      leading = ''
+    elif arg == '--shard-size' or arg.startswith('--shard-size='):
+      try:
+        options.shard_size = int(arg.split('=', 1)[1])
+      except (IndexError, ValueError):
+        diagnostics.error(f'invalid shard size: {arg}')
+      if options.shard_size <= 0:
+        diagnostics.error(f'invalid shard size: {arg}')
+      leading = ''
+    elif arg == '--shard-by-directory':
+      options.shard_by_directory = True
+      leading = ''
     elif arg == '--use-preload-plugins':
       options.use_preload_plugins = True
       leading = ''
@@ -467,6 +548,21 @@ def main():  # noqa: C901, PLR0912, PLR0915
     diagnostics.warn('Remember to build the main file with `-sFORCE_FILESYSTEM` '
         'so that it includes support for loading this file package')
 
+  if options.compress and options.lz4:
+    diagnostics.error('--compress cannot be used together with --lz4')
+
+  if options.lazy:
+    for flag, enabled in (('--lz4', options.lz4), ('--compress', options.compress),
+                          ('--use-preload-cache', options.use_preload_cache),
+                          ('--use-preload-plugins', options.use_preload_plugins)):
+      if enabled:
+        diagnostics.error(f'--lazy cannot be used together with {flag}')
+
+  if is_sharded():
+    for flag, enabled in (('--lz4', options.lz4), ('--lazy', options.lazy)):
+      if enabled:
+        diagnostics.error(f'sharding cannot be used together with {flag}')
+
   if options.jsoutput and os.path.abspath(options.jsoutput) == os.path.abspath(data_target):
     diagnostics.error('TARGET should not be the same value of --js-output')
 
@@ -599,6 +695,435 @@ def escape_for_makefile(fpath):
   return fpath.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
 
 
+def is_sharded():
+  return bool(options.shard_size or options.shard_by_directory)
+
+
+def read_stored_data(file_):
+  """Returns the data of `file_` as it is stored in the data file, and sets
+  `file_.codec` to the format that it was compressed with (if any)."""
+  file_.codec = None
+  data = utils.read_binary(file_.srcpath)
+  if options.compress and file_.mode == 'preload':
+    compressed = compress_data(data)
+    if compressed is not None:
+      file_.codec = options.compress
+      data = compressed
+  return data
+
+
+def get_shard_name(data_target, digest):
+  root, ext = os.path.splitext(data_target)
+  return f'{root}.{digest[:16]}{ext}'
+
+
+def write_data_files(data_target, data_files):
+  """Writes the data of `data_files` to `data_target`, or when sharding to
+  content-hashed shards named after it, and sets the offsets of each file in
+  the data.  File offsets are always relative to the whole data, even when it
+  is split into shards.
+
+  Returns the total size of the data and the list of shards.
+  """
+  start = 0
+  shards = []
+  shard_path = data_target + '.tmp' if is_sharded() else data_target
+  shard_start = 0
+  shard_dir = None
+  shard_hash = None
+  data = open(shard_path, 'wb')
+
+  def finish_shard():
+    data.close()
+    if shard_hash:
+      shard_name = get_shard_name(data_target, shard_hash.hexdigest())
+      os.replace(shard_path, shard_name)
+      shards.append({
+        'name': os.path.basename(shard_name),
+        'start': shard_start,
+        'end': start,
+        'hash': 'sha256-' + shard_hash.hexdigest(),
+      })
+
+  for file_ in data_files:
+    curr = read_stored_data(file_)
+    if is_sharded():
+      # Shards are split by the size of the data as stored, i.e. after
+      # compression.
+      top_dir = file_.dstpath.lstrip('/').split('/')[0]
+      shard_size = start - shard_start
+      if (not shard_hash or
+          (options.shard_by_directory and top_dir != shard_dir) or
+          (options.shard_size and shard_size + len(curr) > options.shard_size and shard_size)):
+        if shard_hash:
+          finish_shard()
+          data = open(shard_path, 'wb')
+        shard_start = start
+        shard_dir = top_dir
+        shard_hash = hashlib.sha256()
+      shard_hash.update(curr)
+    file_.data_start = start
+    file_.data_end = start + len(curr)
+    start += len(curr)
+    data.write(curr)
+  finish_shard()
+  if is_sharded():
+    utils.delete_file(shard_path)
+    remove_stale_shards(data_target, shards)
+  return start, shards
+
+
+def remove_stale_shards(data_target, shards):
+  """Removes the shards of `data_target` that were written by earlier builds
+  and are not used anymore."""
+  root, ext = os.path.splitext(os.path.basename(data_target))
+  shard_re = re.compile(re.escape(root) + r'\.[0-9a-f]{16}' + re.escape(ext))
+  used = {shard['name'] for shard in shards}
+  dirname = os.path.dirname(data_target) or '.'
+  for name in os.listdir(dirname):
+    if name not in used and shard_re.fullmatch(name):
+      utils.delete_file(os.path.join(dirname, name))
+
+
+def get_lazy_chunks(data_files):
+  """Groups adjacent preloaded files into the chunks fetched with --lazy.
+
+  Small files are coalesced so that they can be fetched using a single range
+  request.  Returns a list of `[start, end]` byte ranges in the data file, and
+  sets `chunk` on each preloaded file to the index of the chunk containing it.
+  """
+  chunks = []
+  for file_ in data_files:
+    if file_.mode != 'preload':
+      continue
+    if chunks and chunks[-1][1] == file_.data_start and file_.data_end - chunks[-1][0] <= LAZY_CHUNK_SIZE:
+      chunks[-1][1] = file_.data_end
+    else:
+      chunks.append([file_.data_start, file_.data_end])
+    file_.chunk = len(chunks) - 1
+  return chunks
+
+
+def get_directory_tree(data_files):
+  """Returns the list of directories that need to be created for `data_files`.
+
+  Each directory is encoded as a `[parent, name]` pair, where `parent` is the
+  index of the parent directory in the list, or -1 for the root.  Parents
+  always precede their children, so the list can be created in order.
+  """
+  directories = []
+  indexes = {'': -1}
+  for file_ in data_files:
+    dirname = os.path.dirname(file_.dstpath).lstrip('/') # absolute paths start with '/', remove that
+    if dirname in indexes:
+      continue
+    parent = ''
+    for part in dirname.split('/'):
+      partial = parent + '/' + part if parent else part
+      if partial not in indexes:
+        indexes[partial] = len(directories)
+        directories.append([indexes[parent], part])
+      parent = partial
+  return directories
+
+
+def generate_shard_fetching_code():
+  """Generates `fetchShards`, which fetches all shards of the data file in
+  parallel and returns the whole archive.
+
+  With --use-preload-cache each shard is cached in IndexedDB under its own
+  hash, and `updateCachedShards` removes shards that are no longer used.
+  """
+  cache_lookup_code = ''
+  cache_store_code = ''
+  cache_update_code = ''
+  if options.use_preload_cache:
+    cache_lookup_code = '''
+          if (db) {
+            try {
+              var cachedMetadata = await checkCachedPackage(db, cacheName, shard['hash']);
+              if (cachedMetadata) {
+                data = await fetchCachedPackage(db, cacheName, cachedMetadata);
+                cachedShards++;
+              }
+            } catch (e) {
+              console.error(e);
+            }
+          }'''
+    cache_store_code = '''
+            if (db) {
+              try {
+                await cacheRemotePackage(db, cacheName, data, {uuid: shard['hash']});
+              } catch (e) {
+                console.error(e);
+              }
+            }'''
+    cache_update_code = '''
+        Module['preloadResults'][PACKAGE_NAME] = {fromCache: cachedShards == shards.length, cachedShards};'''
+
+  code = '''
+      async function fetchShards(db) {
+        var shards = metadata['shards'];
+        var packageData = new Uint8Array(REMOTE_PACKAGE_SIZE);
+        var cachedShards = 0;
+        await Promise.all(shards.map(async (shard) => {
+          var name = Module['locateFile']?.(shard['name'], '') ?? shard['name'];
+          var size = shard['end'] - shard['start'];
+          var cacheName = `shard/${shard['hash']}`;
+          var data = Module['getPreloadedPackage']?.(name, size);%(cache_lookup_code)s
+          if (!data) {
+            data = await fetchRemotePackage(name, size);%(cache_store_code)s
+          }
+          packageData.set(new Uint8Array(data), shard['start']);
+        }));%(cache_update_code)s
+        return packageData.buffer;
+      }\n''' % {
+    'cache_lookup_code': cache_lookup_code,
+    'cache_store_code': cache_store_code,
+    'cache_update_code': cache_update_code,
+  }
+
+  if options.use_preload_cache:
+    code += '''
+      // Records the shards used by this package, and removes shards that were
+      // used by a previous version of it from the cache.
+      async function updateCachedShards(db, packageName) {
+        var hashes = metadata['shards'].map((shard) => shard['hash']);
+        var transaction = db.transaction([METADATA_STORE_NAME, PACKAGE_STORE_NAME], IDB_RW);
+        var metadataStore = transaction.objectStore(METADATA_STORE_NAME);
+        var packages = transaction.objectStore(PACKAGE_STORE_NAME);
+        var getRequest = metadataStore.get(`shards/${packageName}`);
+        return new Promise((resolve, reject) => {
+          getRequest.onsuccess = (event) => {
+            for (var hash of event.target.result?.['hashes'] ?? []) {
+              if (!hashes.includes(hash)) {
+                metadataStore.delete(`metadata/shard/${hash}`);
+                packages.delete(IDBKeyRange.bound(`package/shard/${hash}/`, `package/shard/${hash}/\\uffff`));
+              }
+            }
+            metadataStore.put({'hashes': hashes}, `shards/${packageName}`);
+          };
+          transaction.oncomplete = resolve;
+          transaction.onerror = reject;
+        });
+      }\n'''
+  return code
+
+
+def generate_package_fetching_code(catch_handler):
+  """Generates the code that fetches the data file (or its shards), from the
+  preload cache if enabled, and passes it to `processPackageData`.
+
+  Returns the code to run as soon as the package is loaded, so that the fetch
+  can start early, and the code to run once the file system is ready.
+  """
+  ret = ''
+  code = ''
+  if is_sharded():
+    shard_code = generate_shard_fetching_code()
+    # With the preload cache, fetching shards needs the IndexedDB helpers,
+    # otherwise it is started as early as possible, as below.
+    if options.use_preload_cache:
+      code += shard_code
+    else:
+      ret += shard_code
+
+  if options.use_preload_cache and is_sharded():
+    code += '''
+        async function preloadFallback(error) {
+          console.error(error);
+          console.error('falling back to default preload behavior');
+          return fetchShards();
+        }
+
+        Module['setStatus']?.('Downloading...');
+        var packageData;
+        try {
+          var db = await openDatabase();
+          packageData = await fetchShards(db);
+          updateCachedShards(db, PACKAGE_PATH + PACKAGE_NAME).catch((e) => console.error(e));
+        } catch (e) {
+          packageData = await preloadFallback(e);
+        }
+        // Errors in processing the data are not retried, but are reported
+        // (and reject the returned promise, if any) by the caller of runWithFS.
+        await processPackageData(packageData);\n'''
+  elif options.use_preload_cache:
+    code += '''
+        async function preloadFallback(error) {
+          console.error(error);
+          console.error('falling back to default preload behavior');
+          return fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE);
+        }
+
+        var packageData;
+        try {
+          var db = await openDatabase();
+          var pkgMetadata = await checkCachedPackage(db, PACKAGE_PATH + PACKAGE_NAME);
+          var useCached = !!pkgMetadata;
+          Module['preloadResults'][PACKAGE_NAME] = {fromCache: useCached};
+          if (useCached) {
+            packageData = await fetchCachedPackage(db, PACKAGE_PATH + PACKAGE_NAME, pkgMetadata);
+          } else {
+            packageData = await fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE);
+            try {
+              packageData = await cacheRemotePackage(db, PACKAGE_PATH + PACKAGE_NAME, packageData, {uuid:PACKAGE_UUID});
+            } catch (error) {
+              console.error(error);
+            }
+          }
+        } catch(e) {
+          packageData = await preloadFallback(e);
+        }
+
+        Module['setStatus']?.('Downloading...');
+        // Errors in processing the data are not retried, but are reported
+        // (and reject the returned promise, if any) by the caller of runWithFS.
+        await processPackageData(packageData);\n'''
+  else:
+    # Not using preload cache, so we might as well start the xhr ASAP,
+    # potentially before JS parsing of the main codebase if it's after us.
+    # Only tricky bit is the fetch is async, but also when runWithFS is called
+    # is async, so we handle both orderings.
+    if is_sharded():
+      ret += '''
+      var fetched;
+      // Note that we don't use await here because we want to execute the
+      // the rest of this function immediately.
+      var fetchPromise = fetchShards()%s;\n''' % catch_handler
+    else:
+      ret += '''
+      var fetchPromise;
+      var fetched = Module['getPreloadedPackage']?.(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE);
+
+      if (!fetched) {
+        // Note that we don't use await here because we want to execute the
+        // the rest of this function immediately.
+        fetchPromise = fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE)%s;
+      }\n''' % catch_handler
+
+    code += '''
+      Module['preloadResults'][PACKAGE_NAME] = {fromCache: false};
+      if (!fetched) {
+        fetched = await fetchPromise;
+      }
+      await processPackageData(fetched);\n'''
+  return ret, code
+
+
+def generate_lazy_loading_code(use_data):
+  """Generates the code used by --lazy to fetch files when they are opened."""
+  node_read_code = ''
+  if options.support_node:
+    node_read_code = '''
+        if (isNode) {
+          var fs = require('fs');
+          var fd = fs.openSync(REMOTE_PACKAGE_NAME, 'r');
+          var data = new Uint8Array(end - start);
+          fs.readSync(fd, data, 0, data.length, start);
+          fs.closeSync(fd);
+          return data;
+        }'''
+  node_prefetch_code = ''
+  if options.support_node:
+    node_prefetch_code = '''
+        if (isNode) {
+          return readRangeSync(start, end);
+        }'''
+
+  code = '''
+      // Files are fetched when they are first opened, using range requests
+      // for the chunk of the package that contains them.
+      var chunks = metadata['chunks'];
+      var chunkData = [];
+      // The number of files in each chunk that have not been opened yet.  Once
+      // this drops to zero, the chunk no longer needs to be cached.
+      var chunkPending = chunks.map(() => 0);
+      // Set if the server ignored a range request and sent the whole package.
+      var packageData;
+
+      function getRangeResponse(status, buffer, start, end) {
+        if (status == 200) {
+          packageData = new Uint8Array(buffer);
+          return packageData.subarray(start, end);
+        }
+        if (status != 206) {
+          throw new Error(`${status}: ${REMOTE_PACKAGE_NAME}`);
+        }
+        return new Uint8Array(buffer);
+      }
+
+      function readRangeSync(start, end) {
+        if (packageData || start == end) {
+          return packageData ? packageData.subarray(start, end) : new Uint8Array();
+        }%(node_read_code)s
+        assert(typeof XMLHttpRequest != 'undefined' && typeof window == 'undefined', 'lazily loaded files can only be fetched synchronously in web workers, use `Module.prefetchLazyFiles` to fetch them in advance');
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', REMOTE_PACKAGE_NAME, false);
+        xhr.responseType = 'arraybuffer';
+        xhr.setRequestHeader('Range', `bytes=${start}-${end - 1}`);
+        xhr.send(null);
+        return getRangeResponse(xhr.status, xhr.response, start, end);
+      }
+
+      async function readRange(start, end) {
+        if (packageData || start == end) {
+          return readRangeSync(start, end);
+        }%(node_prefetch_code)s
+        var response = await fetch(REMOTE_PACKAGE_NAME, {headers: {'Range': `bytes=${start}-${end - 1}`}});
+        return getRangeResponse(response.status, await response.arrayBuffer(), start, end);
+      }
+
+      async function prefetchChunks(indexes) {
+        // Fetch each run of adjacent chunks using a single request.
+        var runs = [];
+        for (var i of [...new Set(indexes)].sort((a, b) => a - b)) {
+          if (chunkData[i] || !chunkPending[i]) continue;
+          var run = runs.at(-1);
+          if (run && run[1] == i - 1) {
+            run[1] = i;
+          } else {
+            runs.push([i, i]);
+          }
+        }
+        await Promise.all(runs.map(async ([first, last]) => {
+          var start = chunks[first][0];
+          var data = await readRange(start, chunks[last][1]);
+          for (var i = first; i <= last; i++) {
+            chunkData[i] ??= data.subarray(chunks[i][0] - start, chunks[i][1] - start);
+          }
+        }));
+      }
+
+      function getFileContents(file) {
+        var i = file['chunk'];
+        var data = chunkData[i] ?? readRangeSync(chunks[i][0], chunks[i][1]);
+        chunkData[i] = --chunkPending[i] ? data : undefined;
+        var start = file['start'] - chunks[i][0];
+        return data.subarray(start, start + file['end'] - file['start']);
+      }
+
+      var files = metadata['files'];
+      for (var file of files) {
+        chunkPending[file['chunk']]++;
+      }
+      for (let file of files) {
+        Module['FS_createLazyDataFile'](file['filename'], null, file['end'] - file['start'], () => getFileContents(file), true, true);
+      }
+
+      (Module['lazyFilePrefetchers'] ??= []).push((paths) => {
+        var matches = (filename) => paths.some((path) => path.endsWith('/') ? filename.startsWith(path) : filename == path);
+        return prefetchChunks(files.filter((file) => matches(file['filename'])).map((file) => file['chunk']));
+      });
+      Module['prefetchLazyFiles'] ??= (paths) => Promise.all(Module['lazyFilePrefetchers'].map((prefetch) => prefetch(paths)));\n''' % {
+    'node_read_code': node_read_code,
+    'node_prefetch_code': node_prefetch_code,
+  }
+  if use_data:
+    code += '      %s\n' % use_data.strip()
+  return code
+
+
 def generate_js(data_target, data_files, metadata):
   # emcc will add this to the output itself, so it is only needed for
   # standalone calls
@@ -645,30 +1170,22 @@ def generate_js(data_target, data_files, metadata):
       }\n'''
 
   # Set up folders
-  partial_dirs = []
-  for file_ in data_files:
-    dirname = os.path.dirname(file_.dstpath)
-    dirname = dirname.lstrip('/') # absolute paths start with '/', remove that
-    if dirname != '':
-      parts = dirname.split('/')
-      for i in range(len(parts)):
-        partial = '/'.join(parts[:i + 1])
-        if partial not in partial_dirs:
-          code += ('''Module['FS_createPath'](%s, %s, true, true);\n'''
-                   % (json.dumps('/' + '/'.join(parts[:i])), json.dumps(parts[i])))
-          partial_dirs.append(partial)
+  metadata['directories'] = get_directory_tree(data_files)
+  code += '''
+      var directoryPaths = [];
+      for (var [parent, name] of metadata['directories']) {
+        var parentPath = parent < 0 ? '/' : directoryPaths[parent];
+        Module['FS_createPath'](parentPath, name, true, true);
+        directoryPaths.push(`${parent < 0 ? '' : parentPath}/${name}`);
+      }\n'''
 
   if options.has_preloaded:
     # Bundle all datafiles into one archive. Avoids doing lots of simultaneous
-    # XHRs which has overhead.
-    start = 0
-    with open(data_target, 'wb') as data:
-      for file_ in data_files:
-        file_.data_start = start
-        curr = utils.read_binary(file_.srcpath)
-        file_.data_end = start + len(curr)
-        start += len(curr)
-        data.write(curr)
+    # XHRs which has overhead.  When sharding, the archive is split into
+    # several files, but file offsets are still relative to the whole archive.
+    start, shards = write_data_files(data_target, data_files)
+    if shards:
+      metadata['shards'] = shards
 
     if start > 256 * 1024 * 1024:
       diagnostics.warn('file packager is creating an asset bundle of %d MB. '
@@ -690,7 +1207,7 @@ def generate_js(data_target, data_files, metadata):
 
     finish_handler = create_preloaded if options.use_preload_plugins else create_data
 
-    if not options.lz4:
+    if not options.lz4 and not options.lazy:
       # Data requests - for getting a block of data out of the big archive - have
       # a similar API to XHRs
       code += '''
@@ -709,6 +1226,9 @@ def generate_js(data_target, data_files, metadata):
           loadDataReject(error);
         })'''
 
+  if options.lazy:
+    metadata['chunks'] = get_lazy_chunks(data_files)
+
   for counter, file_ in enumerate(data_files):
     filename = file_.dstpath
     dirname = os.path.dirname(filename)
@@ -723,16 +1243,44 @@ def generate_js(data_target, data_files, metadata):
                  % (dirname, basename, counter))
     elif file_.mode == 'preload':
       # Preload
-      metadata['files'].append({
+      file_metadata = {
         'filename': file_.dstpath,
         'start': file_.data_start,
         'end': file_.data_end,
-      })
+      }
+      if file_.codec:
+        file_metadata['codec'] = file_.codec
+      if options.lazy:
+        file_metadata['chunk'] = file_.chunk
+      metadata['files'].append(file_metadata)
     else:
       assert 0
 
   if options.has_preloaded:
-    if not options.lz4:
+    if options.lazy:
+      # Nothing needs to be done once the metadata is loaded, since files are
+      # fetched when they are first opened.
+      use_data = ''
+    elif options.compress:
+      # Compressed files are decompressed in parallel, and uncompressed files
+      # still reuse the bytearray from the XHR, as below.
+      code += '''
+      async function decompressData(data, codec) {
+        assert(typeof DecompressionStream != 'undefined', 'DecompressionStream is not available, which is needed to load packages created with --compress');
+        var stream = new Blob([data]).stream().pipeThrough(new DecompressionStream(codec));
+        return new Uint8Array(await new Response(stream).arrayBuffer());
+      }\n'''
+      use_data = '''await Promise.all(metadata['files'].map(async (file) => {
+            var name = file['filename'];
+            var data = byteArray.subarray(file['start'], file['end']);
+            if (file['codec']) {
+              data = await decompressData(data, file['codec']);
+            }
+            %s
+          }));
+          Module['removeRunDependency']('datafile_%s');''' % (finish_handler,
+                                                              js_manipulation.escape_for_js_string(data_target))
+    elif not options.lz4:
       # Get the big archive and split it up
       use_data = '''// Reuse the bytearray from the XHR as the source for file reads.
           for (var file of metadata['files']) {
@@ -759,7 +1307,7 @@ def generate_js(data_target, data_files, metadata):
       use_data += '\nloadDataResolve();'
 
     package_name = data_target
-    remote_package_size = os.path.getsize(package_name)
+    remote_package_size = start if is_sharded() else os.path.getsize(package_name)
     remote_package_name = os.path.basename(package_name)
     ret += '''
       var PACKAGE_PATH = '';
@@ -775,13 +1323,17 @@ def generate_js(data_target, data_files, metadata):
     metadata['remote_package_size'] = remote_package_size
     ret += "      var REMOTE_PACKAGE_SIZE = metadata['remote_package_size'];\n"
 
-    if options.use_preload_cache:
+  if options.has_preloaded and options.lazy:
+    code += generate_lazy_loading_code(use_data)
+  elif options.has_preloaded:
+    if options.use_preload_cache and not is_sharded():
       # Set the id to a hash of the preloaded data, so that caches survive over multiple builds
       # if the data has not changed.
       data = utils.read_binary(data_target)
       package_uuid = 'sha256-' + hashlib.sha256(data).hexdigest()
       metadata['package_uuid'] = str(package_uuid)
 
+    if options.use_preload_cache:
       code += r'''
         var PACKAGE_UUID = metadata['package_uuid'];
         var IDB_RO = "readonly";
@@ -868,14 +1420,14 @@ def generate_js(data_target, data_files, metadata):
          * Check if there's a cached package, and if so whether it's the latest available.
          * Resolves to the cached metadata, or `null` if it is missing or out-of-date.
          */
-        async function checkCachedPackage(db, packageName) {
+        async function checkCachedPackage(db, packageName, packageUuid = PACKAGE_UUID) {
           var transaction = db.transaction([METADATA_STORE_NAME], IDB_RO);
           var metadata = transaction.objectStore(METADATA_STORE_NAME);
           var getRequest = metadata.get(`metadata/${packageName}`);
           return new Promise((resolve, reject) => {
             getRequest.onsuccess = (event) => {
               var result = event.target.result;
-              if (result && PACKAGE_UUID === result['uuid']) {
+              if (result && packageUuid === result['uuid']) {
                 resolve(result);
               } else {
                 resolve(null);
@@ -1006,57 +1558,14 @@ def generate_js(data_target, data_files, metadata):
     code += '''
       Module['preloadResults'] ??= {};\n'''
 
-    if options.use_preload_cache:
-      code += '''
-        async function preloadFallback(error) {
-          console.error(error);
-          console.error('falling back to default preload behavior');
-          processPackageData(await fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE));
-        }
-
-        try {
-          var db = await openDatabase();
-          var pkgMetadata = await checkCachedPackage(db, PACKAGE_PATH + PACKAGE_NAME);
-          var useCached = !!pkgMetadata;
-          Module['preloadResults'][PACKAGE_NAME] = {fromCache: useCached};
-          if (useCached) {
-            processPackageData(await fetchCachedPackage(db, PACKAGE_PATH + PACKAGE_NAME, pkgMetadata));
-          } else {
-            var packageData = await fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE);
-            try {
-              processPackageData(await cacheRemotePackage(db, PACKAGE_PATH + PACKAGE_NAME, packageData, {uuid:PACKAGE_UUID}))
-            } catch (error) {
-              console.error(error);
-              processPackageData(packageData);
-            }
-          }
-        } catch(e) {
-          await preloadFallback(e)%s;
-        }
-
-        Module['setStatus']?.('Downloading...');\n''' % catch_handler
-    else:
-      # Not using preload cache, so we might as well start the xhr ASAP,
-      # potentially before JS parsing of the main codebase if it's after us.
-      # Only tricky bit is the fetch is async, but also when runWithFS is called
-      # is async, so we handle both orderings.
-      ret += '''
-      var fetchPromise;
-      var fetched = Module['getPreloadedPackage']?.(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE);
-
-      if (!fetched) {
-        // Note that we don't use await here because we want to execute the
-        // the rest of this function immediately.
-        fetchPromise = fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE)%s;
-      }\n''' % catch_handler
-
-      code += '''
-      Module['preloadResults'][PACKAGE_NAME] = {fromCache: false};
-      if (!fetched) {
-        fetched = await fetchPromise;
-      }
-      processPackageData(fetched);\n'''
+    fetch_ret, fetch_code = generate_package_fetching_code(catch_handler)
+    ret += fetch_ret
+    code += fetch_code
 
+  # Errors are handled the same way when runWithFS is called later on.
+  run_with_fs = 'runWithFS'
+  if catch_handler:
+    run_with_fs = '(Module) => runWithFS(Module)' + catch_handler
   ret += '''
     async function runWithFS(Module) {\n'''
   ret += code
@@ -1065,8 +1574,8 @@ def generate_js(data_target, data_files, metadata):
     if (Module['calledRun']) {
       runWithFS(Module)%s;
     } else {
-      (Module['preRun'] ??= []).push(runWithFS); // FS is not initialized yet, wait for it
-    }\n''' % catch_handler
+      (Module['preRun'] ??= []).push(%s); // FS is not initialized yet, wait for it
+    }\n''' % (catch_handler, run_with_fs)
 
   if options.separate_metadata:
     node_support_code = ''
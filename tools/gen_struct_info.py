@@ -52,6 +52,14 @@ The JSON input format is as follows:
 
 Please note that the 'f' for 'FLOAT_DEFINE' is just the format passed to printf(), you can put
 anything printf() understands.
+
+By default the values are found by compiling and running a program that prints
+them.  With --object they are instead read from the data section of a compiled
+object file, which avoids linking and running the program.
+
+Results are cached (in the emscripten cache) keyed by the generated code, the
+compiler flags and the compiler, and are only reused if none of the headers
+that were included have changed since.
 """
 
 import sys
@@ -59,19 +67,26 @@ import os
 import re
 import json
 import argparse
+import hashlib
+import struct
 import tempfile
 import shlex
 import subprocess
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
 __scriptdir__ = os.path.dirname(os.path.abspath(__file__))
 __rootdir__ = os.path.dirname(__scriptdir__)
 sys.path.insert(0, __rootdir__)
 
 from tools import building
+from tools import cache
+from tools import config
+from tools import filelock
 from tools import shared
 from tools import system_libs
 from tools import utils
+from tools import webassembly
 
 QUIET = (__name__ != '__main__')
 DEBUG = False
@@ -102,6 +117,12 @@ DEFAULT_JSON_FILES = [
 ]
 
 
+# Markers for the start of the arrays of values in the object file, see
+# generate_data_code.
+INT_MAGIC = 0x6f666e695f746375
+FLOAT_MAGIC = 123456789.125
+
+
 def show(msg):
   if shared.DEBUG or not QUIET:
     sys.stderr.write('gen_struct_info: %s\n' % msg)
@@ -115,8 +136,13 @@ def show(msg):
 #     scope.set('item2', '%f', '4.2') # generates code that outputs ',\n"item2": 4.2'
 #   # once the scope is exited, it generates code that outputs the end of the JSON object '\n}'
 class Scope:
-  def __init__(self, code: typing.List[str]):
+  def __init__(self, code: typing.List[str], values: list, obj: dict):
     self.code = code
+    # The values that the generated code outputs, as a list of
+    # (dict, key, format, C expression) tuples, which is used to generate the
+    # equivalent code for --object.
+    self.values = values
+    self.obj = obj
     self.has_data = False
 
   def __enter__(self):
@@ -136,13 +162,15 @@ class Scope:
     if '::' in name:
       name = name.split('::', 1)[1]
     self.code.append(fr'printf("\"{name}\": ");')
+    return name
 
   def child(self, name: str):
-    self._start_child(name)
-    return Scope(self.code)
+    name = self._start_child(name)
+    self.obj[name] = {}
+    return Scope(self.code, self.values, self.obj[name])
 
   def set(self, name: str, type_: str, value: str):
-    self._start_child(name)
+    name = self._start_child(name)
 
     assert type_.startswith('%')
     # We only support numeric defines as they are directly compatible with JSON.
@@ -150,6 +178,7 @@ class Scope:
     assert type_[-1] in {'d', 'i', 'u', 'f', 'F', 'e', 'E'}
 
     self.code.append(f'printf("{type_}", {value});')
+    self.values.append((self.obj, name, type_, value))
 
   def gen_inspect_code(self, path: typing.List[str], struct: typing.List[typing.Union[str, dict]]):
     if path[0][-1] == '#':
@@ -173,13 +202,18 @@ class Scope:
 
 
 def generate_c_code(headers):
+  """Returns the code of a program that prints the info about the given headers
+  as JSON, and the info with the values that the program prints missing, along
+  with a list of those values (see Scope)."""
   code = ['#include <stdio.h>', '#include <stddef.h>']
 
   code.extend(f'''#include "{header['name']}"''' for header in headers)
 
   code.append('int main() {')
 
-  with Scope(code) as root:
+  info: typing.Dict[str, dict] = {}
+  values: list = []
+  with Scope(code, values, info) as root:
     with root.child('structs') as structs:
       for header in headers:
         for name, struct in header['structs'].items():
@@ -199,17 +233,83 @@ def generate_c_code(headers):
   code.append('return 0;')
   code.append('}')
 
+  return code, info, values
+
+
+def is_float_format(type_):
+  return type_[-1] in 'fFeE'
+
+
+def get_c_type(type_):
+  """Returns the C type that printf reads for the given format."""
+  length = re.sub(r'[-+ #0-9.]', '', type_[1:-1])
+  if type_[-1] == 'u':
+    types = {'': 'unsigned int', 'hh': 'unsigned char', 'h': 'unsigned short', 'l': 'unsigned long',
+             'll': 'unsigned long long', 'j': 'uintmax_t', 'z': 'size_t', 't': 'size_t'}
+  else:
+    types = {'': 'int', 'hh': 'signed char', 'h': 'short', 'l': 'long',
+             'll': 'long long', 'j': 'intmax_t', 'z': 'ptrdiff_t', 't': 'ptrdiff_t'}
+  if length not in types:
+    raise Exception(f'unsupported format for --object: {type_}')
+  return types[length]
+
+
+def generate_data_code(headers, values):
+  """Returns code that stores the given values in two arrays, one for integers
+  and one for floating point values, each starting with a marker value so that
+  it can be found in the object file.  The values are converted to the type that
+  printf would read them as."""
+  code = ['#include <stddef.h>', '#include <stdint.h>']
+  code.extend(f'''#include "{header['name']}"''' for header in headers)
+
+  ints = [f'{INT_MAGIC:#x}ull']
+  floats = [repr(FLOAT_MAGIC)]
+  for _, _, type_, value in values:
+    if is_float_format(type_):
+      floats.append(f'(double)({value})')
+    else:
+      # Some defines are pointers (e.g. PTHREAD_CANCELED), which can only be
+      # converted to a smaller integer type via an integer type of at least
+      # their size.
+      value = f'({get_c_type(type_)})(uintmax_t)({value})'
+      if type_[-1] != 'u':
+        value = f'(long long){value}'
+      ints.append(f'(unsigned long long){value}')
+
+  code.append('__attribute__((used)) unsigned long long struct_info_ints[] = {')
+  code.extend(f'  {v},' for v in ints)
+  code.append('};')
+  code.append('__attribute__((used)) double struct_info_floats[] = {')
+  code.extend(f'  {v},' for v in floats)
+  code.append('};')
   return code
 
 
+def read_data_values(obj_file, values):
+  """Reads the values stored by the code from generate_data_code from the data
+  section of the object file, and sets them in the info."""
+  with webassembly.Module(obj_file) as module:
+    data = b''.join(module.read_at(seg.offset, seg.size) for seg in module.get_segments())
+
+  int_offset = data.index(INT_MAGIC.to_bytes(8, 'little')) + 8
+  float_offset = data.index(struct.pack('<d', FLOAT_MAGIC)) + 8
+  for obj, name, type_, _ in values:
+    if is_float_format(type_):
+      value = struct.unpack('<d', data[float_offset:float_offset + 8])[0]
+      float_offset += 8
+      # Round the value in the same way as printing it would.
+      python_format = re.sub('(hh|h|ll|l|j|z|t)', '', type_)
+      obj[name] = float(python_format % value)
+    else:
+      obj[name] = int.from_bytes(data[int_offset:int_offset + 8], 'little', signed=type_[-1] != 'u')
+      int_offset += 8
+
+
 def generate_cmd(js_file_path, src_file_path, cflags):
   # Compile the program.
   show('Compiling generated code...')
 
-  if any('libcxxabi' in f for f in cflags):
-    compiler = shared.EMXX
-  else:
-    compiler = shared.EMCC
+  compiler = get_compiler(cflags)
 
   node_flags = building.get_emcc_node_flags(shared.check_node_version())
 
@@ -236,19 +336,82 @@ def generate_cmd(js_file_path, src_file_path, cflags):
   return cmd
 
 
-def inspect_headers(headers, cflags):
+def generate_object_cmd(obj_file_path, src_file_path, cflags):
+  show('Compiling generated code to an object file...')
+  cmd = [get_compiler(cflags)] + cflags + ['-c', '-o', obj_file_path, src_file_path,
+                                           '-O0',
+                                           '-Werror',
+                                           '-Wno-error=version-check',
+                                           '-Wno-deprecated']
+  show(shlex.join(cmd))
+  return cmd
+
+
+def get_compiler(cflags):
+  if any('libcxxabi' in f for f in cflags):
+    return shared.EMXX
+  else:
+    return shared.EMCC
+
+
+def parse_deps_file(deps_file):
+  """Returns the list of files from a make style dependency file."""
+  deps = utils.read_file(deps_file).replace('\\\n', ' ')
+  deps = deps.split(': ', 1)[1]
+  return [d.replace('\\ ', ' ') for d in re.split(r'(?<!\\)\s+', deps) if d]
+
+
+def hash_file(filename):
+  return hashlib.sha256(utils.read_binary(filename)).hexdigest()
+
+
+@utils.memoize
+def get_compiler_identity():
+  clang = os.stat(shared.CLANG_CC)
+  return [utils.EMSCRIPTEN_VERSION, shared.get_clang_version(), clang.st_size, clang.st_mtime_ns, hash_file(__file__)]
+
+
+def inspect_headers(headers, cflags, from_object, use_cache):
+  code, info, values = generate_c_code(headers)
+  if from_object:
+    code = generate_data_code(headers, values)
+
+  if use_cache:
+    # Relative include paths (e.g. -I.) depend on the working directory
+    key = json.dumps([get_compiler_identity(), from_object, os.getcwd(), cflags, code])
+    cache_file = str(cache.get_path(os.path.join('struct_info', hashlib.sha256(key.encode()).hexdigest() + '.json')))
+    utils.safe_ensure_dirs(os.path.dirname(cache_file))
+    with filelock.FileLock(cache_file + '.lock'):
+      if os.path.exists(cache_file):
+        cached = json.loads(utils.read_file(cache_file))
+        if all(os.path.exists(f) and hash_file(f) == h for f, h in cached['deps'].items()):
+          show('Using cached results from ' + cache_file)
+          return cached['info']
+      info, deps = compile_and_inspect(code, info, values, cflags, from_object)
+      utils.write_file(cache_file, json.dumps({'deps': {f: hash_file(f) for f in deps}, 'info': info}))
+      return info
+
+  return compile_and_inspect(code, info, values, cflags, from_object)[0]
+
+
+def compile_and_inspect(code, info, values, cflags, from_object):
+  """Returns the info and the list of headers that were included."""
   # Write the source code to a temporary file.
   src_file_fd, src_file_path = tempfile.mkstemp('.c', text=True)
   show('Generating C code... ' + src_file_path)
-  code = generate_c_code(headers)
   os.write(src_file_fd, '\n'.join(code).encode())
   os.close(src_file_fd)
 
-  js_file_fd, js_file_path = tempfile.mkstemp('.js')
+  out_file_fd, out_file_path = tempfile.mkstemp('.o' if from_object else '.js')
   # Close the unneeded FD.
-  os.close(js_file_fd)
+  os.close(out_file_fd)
+  deps_file_path = out_file_path + '.d'
 
-  cmd = generate_cmd(js_file_path, src_file_path, cflags)
+  if from_object:
+    cmd = generate_object_cmd(out_file_path, src_file_path, cflags)
+  else:
+    cmd = generate_cmd(out_file_path, src_file_path, cflags)
+  cmd += ['-MD', '-MF', deps_file_path]
 
   try:
     subprocess.check_call(cmd, env=system_libs.clean_env())
@@ -256,21 +419,31 @@ def inspect_headers(headers, cflags):
     sys.stderr.write('FAIL: Compilation failed!: %s\n' % e.cmd)
     sys.exit(1)
 
-  # Run the compiled program.
-  show('Calling generated program... ' + js_file_path)
-  info = shared.run_js_tool(js_file_path, stdout=shared.PIPE)
+  if from_object:
+    show('Reading values from object file... ' + out_file_path)
+    read_data_values(out_file_path, values)
+  else:
+    # Run the compiled program.
+    show('Calling generated program... ' + out_file_path)
+    output = shared.run_js_tool(out_file_path, stdout=shared.PIPE)
+    # Parse the output of the program into a dict.
+    info = json.loads(output)
+
+  deps = [os.path.abspath(d) for d in parse_deps_file(deps_file_path)]
+  deps = [d for d in deps if d != os.path.abspath(src_file_path)]
 
   if not DEBUG:
     # Remove all temporary files.
     os.unlink(src_file_path)
+    utils.delete_file(deps_file_path)
 
-    if os.path.exists(js_file_path):
-      os.unlink(js_file_path)
-      wasm_file_path = shared.replace_suffix(js_file_path, '.wasm')
-      os.unlink(wasm_file_path)
+    if os.path.exists(out_file_path):
+      os.unlink(out_file_path)
+      if not from_object:
+        wasm_file_path = shared.replace_suffix(out_file_path, '.wasm')
+        os.unlink(wasm_file_path)
 
-  # Parse the output of the program into a dict.
-  return json.loads(info)
+  return info, deps
 
 
 def merge_info(target, src):
@@ -285,13 +458,13 @@ def merge_info(target, src):
     target['structs'][key] = value
 
 
-def inspect_code(headers, cflags):
+def inspect_code(headers, cflags, from_object=False, use_cache=False):
   if not DEBUG:
-    info = inspect_headers(headers, cflags)
+    info = inspect_headers(headers, cflags, from_object, use_cache)
   else:
     info = {'defines': {}, 'structs': {}}
     for header in headers:
-      merge_info(info, inspect_headers([header], cflags))
+      merge_info(info, inspect_headers([header], cflags, from_object, False))
   return info
 
 
@@ -357,16 +530,24 @@ def main(args):
                       help='Pass an undefine to the preprocessor')
   parser.add_argument('--wasm64', action='store_true',
                       help='use wasm64 architecture')
+  parser.add_argument('--all-archs', action='store_true',
+                      help='Generate the default outputs for both wasm32 and wasm64')
+  parser.add_argument('--object', action='store_true',
+                      help='Read the values from the data section of a compiled object file, '
+                           'rather than linking and running a program under node')
+  parser.add_argument('--no-cache', action='store_true',
+                      help='Do not use or update the cache of previous results')
   args = parser.parse_args(args)
 
   QUIET = args.quiet
 
-  extra_cflags = []
+  if args.all_archs and (args.output or args.wasm64):
+    parser.error('--all-archs cannot be used with -o or --wasm64')
+
+  # The cache cannot be written to when it is frozen.
+  use_cache = not args.no_cache and not DEBUG and not config.FROZEN_CACHE
 
-  if args.wasm64:
-    # Always use =2 here so that we don't generate a binary that actually requires
-    # memory64 to run.  All we care about is that the output is correct.
-    extra_cflags += ['-sMEMORY64=2']
+  extra_cflags = []
 
   # Add the user options to the list as well.
   for path in args.includes:
@@ -378,31 +559,48 @@ def main(args):
   for arg in args.undefines:
     extra_cflags.append('-U' + arg)
 
-  # Look for structs in all passed headers.
-  info = {'defines': {}, 'structs': {}}
-
-  for f in args.json:
-    # This is a JSON file, parse it.
-    header_files = parse_json(f)
-    # Inspect all collected structs.
+  if args.all_archs:
+    archs = [False, True]
+  else:
+    archs = [args.wasm64]
+
+  def get_cflags(f, wasm64):
+    use_cflags = CFLAGS
+    if wasm64:
+      # Always use =2 here so that we don't generate a binary that actually requires
+      # memory64 to run.  All we care about is that the output is correct.
+      use_cflags = use_cflags + ['-sMEMORY64=2']
+    use_cflags = use_cflags + extra_cflags
     if 'internal' in f:
-      use_cflags = CFLAGS + extra_cflags + INTERNAL_CFLAGS
+      use_cflags += INTERNAL_CFLAGS
     elif 'cxx' in f:
-      use_cflags = CFLAGS + extra_cflags + CXXFLAGS
-    else:
-      use_cflags = CFLAGS + extra_cflags
-    info_fragment = inspect_code(header_files, use_cflags)
-    merge_info(info, info_fragment)
-
-  if args.output:
-    output_file = args.output
-  elif args.wasm64:
-    output_file = utils.path_from_root('src/struct_info_generated_wasm64.json')
-  else:
-    output_file = utils.path_from_root('src/struct_info_generated.json')
-
-  with open(output_file, 'w') as f:
-    output_json(info, f)
+      use_cflags += CXXFLAGS
+    return use_cflags
+
+  # Look for structs in all passed headers, inspecting all the files for all
+  # the architectures concurrently.
+  with ThreadPoolExecutor(max_workers=utils.get_num_cores()) as executor:
+    futures = {}
+    for wasm64 in archs:
+      for f in args.json:
+        # This is a JSON file, parse it.
+        header_files = parse_json(f)
+        futures[(wasm64, f)] = executor.submit(inspect_code, header_files, get_cflags(f, wasm64), args.object, use_cache)
+
+    for wasm64 in archs:
+      info = {'defines': {}, 'structs': {}}
+      for f in args.json:
+        merge_info(info, futures[(wasm64, f)].result())
+
+      if args.output:
+        output_file = args.output
+      elif wasm64:
+        output_file = utils.path_from_root('src/struct_info_generated_wasm64.json')
+      else:
+        output_file = utils.path_from_root('src/struct_info_generated.json')
+
+      with open(output_file, 'w') as f:
+        output_json(info, f)
 
   return 0
 
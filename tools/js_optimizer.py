@@ -8,8 +8,10 @@ import os
 import sys
 import subprocess
 import re
+import hashlib
 import json
 import shutil
+from collections import Counter
 
 __scriptdir__ = os.path.dirname(os.path.abspath(__file__))
 __rootdir__ = os.path.dirname(__scriptdir__)
@@ -17,7 +19,7 @@ sys.path.insert(0, __rootdir__)
 
 from tools.toolchain_profiler import ToolchainProfiler
 from tools.utils import path_from_root
-from tools import building, config, shared, utils
+from tools import building, cache, config, filelock, shared, utils
 
 temp_files = shared.get_temp_files()
 
@@ -32,8 +34,17 @@ WINDOWS = sys.platform.startswith('win')
 
 DEBUG = os.environ.get('EMCC_DEBUG')
 
+# Set EMCC_JSOPT_CACHE=0 to disable the cache of optimized functions
+# (see FunctionCache)
+CACHE_FUNCS = os.environ.get('EMCC_JSOPT_CACHE', '1') != '0'
+
+# The maximum number of optimized functions to keep in the cache.  When there
+# are more, the least recently used are removed.
+FUNC_CACHE_LIMIT = 100000
+
 func_sig = re.compile(r'function ([_\w$]+)\(')
 func_sig_json = re.compile(r'\["defun", ?"([_\w$]+)",')
+identifier = re.compile(r'[_\w$]+')
 
 
 def get_acorn_cmd():
@@ -118,6 +129,134 @@ class Minifier:
     }
 
 
+class FunctionCache:
+  """Persistent cache of optimized functions, so that the functions that did
+  not change since a previous build are not optimized again.
+
+  Entries are keyed on the text of the function, the passes that are run, and
+  the extra info given to the optimizer.  Of the minified global names, only
+  those of the globals that the function mentions are part of the key.
+  """
+
+  def __init__(self, passes, extra_info):
+    self.funcs = None
+    self.results = None
+    self.hits = 0
+    self.stored = 0
+    if not CACHE_FUNCS:
+      return
+    info = dict(extra_info or {})
+    self.globs = info.get('globals')
+    if isinstance(self.globs, dict):
+      del info['globals']
+    else:
+      self.globs = {}
+    optimizer_hash = hashlib.sha256(utils.read_binary(ACORN_OPTIMIZER)).hexdigest()
+    self.base_key = json.dumps([utils.EMSCRIPTEN_VERSION, optimizer_hash, passes, info], sort_keys=True)
+    self.dirname = str(cache.get_path('build/jsopt_cache'))
+
+  def get_filename(self, text):
+    names = sorted(set(identifier.findall(text)))
+    relevant_globs = [(name, self.globs[name]) for name in names if name in self.globs]
+    h = hashlib.sha256(self.base_key.encode())
+    h.update(json.dumps(relevant_globs).encode())
+    h.update(text.encode())
+    return os.path.join(self.dirname, h.hexdigest() + '.js')
+
+  def lookup(self, funcs):
+    """Returns the cached optimized version of each of the (ident, text)
+    functions in `funcs`, or None for those that are not in the cache."""
+    results = []
+    for _, text in funcs:
+      filename = self.get_filename(text)
+      try:
+        optimized = utils.read_file(filename)
+      except FileNotFoundError:
+        results.append(None)
+        continue
+      # Record the use of the entry, so that the least recently used entries
+      # are removed first (see `prune`).
+      cache.touch(filename)
+      results.append((func_sig.search(optimized).group(1), optimized))
+      self.hits += 1
+    return results
+
+  @ToolchainProfiler.profile_block('js_optimizer.lookup_cache')
+  def remove_cached(self, funcs):
+    """Returns the (ident, text) functions in `funcs` that are not in the
+    cache, and so need to be optimized.  The others are added back to the
+    output of the optimizer by `merge`."""
+    if not CACHE_FUNCS:
+      return funcs
+    self.funcs = funcs
+    self.results = self.lookup(funcs)
+    misses = [func for func, result in zip(funcs, self.results) if not result]
+    if DEBUG:
+      print('function cache: hits:', self.hits, 'misses:', len(misses), file=sys.stderr)
+    return misses
+
+  def store(self, text, optimized):
+    if config.FROZEN_CACHE:
+      return
+    filename = self.get_filename(text)
+    utils.safe_ensure_dirs(self.dirname)
+    temp = f'{filename}.{os.getpid()}.tmp'
+    utils.write_file(temp, optimized)
+    os.replace(temp, filename)
+    self.stored += 1
+
+  def merge(self, optimized):
+    """Adds the cached functions that `remove_cached` removed to the
+    `optimized` output of the others, and adds those to the cache.
+
+    Each optimized function is matched to its input by name (allowing for
+    the minification of global names).  Any that cannot be matched
+    unambiguously are kept, but not cached.
+    """
+    if self.funcs is None:
+      return optimized
+    input_counts = Counter(ident for ident, _ in self.funcs)
+    output_counts = Counter(ident for ident, _ in optimized)
+    by_name = {ident: text for ident, text in optimized if output_counts[ident] == 1}
+    merged = []
+    matched = set()
+    for (ident, text), result in zip(self.funcs, self.results):
+      if result:
+        merged.append(result)
+        continue
+      out_ident = self.globs.get(ident, ident)
+      if input_counts[ident] == 1 and out_ident in by_name and out_ident not in matched:
+        matched.add(out_ident)
+        merged.append((out_ident, by_name[out_ident]))
+        self.store(text, by_name[out_ident])
+    merged += [func for func in optimized if func[0] not in matched]
+    self.funcs = self.results = None
+    if self.stored:
+      self.prune()
+    return merged
+
+  def prune(self):
+    """Removes the least recently used entries when there are more than
+    FUNC_CACHE_LIMIT of them.  To avoid doing this on every link, it removes
+    a quarter more than it needs to."""
+    files = [f for f in os.listdir(self.dirname) if f.endswith('.js')]
+    if len(files) <= FUNC_CACHE_LIMIT:
+      return
+    with filelock.FileLock(self.dirname + '.lock'):
+      entries = []
+      for f in files:
+        f = os.path.join(self.dirname, f)
+        try:
+          entries.append((os.path.getmtime(f), f))
+        except FileNotFoundError:
+          # Removed by another process
+          pass
+      entries.sort()
+      keep = FUNC_CACHE_LIMIT * 3 // 4
+      for _, f in entries[:len(entries) - keep]:
+        utils.delete_file(f)
+
+
 start_funcs_marker = '// EMSCRIPTEN_START_FUNCS\n'
 end_funcs_marker = '// EMSCRIPTEN_END_FUNCS\n'
 start_asm_marker = '// EMSCRIPTEN_START_ASM\n'
@@ -235,8 +374,9 @@ EMSCRIPTEN_FUNCS();
       #   print >> sys.stderr, 'minify info:', minify_info
 
   with ToolchainProfiler.profile_block('js_optimizer.split'):
-    total_size = len(js)
-    funcs = split_funcs(js)
+    # Only the functions that are not in the cache need to be optimized
+    func_cache = FunctionCache(passes, minify_info if minify_globals else extra_info)
+    funcs = func_cache.remove_cached(split_funcs(js))
     js = None
 
   with ToolchainProfiler.profile_block('js_optimizer.split_to_chunks'):
@@ -244,7 +384,7 @@ EMSCRIPTEN_FUNCS();
     # top of the file, so avoid breaking the JS into chunks
 
     intended_num_chunks = round(utils.get_num_cores() * NUM_CHUNKS_PER_CORE)
-    chunk_size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, total_size / intended_num_chunks))
+    chunk_size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, sum(len(func[1]) for func in funcs) / intended_num_chunks))
     chunks = chunkify(funcs, chunk_size)
 
     chunks = [chunk for chunk in chunks if chunk]
@@ -330,7 +470,7 @@ EMSCRIPTEN_FUNCS();
     with ToolchainProfiler.profile_block('sort_or_concat'):
       # sort functions by size, to make diffing easier and to improve aot times
       funcses = [split_funcs(utils.read_file(out_file)) for out_file in filenames]
-      funcs = [item for sublist in funcses for item in sublist]
+      funcs = func_cache.merge([item for sublist in funcses for item in sublist])
       funcses = None
       if not os.environ.get('EMCC_NO_OPT_SORT'):
         funcs.sort(key=lambda x: (len(x[1]), x[0]), reverse=True)
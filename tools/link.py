@@ -41,6 +41,7 @@ from .shared import DEBUG, WINDOWS, DYLIB_EXTENSIONS
 from .shared import unsuffixed, unsuffixed_basename, get_file_suffix
 from .settings import settings, default_setting, user_settings, JS_ONLY_SETTINGS, DEPRECATED_SETTINGS
 from .minimal_runtime_shell import generate_minimal_runtime_html
+from .task_graph import TaskGraph
 
 logger = logging.getLogger('link')
 
@@ -148,6 +149,22 @@ def base64_encode(filename):
   return b64.decode('ascii')
 
 
+def write_base64(fh, filename):
+  """Writes the base64 encoding of the given file a chunk at a time, so that
+  it is never all in memory at once."""
+  # The chunk size must be a multiple of 3 so that the encoded chunks can be
+  # concatenated without padding.
+  chunk_size = 3 * 1024 * 1024
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      fh.write(base64.b64encode(chunk).decode('ascii'))
+
+
+def write_text(fh, filename):
+  with open(filename, encoding='utf-8') as f:
+    shutil.copyfileobj(f, fh)
+
+
 def align_to_wasm_page_boundary(address):
   page_size = webassembly.WASM_PAGE_SIZE
   return ((address + (page_size - 1)) // page_size) * page_size
@@ -1326,6 +1343,11 @@ def phase_linker_setup(options, linker_args):  # noqa: C901, PLR0912, PLR0915
     # File preloading uses `Module['preRun']`.
     settings.INCOMING_MODULE_JS_API.append('preRun')
 
+  if options.lazy_preload_files:
+    if settings.WASMFS:
+      exit_with_error('--lazy-preload-files is not supported with WASMFS')
+    settings.EXPORTED_RUNTIME_METHODS.append('FS_createLazyDataFile')
+
   if settings.FORCE_FILESYSTEM and not settings.FILESYSTEM:
     exit_with_error('`-sFORCE_FILESYSTEM` cannot be used with `-sFILESYSTEM=0`')
 
@@ -1892,14 +1914,36 @@ def phase_linker_setup(options, linker_args):  # noqa: C901, PLR0912, PLR0915
   return target, wasm_target
 
 
+def get_partial_lib_roots(linker_inputs):
+  """Returns the symbols that a link with the given inputs needs from the
+  system libraries, for building partial libraries (EMCC_PARTIAL_LIBS).
+
+  This does not need to be exact: if a symbol is missed the link fails and is
+  retried with complete libraries.
+  """
+  roots = set(settings.REQUIRED_EXPORTS + settings.EXPORT_IF_DEFINED)
+  roots.update(shared.demangle_c_symbol_name(e) for e in settings.EXPORTED_FUNCTIONS if shared.is_c_symbol(e))
+  # Any native function that the JS library code might depend on.
+  for deps in get_js_sym_info()['deps'].values():
+    roots.update(deps)
+  inputs = [a for a in linker_inputs if not a.startswith('-') and (building.is_ar(a) or building.is_wasm(a))]
+  roots.update(system_libs.get_undefined_symbols(inputs))
+  return roots
+
+
 @ToolchainProfiler.profile_block('calculate system libraries')
-def phase_calculate_system_libraries(options):
+def phase_calculate_system_libraries(options, linker_args):
   extra_files_to_link = []
   # Link in ports and system libraries, if necessary
   if not settings.SIDE_MODULE:
     # Ports are always linked into the main module, never the side module.
     extra_files_to_link += ports.get_libs(settings)
-  extra_files_to_link += system_libs.calculate(options)
+  partial_roots = None
+  # Partial libraries are not used when linking with --whole-archive or LTO,
+  # where the code generator can introduce new references to libcalls.
+  if system_libs.PARTIAL_LIBS and not settings.LINKABLE and not settings.SIDE_MODULE and not settings.LTO and not shared.SKIP_SUBPROCS:
+    partial_roots = get_partial_lib_roots(linker_args + extra_files_to_link)
+  extra_files_to_link += system_libs.calculate(options, partial_roots)
   return extra_files_to_link
 
 
@@ -1930,6 +1974,12 @@ def phase_link(linker_args, wasm_target, js_syms):
     settings.LINKABLE = True
     rtn = extract_metadata.extract_metadata(wasm_target)
 
+  if system_libs.partial_libs:
+    if building.link_lld(linker_args, wasm_target, external_symbols=js_syms, check=False):
+      return rtn
+    logger.info('linking with partially built system libraries failed, building the complete libraries')
+    linker_args = system_libs.complete_partial_libs(linker_args)
+
   building.link_lld(linker_args, wasm_target, external_symbols=js_syms)
   return rtn
 
@@ -1954,20 +2004,36 @@ def phase_post_link(options, in_wasm, wasm_target, target, js_syms, base_metadat
 
   metadata = phase_emscript(in_wasm, wasm_target, js_syms, base_metadata)
 
+  # A single run of the embind generator produces the output needed by both
+  # EMBIND_AOT and --emit-tsd.
+  embind_out = None
+  if settings.EMBIND_AOT or (options.emit_tsd and settings.EMBIND):
+    embind_out = phase_embind_gen(options, wasm_target, js_syms)
+
   if settings.EMBIND_AOT:
-    phase_embind_aot(options, wasm_target, js_syms)
+    phase_embind_aot(embind_out)
 
   if options.emit_tsd:
-    phase_emit_tsd(options, wasm_target, js_target, js_syms, metadata)
+    phase_emit_tsd(options, js_target, metadata, embind_out)
 
   if options.js_transform:
     phase_source_transforms(options)
 
-  phase_binaryen(target, options, wasm_target)
+  # The later post-link steps run on a graph of tasks, so that those which
+  # don't depend on each other can run concurrently.  Running them one at a
+  # time keeps the numbering of the intermediate files deterministic when
+  # debugging.
+  tasks = TaskGraph(1 if DEBUG else utils.get_num_cores())
+  try:
+    phase_binaryen(target, options, wasm_target, tasks)
 
-  # If we are not emitting any JS then we are all done now
-  if options.oformat != OFormat.WASM:
-    phase_final_emitting(options, target, js_target, wasm_target)
+    # If we are not emitting any JS then we are all done now
+    if options.oformat != OFormat.WASM:
+      phase_final_emitting(options, target, js_target, wasm_target, tasks)
+
+    tasks.wait()
+  finally:
+    tasks.shutdown()
 
 
 @ToolchainProfiler.profile_block('emscript')
@@ -1989,10 +2055,9 @@ def phase_emscript(in_wasm, wasm_target, js_syms, base_metadata):
   return metadata
 
 
-def run_embind_gen(options, wasm_target, js_syms, extra_settings):
+def run_embind_gen(options, wasm_target, js_syms):
   # Save settings so they can be restored after TS generation.
   original_settings = settings.backup()
-  settings.attrs.update(extra_settings)
   settings.EMBIND_GEN_MODE = True
 
   if settings.MAIN_MODULE:
@@ -2045,42 +2110,68 @@ def run_embind_gen(options, wasm_target, js_syms, extra_settings):
     settings.MEMORY64 = 2
   # Source maps haven't been generated yet and aren't needed to run embind_gen.
   settings.LOAD_SOURCE_MAP = 0
-  outfile_js = in_temp('tsgen.js')
-  # The Wasm outfile may be modified by emscripten.emscript, so use a temporary file.
-  outfile_wasm = in_temp('tsgen.wasm')
-  emscripten.emscript(wasm_target, outfile_wasm, outfile_js, js_syms, finalize=False)
-  # Build the flags needed by Node.js to properly run the output file.
-  node_args = []
-  if settings.MEMORY64:
-    # See comment above about lowering memory64.
-    building.run_wasm_opt(outfile_wasm, outfile_wasm, ['--memory64-lowering', '--table64-lowering'])
-  if settings.WASM_EXCEPTIONS:
-    node_args += shared.node_exception_flags(config.NODE_JS)
-  # Run the generated JS file with the proper flags to generate the TypeScript bindings.
-  output_file = in_temp('embind_generated_output.js')
-  shared.run_js_tool(outfile_js, [output_file], node_args)
+
+  def generate():
+    outfile_js = in_temp('tsgen.js')
+    # The Wasm outfile may be modified by emscripten.emscript, so use a temporary file.
+    outfile_wasm = in_temp('tsgen.wasm')
+    emscripten.emscript(wasm_target, outfile_wasm, outfile_js, js_syms, finalize=False)
+    # Build the flags needed by Node.js to properly run the output file.
+    node_args = []
+    if settings.MEMORY64:
+      # See comment above about lowering memory64.
+      building.run_wasm_opt(outfile_wasm, outfile_wasm, ['--memory64-lowering', '--table64-lowering'])
+    if settings.WASM_EXCEPTIONS:
+      node_args += shared.node_exception_flags(config.NODE_JS)
+    # Run the generated JS file with the proper flags to generate the TypeScript bindings.
+    output_file = in_temp('embind_generated_output.js')
+    shared.run_js_tool(outfile_js, [output_file], node_args)
+    return read_file(output_file)
+
+  if DEBUG or config.FROZEN_CACHE:
+    output = generate()
+  else:
+    # The output only depends on the wasm file, the settings and the JS
+    # libraries, so we can reuse it across relinks that don't change those.
+    input_files = [json.dumps(settings.external_dict(), sort_keys=True, indent=2)]
+    jslibs = glob.glob(utils.path_from_root('src/lib') + '/lib*.js')
+    input_files.extend(read_file(jslib) for jslib in sorted(jslibs))
+    for jslib in settings.JS_LIBRARIES:
+      input_files.append(read_file(jslib))
+    content_hash = hashlib.sha1('\n'.join(input_files).encode('utf-8'))
+    content_hash.update(utils.read_binary(wasm_target))
+    if settings.MAIN_MODULE:
+      for f in options.input_files:
+        if building.is_wasm_dylib(f):
+          content_hash.update(utils.read_binary(f))
+    output = get_cached_file('embind_gen', f'{content_hash.hexdigest()}.json', generate, cache_limit=100)
+
   settings.restore(original_settings)
-  return read_file(output_file)
+  return output
+
+
+@ToolchainProfiler.profile_block('embind gen')
+def phase_embind_gen(options, wasm_target, js_syms):
+  out = run_embind_gen(options, wasm_target, js_syms)
+  if DEBUG:
+    write_file(in_temp('embind_gen.json'), out)
+  return json.loads(out)
 
 
 @ToolchainProfiler.profile_block('emit tsd')
-def phase_emit_tsd(options, wasm_target, js_target, js_syms, metadata):
+def phase_emit_tsd(options, js_target, metadata, embind_out):
   logger.debug('emit tsd')
   filename = options.emit_tsd
   embind_tsd = ''
   if settings.EMBIND:
-    embind_tsd = run_embind_gen(options, wasm_target, js_syms, {'EMBIND_AOT': False})
+    embind_tsd = embind_out['tsd'] + '\n'
   all_tsd = emscripten.create_tsd(metadata, embind_tsd)
   out_file = os.path.join(os.path.dirname(js_target), filename)
   write_file(out_file, all_tsd)
 
 
 @ToolchainProfiler.profile_block('embind aot js')
-def phase_embind_aot(options, wasm_target, js_syms):
-  out = run_embind_gen(options, wasm_target, js_syms, {})
-  if DEBUG:
-    write_file(in_temp('embind_aot.json'), out)
-  out = json.loads(out)
+def phase_embind_aot(out):
   src = read_file(final_js)
   src = do_replace(src, '<<< EMBIND_AOT_INVOKERS >>>', out['invokers'])
   if settings.MODULARIZE == 'instance':
@@ -2190,12 +2281,15 @@ if (isNode) {{
 
 
 @ToolchainProfiler.profile_block('final emitting')
-def phase_final_emitting(options, target, js_target, wasm_target):
+def phase_final_emitting(options, target, js_target, wasm_target, tasks):
   global final_js
 
   if shared.SKIP_SUBPROCS:
     return
 
+  # The steps on the wasm can continue while the JS is finished off
+  tasks.wait('js')
+
   if settings.MODULARIZE and settings.MODULARIZE != 'instance':
     modularize()
   elif settings.USE_CLOSURE_COMPILER:
@@ -2240,6 +2334,9 @@ def phase_final_emitting(options, target, js_target, wasm_target):
   if settings.WASM_ESM_INTEGRATION:
     support_target = unsuffixed(js_target) + '.support.mjs'
     move_file(final_js, support_target)
+    # The wrapper reads (and rewrites) the wasm, so the steps on it must be
+    # done first.
+    tasks.wait(wasm_target)
     create_esm_wrapper(js_target, support_target, wasm_target)
     if settings.PTHREADS:
       support_target = unsuffixed(js_target) + '.pthread.mjs'
@@ -2253,6 +2350,8 @@ def phase_final_emitting(options, target, js_target, wasm_target):
 
   utils.convert_line_endings_in_file(js_target, options.output_eol)
 
+  tasks.wait()
+
   # If we were asked to also generate HTML, do that
   if options.oformat == OFormat.HTML:
     generate_html(target, options, js_target, target_basename,
@@ -2269,7 +2368,7 @@ def phase_final_emitting(options, target, js_target, wasm_target):
 
 
 @ToolchainProfiler.profile_block('binaryen')
-def phase_binaryen(target, options, wasm_target):
+def phase_binaryen(target, options, wasm_target, tasks):
   global final_js
   logger.debug('using binaryen')
   # whether we need to emit -g (function name debug info) in the final wasm
@@ -2357,18 +2456,26 @@ def phase_binaryen(target, options, wasm_target):
                                            debug_info=intermediate_debug_info)
         save_intermediate_with_wasm('postclean', wasm_target)
 
+    # The remaining steps are added to the post-link task graph, declaring the
+    # files that each of them reads and writes.  This lets the steps that only
+    # need the final wasm (e.g. writing the symbol map) overlap with those
+    # that process the JS (e.g. closure).
     if options.use_closure_compiler:
-      with ToolchainProfiler.profile_block('closure_compile'):
+      def closure():
+        global final_js
         final_js = building.closure_compiler(final_js, extra_closure_args=settings.CLOSURE_ARGS)
-      save_intermediate('closure')
+        save_intermediate('closure')
+      tasks.add('closure_compile', closure, inputs=['js'], outputs=['js'])
 
     if settings.TRANSPILE:
-      with ToolchainProfiler.profile_block('transpile'):
+      def transpile():
+        global final_js
         final_js = building.transpile(final_js)
-      save_intermediate('transpile')
-      # Run acorn one more time to minify whitespace after babel runs
-      if settings.MINIFY_WHITESPACE:
-        final_js = building.acorn_optimizer(final_js, ['--minify-whitespace'])
+        save_intermediate('transpile')
+        # Run acorn one more time to minify whitespace after babel runs
+        if settings.MINIFY_WHITESPACE:
+          final_js = building.acorn_optimizer(final_js, ['--minify-whitespace'])
+      tasks.add('transpile', transpile, inputs=['js'], outputs=['js'])
 
   symbols_file = None
   if options.emit_symbol_map:
@@ -2385,28 +2492,37 @@ def phase_binaryen(target, options, wasm_target):
       # generate secondary file for JS symbols
       if options.emit_symbol_map:
         symbols_file_js = shared.replace_or_append_suffix(wasm2js_template, '.symbols')
+      inputs = [wasm_target, wasm2js_template]
+      outputs = [wasm2js_template]
     else:
-      wasm2js_template = final_js
+      wasm2js_template = None
       if options.emit_symbol_map:
         symbols_file_js = shared.replace_or_append_suffix(target, '.symbols')
+      inputs = [wasm_target, 'js']
+      outputs = ['js']
+    outputs += [f for f in (symbols_file, symbols_file_js) if f]
 
-    wasm2js = building.wasm2js(wasm2js_template,
-                               wasm_target,
-                               opt_level=settings.OPT_LEVEL,
-                               use_closure_compiler=options.use_closure_compiler,
-                               debug_info=debug_function_names,
-                               symbols_file=symbols_file,
-                               symbols_file_js=symbols_file_js)
+    def wasm2js():
+      global final_js
+      wasm2js = building.wasm2js(wasm2js_template or final_js,
+                                 wasm_target,
+                                 opt_level=settings.OPT_LEVEL,
+                                 use_closure_compiler=options.use_closure_compiler,
+                                 debug_info=debug_function_names,
+                                 symbols_file=symbols_file,
+                                 symbols_file_js=symbols_file_js)
 
-    shared.get_temp_files().note(wasm2js)
+      shared.get_temp_files().note(wasm2js)
 
-    if settings.WASM == 2:
-      safe_copy(wasm2js, wasm2js_template)
+      if settings.WASM == 2:
+        safe_copy(wasm2js, wasm2js_template)
+
+      if settings.WASM != 2:
+        final_js = wasm2js
 
-    if settings.WASM != 2:
-      final_js = wasm2js
+      save_intermediate('wasm2js')
 
-    save_intermediate('wasm2js')
+    tasks.add('wasm2js', wasm2js, inputs=inputs, outputs=outputs)
 
   generating_wasm = settings.WASM == 2 or not settings.WASM2JS
 
@@ -2417,9 +2533,11 @@ def phase_binaryen(target, options, wasm_target):
   if options.emit_symbol_map:
     intermediate_debug_info -= 1
     if generating_wasm:
-      building.write_symbol_map(wasm_target, symbols_file)
+      tasks.add('write_symbol_map', lambda: building.write_symbol_map(wasm_target, symbols_file),
+                inputs=[wasm_target], outputs=[symbols_file])
       if not intermediate_debug_info:
-        building.strip(wasm_target, wasm_target, sections=['name'])
+        tasks.add('strip_symbol_names', lambda: building.strip(wasm_target, wasm_target, sections=['name']),
+                  inputs=[wasm_target], outputs=[wasm_target])
 
   if settings.GENERATE_DWARF and settings.SEPARATE_DWARF and generating_wasm:
     # if the dwarf filename wasn't provided, use the default target + a suffix
@@ -2428,7 +2546,8 @@ def phase_binaryen(target, options, wasm_target):
       # Historically this file has been called `.wasm.debug.wasm`
       # TODO(sbc): Should this just be `.debug.wasm`
       wasm_file_with_dwarf = get_secondary_target(target, '.wasm.debug.wasm')
-    building.emit_debug_on_side(wasm_target, wasm_file_with_dwarf)
+    tasks.add('emit_debug_on_side', lambda: building.emit_debug_on_side(wasm_target, wasm_file_with_dwarf),
+              inputs=[wasm_target], outputs=[wasm_target, wasm_file_with_dwarf])
 
   # we have finished emitting the wasm, and so intermediate debug info will
   # definitely no longer be used tracking it.
@@ -2436,17 +2555,26 @@ def phase_binaryen(target, options, wasm_target):
     intermediate_debug_info -= 1
   assert intermediate_debug_info == 0
   # strip debug info if it was not already stripped by the last command
-  if not debug_function_names and building.binaryen_kept_debug_info and generating_wasm:
-    with ToolchainProfiler.profile_block('strip_name_section'):
-      building.strip(wasm_target, wasm_target, debug=False, sections=["name"])
+  if not debug_function_names and generating_wasm:
+    def strip_name_section():
+      # This is checked when the task runs, since it depends on the last
+      # binaryen command, which may be run by an earlier task (e.g. wasm2js).
+      if building.binaryen_kept_debug_info:
+        building.strip(wasm_target, wasm_target, debug=False, sections=["name"])
+    tasks.add('strip_name_section', strip_name_section, inputs=[wasm_target], outputs=[wasm_target])
 
   # replace placeholder strings with correct subresource locations
   if final_js and settings.SINGLE_FILE and not settings.WASM2JS:
-    js = read_file(final_js)
-
-    js = do_replace(js, '<<< WASM_BINARY_DATA >>>', base64_encode(wasm_target))
-    delete_file(wasm_target)
-    write_file(final_js, js)
+    def embed_wasm():
+      js = read_file(final_js)
+      placeholder = '<<< WASM_BINARY_DATA >>>'
+      if placeholder not in js:
+        exit_with_error('expected to find pattern in input JS: %s' % placeholder)
+      # The wasm can be large, so stream its encoding into the JS rather than
+      # building the whole output in memory.
+      utils.write_file_with_replacement(final_js, js, placeholder, lambda fh: write_base64(fh, wasm_target))
+      delete_file(wasm_target)
+    tasks.add('embed_wasm', embed_wasm, inputs=['js', wasm_target], outputs=['js', wasm_target])
 
 
 def modularize():
@@ -2513,14 +2641,7 @@ def generate_traditional_runtime_html(target, options, js_target, target_basenam
     # Normal code generation path
     script.src = base_js_target
 
-  if settings.SINGLE_FILE:
-    js_contents = script.inline or ''
-    if script.src:
-      js_contents += read_file(js_target)
-    script.src = None
-    script.inline = read_file(js_target)
-    delete_file(js_target)
-  else:
+  if not settings.SINGLE_FILE:
     if not settings.WASM_ASYNC_COMPILATION:
       # We need to load the wasm file before anything else, since it
       # has be synchronously ready.
@@ -2554,14 +2675,26 @@ def generate_traditional_runtime_html(target, options, js_target, target_basenam
           }
 ''' % (script.inline, get_subresource_location_js(wasm_target + '.js'))
 
-  shell = do_replace(shell, '{{{ SCRIPT }}}', script.replacement())
   shell = shell.replace('{{{ SHELL_CSS }}}', utils.read_file(utils.path_from_root('src/shell.css')))
   logo_filename = utils.path_from_root('media/powered_by_logo_shell.png')
   logo_b64 = base64_encode(logo_filename)
   shell = shell.replace('{{{ SHELL_LOGO }}}', f'<img id="emscripten_logo" src="data:image/png;base64,{logo_b64}">')
 
   check_output_file(target)
-  write_file(target, shell)
+  if settings.SINGLE_FILE:
+    # The JS (with the wasm embedded in it) is streamed into the HTML, since
+    # it can be large.
+    if '{{{ SCRIPT }}}' not in shell:
+      exit_with_error('expected to find pattern in input HTML: {{{ SCRIPT }}}')
+    def write_script(fh):
+      fh.write('<script id="mainScript">\n')
+      write_text(fh, js_target)
+      fh.write('\n</script>')
+    utils.write_file_with_replacement(target, shell, '{{{ SCRIPT }}}', write_script)
+    delete_file(js_target)
+  else:
+    shell = do_replace(shell, '{{{ SCRIPT }}}', script.replacement())
+    write_file(target, shell)
 
 
 def minify_html(filename):
@@ -2984,6 +3117,14 @@ def package_files(options, target):
     file_args.append('--use-preload-cache')
   if settings.LZ4:
     file_args.append('--lz4')
+  if options.compress_preload_files:
+    file_args.append('--compress')
+  if options.lazy_preload_files:
+    file_args.append('--lazy')
+  if options.preload_shard_size:
+    file_args.append('--shard-size=' + options.preload_shard_size)
+  if options.preload_shard_by_directory:
+    file_args.append('--shard-by-directory')
   if options.use_preload_plugins:
     file_args.append('--use-preload-plugins')
   if not settings.ENVIRONMENT_MAY_BE_NODE:
@@ -3032,11 +3173,11 @@ def phase_calculate_linker_inputs(options, linker_args):
 
 def calc_extra_ldflags(options):
   extra_args = []
-  system_libpath = str(cache.get_lib_dir(absolute=True))
   system_js_path = utils.path_from_root('src', 'lib')
-  options.lib_dirs.append(system_libpath)
+  for system_libpath in cache.get_lib_dirs():
+    options.lib_dirs.append(system_libpath)
+    extra_args.append('-L' + system_libpath)
   options.lib_dirs.append(system_js_path)
-  extra_args.append('-L' + system_libpath)
   extra_args.append('-L' + system_js_path)
 
   if settings.FETCH:
@@ -3090,7 +3231,7 @@ def run(options, linker_args):
     logger.debug('stopping after linking to object file')
     return 0
 
-  linker_args += phase_calculate_system_libraries(options)
+  linker_args += phase_calculate_system_libraries(options, linker_args)
 
   js_syms = {}
   if (not settings.SIDE_MODULE or settings.ASYNCIFY) and not shared.SKIP_SUBPROCS:
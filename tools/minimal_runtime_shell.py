@@ -2,6 +2,7 @@ import re
 import sys
 import os
 import logging
+import shutil
 
 __scriptdir__ = os.path.dirname(os.path.abspath(__file__))
 __rootdir__ = os.path.dirname(__scriptdir__)
@@ -191,11 +192,12 @@ def generate_minimal_runtime_html(target, options, js_target, target_basename):
   shell = shell.replace('{{{ EXPORT_NAME }}}', settings.EXPORT_NAME)
   shell = shell.replace('{{{ TARGET_JS_NAME }}}', settings.TARGET_JS_NAME)
 
-  # In SINGLE_FILE build, embed the main .js file into the .html output
+  # In SINGLE_FILE build, embed the main .js file into the .html output.  It
+  # is streamed into the output since it can be large.
+  def write_js_contents(fh):
+    if settings.SINGLE_FILE:
+      with open(js_target, encoding='utf-8') as f:
+        shutil.copyfileobj(f, fh)
+  utils.write_file_with_replacement(target, shell, '{{{ JS_CONTENTS_IN_SINGLE_FILE_BUILD }}}', write_js_contents, options.output_eol)
   if settings.SINGLE_FILE:
-    js_contents = utils.read_file(js_target)
     utils.delete_file(js_target)
-  else:
-    js_contents = ''
-  shell = shell.replace('{{{ JS_CONTENTS_IN_SINGLE_FILE_BUILD }}}', js_contents)
-  utils.write_file(target, shell, options.output_eol)
@@ -14,10 +14,12 @@ from inspect import signature
 import sys
 import subprocess
 from typing import Set, Dict
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
 
 from tools import cache
 from tools import config
+from tools import filelock
 from tools import shared
 from tools import system_libs
 from tools import utils
@@ -38,6 +40,8 @@ ports_dir = os.path.dirname(os.path.abspath(__file__))
 
 logger = logging.getLogger('ports')
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 def get_port_by_name(name):
   port = ports_by_name[name]
@@ -74,6 +78,8 @@ def init_local_port(name, port):
     port.deps = []
   if not hasattr(port, 'process_args'):
     port.process_args = lambda x: []
+  if not hasattr(port, 'sources'):
+    port.sources = lambda s: []
   if not hasattr(port, 'variants'):
     # port variants (default: no variants)
     port.variants = {}
@@ -114,6 +120,7 @@ def init_external_port(name, port):
   for a in expected_attrs:
     assert hasattr(port, a), 'port %s is missing %s' % (port, a)
   port.needed = lambda s: name in ports_needed
+  port.sources = lambda s: []
   port.show = lambda: f'{port.name} (--use-port={port.name}; {port.LICENSE})'
 
 
@@ -172,18 +179,99 @@ def dir_is_newer(dir_a, dir_b):
 
 def maybe_copy(src, dest):
   """Just like shutil.copyfile, but will do nothing if the destination already
-  exists and has the same contents as the source.
-
-  In the case where a library is built in multiple different configurations,
-  we want to avoids racing between processes that are reading headers (without
-  holding the cache lock) (e.g. normal compile steps) and a process that is
-  building/installing a new flavor of a given library.  In this case the
-  headers will be "re-installed" but we skip the actual filesystem mods
-  to avoid racing with other processes that might be reading these files.
+  exists and has the same contents as the source (see
+  system_libs.InstallManifest)."""
+  manifest = system_libs.InstallManifest()
+  manifest.install(src, dest)
+  manifest.save()
+
+
+def hash_file(filename):
+  h = hashlib.sha512()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def get_mirror_url(name, url):
+  """Returns the location of the given port archive in the ports mirror (see
+  PORTS_MIRROR), or None if no mirror is configured.  The mirror is a
+  directory (or URL) containing `<port name>/<archive filename>`."""
+  mirror = config.PORTS_MIRROR
+  if not mirror:
+    return None
+  if '://' not in mirror:
+    mirror = Path(mirror).resolve().as_uri()
+  return f"{mirror.rstrip('/')}/{name}/{url.rsplit('/')[-1]}"
+
+
+class UnexpectedHashError(Exception):
+  """Raised by download() when the downloaded file does not have the expected
+  hash."""
+
+
+def download(url, filename, sha512hash=None):
+  """Streams `url` into `filename`, verifying its sha512 hash along the way.
+
+  The data is first written to `filename + '.part'`.  If that already exists
+  (e.g. from an interrupted download) then the download is resumed from where
+  it stopped, if the server supports range requests.
   """
-  if os.path.exists(dest) and utils.read_binary(src) == utils.read_binary(dest):
-    return
-  shutil.copyfile(src, dest)
+  partial = filename + '.part'
+  h = hashlib.sha512()
+  offset = 0
+  if os.path.exists(partial):
+    offset = os.path.getsize(partial)
+    with open(partial, 'rb') as f:
+      for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+        h.update(chunk)
+
+  if utils.MACOS and not url.startswith('file:'):
+    # Use `curl` over `urllib` on macOS to avoid issues with
+    # certificate verification.
+    # https://stackoverflow.com/questions/40684543/how-to-make-python-use-ca-certificates-from-mac-os-truststore
+    # Unlike on Windows or Linux, curl is guaranteed to always be
+    # available on macOS.
+    subprocess.check_call(['curl', '-sSL', '-C', '-', '-o', partial, url])
+    actual_hash = hash_file(partial)
+  else:
+    request = Request(url)
+    if offset:
+      request.add_header('Range', f'bytes={offset}-')
+    with urlopen(request) as response:
+      mode = 'ab'
+      if offset and response.getcode() != 206:
+        logger.debug(f'server does not support resuming the download of {url}')
+        h = hashlib.sha512()
+        mode = 'wb'
+      with open(partial, mode) as f:
+        for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+          h.update(chunk)
+          f.write(chunk)
+    actual_hash = h.hexdigest()
+
+  if sha512hash and actual_hash != sha512hash:
+    utils.delete_file(partial)
+    raise UnexpectedHashError(f'Unexpected hash: {actual_hash}')
+  os.replace(partial, filename)
+
+
+def retrieve_port_archive(name, url, filename, sha512hash):
+  mirror_url = get_mirror_url(name, url)
+  if mirror_url:
+    try:
+      logger.info(f'retrieving port: {name} from mirror {mirror_url}')
+      download(mirror_url, filename, sha512hash)
+      return
+    except (OSError, subprocess.CalledProcessError, UnexpectedHashError) as e:
+      logger.warning(f'unable to retrieve port {name} from mirror ({e}), falling back to {url}')
+      utils.delete_file(filename + '.part')
+  logger.info(f'retrieving port: {name} from {url}')
+  try:
+    download(url, filename, sha512hash)
+  except UnexpectedHashError as e:
+    utils.exit_with_error(f'{e}\nIf you are updating the port, please update the hash.')
 
 
 class Ports:
@@ -192,6 +280,18 @@ class Ports:
 
   @staticmethod
   def get_include_dir(*parts):
+    # Ports that are prebuilt in a read-only cache layer have their headers
+    # installed there.
+    if parts:
+      for dirname in cache.get_layer_paths(cache.get_sysroot(absolute=False), 'include', *parts)[:-1]:
+        if dirname.is_dir():
+          return str(dirname)
+    return Ports.get_install_include_dir(*parts)
+
+  @staticmethod
+  def get_install_include_dir(*parts):
+    """Like get_include_dir but always returns the directory in the writable
+    cache, which is where headers get installed."""
     dirname = cache.get_include_dir(*parts)
     shared.safe_ensure_dirs(dirname)
     return dirname
@@ -201,9 +301,11 @@ class Ports:
     """Like install_headers but recursively copied all files in a directory"""
     if not target:
       target = os.path.basename(src_dir)
-    dest = Ports.get_include_dir(target)
+    dest = Ports.get_install_include_dir(target)
     logger.debug(f'installing headers: {dest}')
-    shutil.copytree(src_dir, dest, dirs_exist_ok=True, copy_function=maybe_copy)
+    manifest = system_libs.InstallManifest()
+    shutil.copytree(src_dir, dest, dirs_exist_ok=True, copy_function=manifest.install)
+    manifest.save()
 
   @staticmethod
   def install_file(filename, target):
@@ -215,16 +317,18 @@ class Ports:
   @staticmethod
   def install_headers(src_dir, pattern='*.h', target=None):
     logger.debug('install_headers')
-    dest = Ports.get_include_dir()
+    dest = Ports.get_install_include_dir()
     assert os.path.exists(dest)
     if target:
       dest = os.path.join(dest, target)
       shared.safe_ensure_dirs(dest)
     matches = glob.glob(os.path.join(src_dir, pattern))
     assert matches, f'no headers found to install in {src_dir}'
+    manifest = system_libs.InstallManifest()
     for f in matches:
       logger.debug('installing: ' + os.path.join(dest, os.path.basename(f)))
-      maybe_copy(f, os.path.join(dest, os.path.basename(f)))
+      manifest.install(f, os.path.join(dest, os.path.basename(f)))
+    manifest.save()
 
   @staticmethod
   def build_port(src_dir, output_path, port_name, includes=[], flags=[], cxxflags=[], exclude_files=[], exclude_dirs=[], srcs=[]):  # noqa
@@ -298,6 +402,8 @@ class Ports:
     """This function only fetches the port and returns True when the port is up to date, False otherwise"""
     # To compute the sha512 hash, run `curl URL | sha512sum`.
     fullname = Ports.get_dir(name)
+    cache.record_access(fullname)
+    cache.touch(fullname)
 
     if name not in Ports.name_cache: # only mention each port once in log
       logger.debug(f'including port: {name}')
@@ -336,7 +442,7 @@ class Ports:
           if os.path.exists(target) and dir_is_newer(path, target):
             logger.warning(uptodate_message)
             return True
-          with cache.lock('unpack local port'):
+          with filelock.FileLock(fullname + '.lock'):
             # Another early out in case another process unpackage the library while we were
             # waiting for the lock
             if os.path.exists(target) and not dir_is_newer(path, target):
@@ -351,28 +457,6 @@ class Ports:
     ext = url_filename.split('.', 1)[1]
     fullpath = fullname + '.' + ext
 
-    def retrieve():
-      # retrieve from remote server
-      logger.info(f'retrieving port: {name} from {url}')
-
-      if utils.MACOS:
-        # Use `curl` over `urllib` on macOS to avoid issues with
-        # certificate verification.
-        # https://stackoverflow.com/questions/40684543/how-to-make-python-use-ca-certificates-from-mac-os-truststore
-        # Unlike on Windows or Linux, curl is guaranteed to always be
-        # available on macOS.
-        data = subprocess.check_output(['curl', '-sSL', url])
-      else:
-        f = urlopen(url)
-        data = f.read()
-
-      if sha512hash:
-        actual_hash = hashlib.sha512(data).hexdigest()
-        if actual_hash != sha512hash:
-          utils.exit_with_error(f'Unexpected hash: {actual_hash}\n'
-                                'If you are updating the port, please update the hash.')
-      utils.write_binary(fullpath, data)
-
     marker = os.path.join(fullname, '.emscripten_url')
 
     def unpack():
@@ -388,21 +472,21 @@ class Ports:
     if up_to_date():
       return True
 
-    # main logic. do this under a cache lock, since we don't want multiple jobs to
-    # retrieve the same port at once
-    cache.ensure() # TODO: find a better place for this (necessary at the moment)
-    with cache.lock('unpack port'):
-      if os.path.exists(fullpath):
-        # Another early out in case another process unpackage the library while we were
-        # waiting for the lock
-        if up_to_date():
-          return True
-        # file exists but tag is bad
-        logger.warning('local copy of port is not correct, retrieving from remote server')
-        utils.delete_dir(fullname)
+    # main logic. do this under a per-port lock, since we don't want multiple
+    # jobs to retrieve the same port at once, but there is no need to block
+    # other users of the cache (or the fetching of other ports).
+    with filelock.FileLock(fullname + '.lock'):
+      # Another early out in case another process unpackage the library while we were
+      # waiting for the lock
+      if up_to_date():
+        return True
+      # Remove any previous version, or the remains of an interrupted unpack.
+      utils.delete_dir(fullname)
+      if os.path.exists(fullpath) and sha512hash and hash_file(fullpath) == sha512hash:
+        logger.debug(f'using previously downloaded archive for port: {name}')
+      else:
         utils.delete_file(fullpath)
-
-      retrieve()
+        retrieve_port_archive(name, url, fullpath, sha512hash)
       unpack()
 
       return False
@@ -413,6 +497,12 @@ class Ports:
       # we unpacked a new version, clear the build in the cache
       Ports.clear_project_build(name)
 
+  @staticmethod
+  def fetch_sources(sources):
+    """Fetches the sources returned by a port's `sources()` function."""
+    for name, url, sha512hash in sources:
+      Ports.fetch_project(name, url, sha512hash)
+
   @staticmethod
   def clear_project_build(name):
     port = get_port_by_name(name)
@@ -607,10 +697,26 @@ def get_needed_ports(settings, cflags_only=False):
   return needed
 
 
+def fetch_ports(port_list, settings):
+  """Concurrently fetches the sources that the given ports declare with their
+  `sources` function.  The ports are then built in dependency order, which
+  finds the sources already unpacked."""
+  sources = []
+  for port in port_list:
+    sources += port.sources(settings)
+  if len(sources) < 2:
+    return
+  with ThreadPoolExecutor(max_workers=min(len(sources), 8)) as executor:
+    futures = [executor.submit(Ports.fetch_project, *args) for args in sources]
+    for future in futures:
+      future.result()
+
+
 def build_port(port_name, settings):
   port = get_port_by_name(port_name)
   port_set = OrderedSet([port])
   resolve_dependencies(port_set, settings)
+  fetch_ports(port_set, settings)
   for port in dependency_order(port_set):
     port.get(Ports, settings, shared)
 
@@ -630,6 +736,7 @@ def get_libs(settings):
   """
   ret = []
   needed = get_needed_ports(settings)
+  fetch_ports(needed, settings)
 
   for port in dependency_order(needed):
     port.linker_setup(Ports, settings)
@@ -652,6 +759,8 @@ def add_cflags(args, settings):
     args += ['-I' + Ports.get_include_dir('SDL')]
 
   needed = get_needed_ports(settings, cflags_only=True)
+  if not os.getenv('EMBUILDER_PORT_BUILD_DEFERRED'):
+    fetch_ports(needed, settings)
 
   # Now get (i.e. build) the ports in dependency order.  This is important because the
   # headers from one port might be needed before we can build the next.
@@ -13,10 +13,12 @@ def needed(settings):
   return settings.USE_BOOST_HEADERS == 1
 
 
+def sources(settings):
+  return [('boost_headers', f'https://github.com/emscripten-ports/boost/releases/download/boost-{TAG}/boost-headers-{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('boost_headers',
-                      f'https://github.com/emscripten-ports/boost/releases/download/boost-{TAG}/boost-headers-{TAG}.zip',
-                      sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     # includes
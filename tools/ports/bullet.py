@@ -14,14 +14,18 @@ def needed(settings):
   return settings.USE_BULLET == 1
 
 
+def sources(settings):
+  return [('bullet', f'https://github.com/emscripten-ports/bullet/archive/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('bullet', f'https://github.com/emscripten-ports/bullet/archive/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('bullet', 'Bullet-' + TAG)
     src_path = os.path.join(source_path, 'bullet', 'src')
 
-    dest_include_path = ports.get_include_dir('bullet')
+    dest_include_path = ports.get_install_include_dir('bullet')
     for base, _, files in os.walk(src_path):
       for f in files:
         if shared.suffix(f) != '.h':
@@ -11,8 +11,12 @@ def needed(settings):
   return settings.USE_BZIP2
 
 
+def sources(settings):
+  return [('bzip2', f'https://github.com/emscripten-ports/bzip2/archive/{VERSION}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('bzip2', f'https://github.com/emscripten-ports/bzip2/archive/{VERSION}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('bzip2', 'bzip2-' + VERSION)
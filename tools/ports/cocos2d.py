@@ -17,8 +17,12 @@ def needed(settings):
   return settings.USE_COCOS2D == 3
 
 
+def sources(settings):
+  return [('cocos2d', f'https://github.com/emscripten-ports/Cocos2d/archive/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('cocos2d', f'https://github.com/emscripten-ports/Cocos2d/archive/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     diagnostics.warning('experimental', 'cocos2d: library is experimental, do not expect that it will work out of the box')
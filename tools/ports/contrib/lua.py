@@ -17,9 +17,13 @@ port_name = 'contrib.lua'
 lib_name = 'liblua.a'
 
 
+def sources(settings):
+  return [(port_name, f'https://www.lua.org/ftp/lua-{TAG}.tar.gz', HASH)]
+
+
 def get(ports, settings, shared):
   # get the port
-  ports.fetch_project(port_name, f'https://www.lua.org/ftp/lua-{TAG}.tar.gz', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     root_path = os.path.join(ports.get_dir(), port_name, f'lua-{TAG}')
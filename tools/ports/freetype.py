@@ -23,8 +23,12 @@ def get_lib_name(settings):
     return 'libfreetype.a'
 
 
+def sources(settings):
+  return [('freetype', f'https://github.com/freetype/freetype/archive/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('freetype', f'https://github.com/freetype/freetype/archive/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('freetype', f'freetype-{TAG}')
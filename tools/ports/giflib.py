@@ -11,8 +11,12 @@ def needed(settings):
   return settings.USE_GIFLIB
 
 
+def sources(settings):
+  return [('giflib', f'https://storage.googleapis.com/webassembly/emscripten-ports/giflib-{VERSION}.tar.gz', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('giflib', f'https://storage.googleapis.com/webassembly/emscripten-ports/giflib-{VERSION}.tar.gz', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('giflib', f'giflib-{VERSION}')
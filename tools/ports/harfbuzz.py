@@ -78,8 +78,12 @@ def get_lib_name(settings):
   return 'libharfbuzz' + ('-mt' if settings.PTHREADS else '') + '.a'
 
 
+def sources(settings):
+  return [('harfbuzz', f'https://github.com/harfbuzz/harfbuzz/releases/download/{VERSION}/harfbuzz-{VERSION}.tar.xz', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('harfbuzz', f'https://github.com/harfbuzz/harfbuzz/releases/download/{VERSION}/harfbuzz-{VERSION}.tar.xz', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('harfbuzz', 'harfbuzz-' + VERSION)
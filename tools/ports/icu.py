@@ -25,8 +25,12 @@ def get_lib_name(base_name, settings):
   return base_name + ('-mt' if settings.PTHREADS else '') + '.a'
 
 
+def sources(settings):
+  return [('icu', f'https://github.com/unicode-org/icu/releases/download/{TAG}/icu4c-{VERSION}-src.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('icu', f'https://github.com/unicode-org/icu/releases/download/{TAG}/icu4c-{VERSION}-src.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
   icu_source_path = None
 
   def prepare_build():
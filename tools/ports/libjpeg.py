@@ -14,11 +14,15 @@ def needed(settings):
   return settings.USE_LIBJPEG
 
 
-def get(ports, settings, shared):
+def sources(settings):
   # Archive mirrored from http://www.ijg.org/files/jpegsrc.v9f.tar.gz.
   # We have issues where python urllib was not able to load from the www.ijg.org webserver
   # and was resulting in 403: Forbidden.
-  ports.fetch_project('libjpeg', f'https://storage.googleapis.com/webassembly/emscripten-ports/jpegsrc.v{VERSION}.tar.gz', sha512hash=HASH)
+  return [('libjpeg', f'https://storage.googleapis.com/webassembly/emscripten-ports/jpegsrc.v{VERSION}.tar.gz', HASH)]
+
+
+def get(ports, settings, shared):
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('libjpeg', f'jpeg-{VERSION}')
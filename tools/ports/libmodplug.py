@@ -14,8 +14,12 @@ def needed(settings):
   return settings.USE_MODPLUG
 
 
+def sources(settings):
+  return [('libmodplug', f'https://github.com/jancc/libmodplug/archive/v{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('libmodplug', f'https://github.com/jancc/libmodplug/archive/v{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('libmodplug', 'libmodplug-' + TAG)
@@ -30,9 +30,13 @@ def get_lib_name(settings):
   return f'libpng{suffix}.a'
 
 
-def get(ports, settings, shared):
+def sources(settings):
   # This is an emscripten-hosted mirror of the libpng repo from Sourceforge.
-  ports.fetch_project('libpng', f'https://storage.googleapis.com/webassembly/emscripten-ports/libpng-{TAG}.tar.gz', sha512hash=HASH)
+  return [('libpng', f'https://storage.googleapis.com/webassembly/emscripten-ports/libpng-{TAG}.tar.gz', HASH)]
+
+
+def get(ports, settings, shared):
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('libpng', 'libpng-' + TAG)
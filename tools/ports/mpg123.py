@@ -14,8 +14,12 @@ def needed(settings):
   return settings.USE_MPG123
 
 
+def sources(settings):
+  return [('mpg123', f'https://www.mpg123.de/download/mpg123-{TAG}.tar.bz2', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('mpg123', f'https://www.mpg123.de/download/mpg123-{TAG}.tar.bz2', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('mpg123', 'mpg123-' + TAG)
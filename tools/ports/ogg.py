@@ -14,8 +14,12 @@ def needed(settings):
   return settings.USE_OGG
 
 
+def sources(settings):
+  return [('ogg', f'https://github.com/xiph/ogg/releases/download/v{VERSION}/libogg-{VERSION}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('ogg', f'https://github.com/xiph/ogg/releases/download/v{VERSION}/libogg-{VERSION}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('ogg', 'libogg-' + VERSION)
@@ -19,8 +19,12 @@ def get_lib_name(settings):
   return 'libregal' + ('-mt' if settings.PTHREADS else '') + '.a'
 
 
+def sources(settings):
+  return [('regal', f'https://github.com/emscripten-ports/regal/archive/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('regal', f'https://github.com/emscripten-ports/regal/archive/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('regal', 'regal-' + TAG)
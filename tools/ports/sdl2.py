@@ -27,9 +27,13 @@ def process_dependencies(settings, cflags_only):
     settings.EXPORTED_RUNTIME_METHODS.append('createContext')
 
 
+def sources(settings):
+  return [('sdl2', f'https://github.com/libsdl-org/SDL/archive/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
   # get the port
-  ports.fetch_project('sdl2', f'https://github.com/libsdl-org/SDL/archive/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     # copy includes to a location so they can be used as 'SDL2/'
@@ -13,8 +13,12 @@ def needed(settings):
   return settings.USE_SDL_GFX == 2
 
 
+def sources(settings):
+  return [('sdl2_gfx', f'https://github.com/svn2github/sdl2_gfx/archive/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('sdl2_gfx', f'https://github.com/svn2github/sdl2_gfx/archive/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('sdl2_gfx', 'sdl2_gfx-' + TAG)
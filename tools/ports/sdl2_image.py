@@ -50,8 +50,12 @@ def get_lib_name(settings):
   return libname + '.a'
 
 
+def sources(settings):
+  return [('sdl2_image', f'https://github.com/libsdl-org/SDL_image/archive/refs/tags/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('sdl2_image', f'https://github.com/libsdl-org/SDL_image/archive/refs/tags/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
   libname = get_lib_name(settings)
 
   def create(final):
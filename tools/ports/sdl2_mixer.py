@@ -50,8 +50,12 @@ def get_lib_name(settings):
   return libname
 
 
+def sources(settings):
+  return [('sdl2_mixer', f'https://github.com/libsdl-org/SDL_mixer/archive/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('sdl2_mixer', f'https://github.com/libsdl-org/SDL_mixer/archive/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
   libname = get_lib_name(settings)
 
   def create(final):
@@ -13,8 +13,12 @@ def needed(settings):
   return settings.USE_SDL_NET == 2
 
 
+def sources(settings):
+  return [('sdl2_net', f'https://github.com/emscripten-ports/SDL2_net/archive/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('sdl2_net', f'https://github.com/emscripten-ports/SDL2_net/archive/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     src_dir = ports.get_dir('sdl2_net', 'SDL2_net-' + TAG)
@@ -19,8 +19,12 @@ def get_lib_name(settings):
   return 'libSDL2_ttf' + ('-mt' if settings.PTHREADS else '') + '.a'
 
 
+def sources(settings):
+  return [('sdl2_ttf', f'https://github.com/libsdl-org/SDL_ttf/archive/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('sdl2_ttf', f'https://github.com/libsdl-org/SDL_ttf/archive/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     src_root = ports.get_dir('sdl2_ttf', 'SDL_ttf-' + TAG)
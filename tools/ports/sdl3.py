@@ -25,9 +25,13 @@ def get_lib_name(settings):
   return 'libSDL3' + ('-mt' if settings.PTHREADS else '') + '.a'
 
 
+def sources(settings):
+  return [('sdl3', f'https://github.com/libsdl-org/SDL/archive/{TAG}.zip', HASH)]
+
+
 def get(ports, settings, shared):
   # get the port
-  ports.fetch_project('sdl3', f'https://github.com/libsdl-org/SDL/archive/{TAG}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     diagnostics.warning('experimental', 'sdl3 port is still experimental')
@@ -8,6 +8,7 @@
 VERSION = (3, 39, 0)
 VERSION_YEAR = 2022
 HASH = 'cbaf4adb3e404d9aa403b34f133c5beca5f641ae1e23f84dbb021da1fb9efdc7c56b5922eb533ae5cb6d26410ac60cb3f026085591bc83ebc1c225aed0cf37ca'
+RELEASE = f'sqlite-amalgamation-{VERSION[0]}{VERSION[1]:02}{VERSION[2]:02}00'
 
 variants = {'sqlite3-mt': {'PTHREADS': 1}}
 
@@ -20,13 +21,16 @@ def get_lib_name(settings):
   return 'libsqlite3' + ('-mt' if settings.PTHREADS else '') + '.a'
 
 
-def get(ports, settings, shared):
-  release = f'sqlite-amalgamation-{VERSION[0]}{VERSION[1]:02}{VERSION[2]:02}00'
+def sources(settings):
   # TODO: Fetch the file from an emscripten-hosted mirror.
-  ports.fetch_project('sqlite3', f'https://www.sqlite.org/{VERSION_YEAR}/{release}.zip', sha512hash=HASH)
+  return [('sqlite3', f'https://www.sqlite.org/{VERSION_YEAR}/{RELEASE}.zip', HASH)]
+
+
+def get(ports, settings, shared):
+  ports.fetch_sources(sources(settings))
 
   def create(final):
-    source_path = ports.get_dir('sqlite3', release)
+    source_path = ports.get_dir('sqlite3', RELEASE)
 
     ports.install_headers(source_path)
     ports.make_pkg_config('sqlite', ','.join(str(v) for v in VERSION), '-sUSE_SQLITE3')
@@ -15,8 +15,12 @@ def needed(settings):
   return settings.USE_VORBIS
 
 
+def sources(settings):
+  return [('vorbis', f'https://github.com/xiph/vorbis/releases/download/v{VERSION}/libvorbis-{VERSION}.zip', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('vorbis', f'https://github.com/xiph/vorbis/releases/download/v{VERSION}/libvorbis-{VERSION}.zip', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('vorbis', 'libvorbis-' + VERSION)
@@ -14,8 +14,12 @@ def needed(settings):
   return settings.USE_ZLIB
 
 
+def sources(settings):
+  return [('zlib', f'https://github.com/madler/zlib/archive/refs/tags/v{VERSION}.tar.gz', HASH)]
+
+
 def get(ports, settings, shared):
-  ports.fetch_project('zlib', f'https://github.com/madler/zlib/archive/refs/tags/v{VERSION}.tar.gz', sha512hash=HASH)
+  ports.fetch_sources(sources(settings))
 
   def create(final):
     source_path = ports.get_dir('zlib', 'zlib-' + VERSION)
@@ -51,6 +51,9 @@ import contextlib
 DEBUG_SAVE = DEBUG or int(os.environ.get('EMCC_DEBUG_SAVE', '0'))
 PRINT_SUBPROCS = int(os.getenv('EMCC_VERBOSE', '0'))
 SKIP_SUBPROCS = False
+# When set to a semaphore, limits the total number of subprocesses that
+# run_multiple_processes() runs at once across all threads of the process.
+JOB_SLOTS = None
 
 # Minimum node version required to run the emscripten compiler.  This is
 # distinct from the minimum version required to execute the generated code
@@ -115,6 +118,15 @@ def run_process(cmd, check=True, input=None, *args, **kw):
   return ret
 
 
+def acquire_job_slot(blocking):
+  return JOB_SLOTS is None or JOB_SLOTS.acquire(blocking)
+
+
+def release_job_slot():
+  if JOB_SLOTS is not None:
+    JOB_SLOTS.release()
+
+
 def returncode_to_str(code):
   assert code != 0
   if code < 0:
@@ -169,29 +181,46 @@ def run_multiple_processes(commands,
   temp_files = get_temp_files()
   i = 0
   num_completed = 0
-  while num_completed < len(commands):
-    if i < len(commands) and len(processes) < num_parallel_processes:
-      # Not enough parallel processes running, spawn a new one.
-      if route_stdout_to_temp_files_suffix:
-        stdout = temp_files.get(route_stdout_to_temp_files_suffix)
+  try:
+    while num_completed < len(commands):
+      # When the job slots are shared with other threads, only block waiting for
+      # a free slot if there are no processes of our own to wait for.
+      if i < len(commands) and len(processes) < num_parallel_processes and acquire_job_slot(blocking=not processes):
+        # Not enough parallel processes running, spawn a new one.
+        if route_stdout_to_temp_files_suffix:
+          stdout = temp_files.get(route_stdout_to_temp_files_suffix)
+        else:
+          stdout = None
+        if DEBUG:
+          logger.debug('Running subprocess %d/%d: %s' % (i + 1, len(commands), ' '.join(commands[i])))
+        print_compiler_stage(commands[i])
+        try:
+          proc = subprocess.Popen(commands[i], stdout=stdout, stderr=None, env=env, cwd=cwd)
+        except BaseException:
+          release_job_slot()
+          raise
+        processes[i] = proc
+        if route_stdout_to_temp_files_suffix:
+          std_outs.append((i, stdout.name))
+        i += 1
       else:
-        stdout = None
-      if DEBUG:
-        logger.debug('Running subprocess %d/%d: %s' % (i + 1, len(commands), ' '.join(commands[i])))
-      print_compiler_stage(commands[i])
-      proc = subprocess.Popen(commands[i], stdout=stdout, stderr=None, env=env, cwd=cwd)
-      processes[i] = proc
-      if route_stdout_to_temp_files_suffix:
-        std_outs.append((i, stdout.name))
-      i += 1
-    else:
-      # Not spawning a new process (Too many commands running in parallel, or
-      # no commands left): find if a process has finished.
-      idx = get_finished_process()
-      finished_process = processes.pop(idx)
-      if finished_process.returncode != 0:
-        exit_with_error('subprocess %d/%d failed (%s)! (cmdline: %s)' % (idx + 1, len(commands), returncode_to_str(finished_process.returncode), shlex.join(commands[idx])))
-      num_completed += 1
+        # Not spawning a new process (Too many commands running in parallel, or
+        # no commands left): find if a process has finished.
+        idx = get_finished_process()
+        finished_process = processes.pop(idx)
+        release_job_slot()
+        if finished_process.returncode != 0:
+          exit_with_error('subprocess %d/%d failed (%s)! (cmdline: %s)' % (idx + 1, len(commands), returncode_to_str(finished_process.returncode), shlex.join(commands[idx])))
+        num_completed += 1
+  finally:
+    # When a process fails, stop the ones that are still running, and only
+    # then release their job slots, so that the other threads sharing them
+    # never run more processes than there are slots.
+    for proc in processes.values():
+      proc.kill()
+    for proc in processes.values():
+      proc.wait()
+      release_job_slot()
 
   if route_stdout_to_temp_files_suffix:
     # If processes finished out of order, sort the results to the order of the input.
@@ -220,6 +249,7 @@ def exec_process(cmd):
   else:
     sys.stdout.flush()
     sys.stderr.flush()
+    ToolchainProfiler.flush_log()
     os.execvp(cmd[0], cmd)
 
 
@@ -466,7 +496,7 @@ def check_sanity(force=False, quiet=False):
       logger.info('old sanity: %s', sanity_data.strip())
       logger.info('new sanity: %s', expected.strip())
       logger.info('(Emscripten: config changed, clearing cache)')
-      cache.erase()
+      cache.erase(keep_system_headers=True)
     else:
       logger.debug(f'sanity file not found: {sanity_file}')
 
@@ -7,16 +7,20 @@ import re
 from time import time
 from .toolchain_profiler import ToolchainProfiler
 
+import hashlib
 import itertools
+import json
 import logging
 import os
 import shutil
 import textwrap
 import shlex
 import subprocess
+import threading
 from enum import IntEnum, auto
 from glob import iglob
-from typing import List, Optional
+from subprocess import PIPE
+from typing import Dict, List, Optional
 
 from . import shared, building, utils
 from . import diagnostics
@@ -43,6 +47,18 @@ LIBC_SOCKETS = ['socket.c', 'socketpair.c', 'shutdown.c', 'bind.c', 'connect.c',
 # link time.
 USE_NINJA = int(os.environ.get('EMCC_USE_NINJA', '0'))
 
+# Experimental: Setting EMCC_PARTIAL_LIBS=1 means that when a variation of a
+# library is missing from the cache, but another variation of it has already
+# been built, only the objects needed by the current link get compiled.  The
+# symbols of the variation that has been built are used to find them.  The
+# resulting partial archive (e.g. libc-mt-debug.partial.a) is extended by later
+# links that need more of it.  If a link fails using partial archives then the
+# complete libraries are built and the link is retried.
+PARTIAL_LIBS = int(os.environ.get('EMCC_PARTIAL_LIBS', '0'))
+
+# The partial archives used by the current link, mapped to their libraries.
+partial_libs: Dict[str, 'Library'] = {}
+
 # A (fake) deterministic emscripten path to use in __FILE__ macro and debug info
 # to produce reproducible builds across platforms.
 DETERMINISTIC_PREFIX = '/emsdk/emscripten'
@@ -154,6 +170,169 @@ def create_lib(libname, inputs):
     building.emar('cr', libname, inputs)
 
 
+def get_object_key(filename):
+  """Returns the name that identifies the object file compiled from the given
+  source file (or the given archive member) across variations of a library.
+  Object files are named after their sources, except that the case may differ
+  and a `__N` suffix is added to make the names unique."""
+  return re.sub(r'__\d+$', '', shared.unsuffixed_basename(filename).lower())
+
+
+def get_object_names(files):
+  """Maps each of the given source files to a unique object file name."""
+  names = {}
+  for src in files:
+    basename = shared.unsuffixed_basename(src).lower()
+    name = basename + '.o'
+    object_uuid = 0
+    while name in names.values():
+      object_uuid += 1
+      name = f'{basename}__{object_uuid}.o'
+    names[src] = name
+  return names
+
+
+def parse_nm_output(output, default_member):
+  """Parses the output of llvm-nm into a mapping from object key to the sets
+  of defined and undefined global symbols of those objects."""
+  index = {}
+  member = default_member
+  for line in output.splitlines():
+    parts = line.split()
+    if not parts:
+      continue
+    if len(parts) == 1 and line.endswith(':'):
+      member = line[:-1]
+      continue
+    symtype, name = parts[-2:]
+    defs, undefs = index.setdefault(get_object_key(member), (set(), set()))
+    if symtype == 'U':
+      undefs.add(name)
+    elif symtype.isupper():
+      # Lower case types are local symbols, or weak undefined symbols (`w`),
+      # which don't cause archive members to be included.
+      defs.add(name)
+  return index
+
+
+def get_symbol_index(filename):
+  """Returns the defined and undefined symbols of each object in the given
+  archive (or object file), keyed by `get_object_key`.
+
+  The result is cached in the build directory, keyed by the contents of the
+  file, since system libraries are indexed on every link that uses partial
+  libraries.
+  """
+  digest = hashlib.sha256(utils.read_binary(filename)).hexdigest()
+  index_file = os.path.join(get_build_dir(), 'symbol_index', digest + '.json')
+  if os.path.exists(index_file):
+    index = json.loads(read_file(index_file))
+    return {key: (set(defs), set(undefs)) for key, (defs, undefs) in index.items()}
+  output = shared.check_call([shared.LLVM_NM, filename], stdout=PIPE, stderr=PIPE).stdout
+  index = parse_nm_output(output, filename)
+  utils.safe_ensure_dirs(os.path.dirname(index_file))
+  utils.write_file(index_file + '.tmp', json.dumps({key: [sorted(defs), sorted(undefs)] for key, (defs, undefs) in index.items()}))
+  os.replace(index_file + '.tmp', index_file)
+  return index
+
+
+def get_undefined_symbols(filenames):
+  """Returns the symbols that the given object files and archives reference
+  but do not define."""
+  if not filenames:
+    return set()
+  cmd = building.get_command_with_possible_response_file([shared.LLVM_NM] + filenames)
+  output = shared.check_call(cmd, stdout=PIPE, stderr=PIPE).stdout
+  all_defs = set()
+  all_undefs = set()
+  for defs, undefs in parse_nm_output(output, filenames[0]).values():
+    all_defs.update(defs)
+    all_undefs.update(undefs)
+  return all_undefs - all_defs
+
+
+def select_objects(roots, indexes):
+  """Finds the objects that the linker could include from the given libraries,
+  starting from the `roots` symbols.
+
+  `indexes` maps library names to their symbol indexes.  Every object that
+  defines a needed symbol is selected (not just the first one the linker would
+  find), so the result is a superset of what the linker would include from the
+  complete libraries.  Returns a mapping from library name to the selected
+  object keys.
+  """
+  providers = {}
+  for libname, index in indexes.items():
+    for key, (defs, _) in index.items():
+      for sym in defs:
+        providers.setdefault(sym, []).append((libname, key))
+
+  selected = {libname: set() for libname in indexes}
+  needed = list(roots)
+  seen = set(roots)
+  while needed:
+    sym = needed.pop()
+    for libname, key in providers.get(sym, []):
+      if key not in selected[libname]:
+        selected[libname].add(key)
+        for undef in indexes[libname][key][1]:
+          if undef not in seen:
+            seen.add(undef)
+            needed.append(undef)
+  return selected
+
+
+def build_partial_libraries(libs, other_libs, roots):
+  """Partially builds the given libraries so that they contain (at least) the
+  objects needed by a link which needs `roots` and also links `other_libs`.
+  Returns a mapping from library to the path of its partial archive.
+
+  The objects are selected using the symbol index of another, already built,
+  variation of each library.  Since the variations can differ (e.g. debug
+  builds reference more symbols) this is repeated using the actual symbols of
+  the objects compiled so far, until no new objects are needed.
+  """
+  roots = set(roots)
+  indexes = {}
+  for lib in other_libs:
+    index = get_symbol_index(lib.build())
+    if lib.get_ext() == '.a':
+      indexes[lib.name] = index
+    else:
+      # Object files are always linked in completely.
+      for _, undefs in index.values():
+        roots.update(undefs)
+
+  base_indexes = {lib: get_symbol_index(lib.partial_index_source) for lib in libs}
+  with cache.lock('partial system libraries'):
+    while True:
+      for lib in libs:
+        index = dict(base_indexes[lib])
+        if os.path.exists(lib.get_partial_path()):
+          index.update(get_symbol_index(lib.get_partial_path()))
+        indexes[lib.name] = index
+      selected = select_objects(roots, indexes)
+      compiled = False
+      for lib in libs:
+        if lib.build_partial(selected[lib.name], base_indexes[lib]):
+          compiled = True
+      if not compiled:
+        break
+
+  return {lib: lib.get_partial_path() for lib in libs}
+
+
+def complete_partial_libs(linker_args):
+  """Builds the complete libraries for all the partial archives in the given
+  link command and replaces the partial archives with them."""
+  rtn = []
+  for arg in linker_args:
+    if arg in partial_libs:
+      arg = partial_libs.pop(arg).get_link_flag()
+    rtn.append(arg)
+  return rtn
+
+
 def get_top_level_ninja_file():
   return os.path.join(get_build_dir(), 'build.ninja')
 
@@ -493,20 +672,7 @@ class Library:
     objects = set()
     cflags = self.get_cflags()
     for src in self.get_files():
-      ext = shared.suffix(src)
-      if ext in {'.s', '.S', '.c'}:
-        cmd = shared.EMCC
-      else:
-        cmd = shared.EMXX
-      cmd = [cmd, '-c']
-      if ext == '.s':
-        # .s files are processed directly by the assembler.  In this case we can't pass
-        # pre-processor flags such as `-I` and `-D` but we still want core flags such as
-        # `-sMEMORY64`.
-        cmd += get_base_cflags(self.build_dir, preprocess=False)
-      else:
-        cmd += cflags
-      cmd = self.customize_build_cmd(cmd, src)
+      cmd = self.get_build_cmd(src, cflags)
 
       object_basename = shared.unsuffixed_basename(src).lower()
       o = os.path.join(build_dir, object_basename + '.o')
@@ -549,6 +715,24 @@ class Library:
     run_build_commands(commands, num_inputs=len(objects), build_dir=build_dir)
     return objects
 
+  def get_build_cmd(self, src, cflags):
+    """Returns the command used to compile the given source file (without the
+    input and output filenames)."""
+    ext = shared.suffix(src)
+    if ext in {'.s', '.S', '.c'}:
+      cmd = shared.EMCC
+    else:
+      cmd = shared.EMXX
+    cmd = [cmd, '-c']
+    if ext == '.s':
+      # .s files are processed directly by the assembler.  In this case we can't pass
+      # pre-processor flags such as `-I` and `-D` but we still want core flags such as
+      # `-sMEMORY64`.
+      cmd += get_base_cflags(self.build_dir, preprocess=False)
+    else:
+      cmd += cflags
+    return self.customize_build_cmd(cmd, src)
+
   def customize_build_cmd(self, cmd, _filename):
     """Allows libraries to customize the build command used on per-file basis.
 
@@ -575,6 +759,79 @@ class Library:
   def do_generate(self, out_filename):
     self.do_build(out_filename, generate_only=True)
 
+  def get_partial_path(self):
+    """Returns the path of the partial archive of this library (see
+    EMCC_PARTIAL_LIBS)."""
+    return cache.get_lib_name(self.get_base_name() + '.partial' + self.get_ext(), absolute=True)
+
+  def find_built_variation(self):
+    """Returns the path of an already built variation of this library, or None.
+
+    If there are several then the one with the most source files in common
+    with this variation is chosen.
+    """
+    keys = {get_object_key(f) for f in self.get_files()}
+    best = None
+    best_overlap = -1
+    for flags in type(self).variations():
+      variation = type(self)(**flags)
+      if variation.get_base_name() == self.get_base_name() or not variation.can_build():
+        continue
+      for path in cache.get_layer_paths(variation.get_path()):
+        if path.exists():
+          overlap = len(keys.intersection(get_object_key(f) for f in variation.get_files()))
+          if overlap > best_overlap:
+            best = str(path)
+            best_overlap = overlap
+          break
+    return best
+
+  def can_build_partially(self):
+    """Whether this library should be partially built for the current link.
+
+    This is the case when it is missing from the cache but another variation
+    of it has been built.
+    """
+    if self.get_ext() != '.a' or USE_NINJA:
+      return False
+    if any(p.exists() for p in cache.get_layer_paths(self.get_path())):
+      return False
+    self.partial_index_source = self.find_built_variation()
+    return self.partial_index_source is not None
+
+  def build_partial(self, keys, base_index):
+    """Compiles the objects with the given keys that have not been compiled
+    yet, along with any source files that `base_index` (the index of the
+    variation used to select the objects) does not know about, and updates the
+    partial archive.  Returns True if anything was compiled."""
+    build_dir = os.path.join(get_build_dir(), self.get_base_name() + '-partial')
+    utils.safe_ensure_dirs(build_dir)
+    self.build_dir = build_dir
+    partial_path = self.get_partial_path()
+
+    cflags = self.get_cflags()
+    files = self.get_files()
+    commands = []
+    for src, name in get_object_names(files).items():
+      key = get_object_key(src)
+      o = os.path.join(build_dir, name)
+      if (key in keys or key not in base_index) and not os.path.exists(o):
+        commands.append(self.get_build_cmd(src, cflags) + [src, '-o', o])
+
+    if commands:
+      logger.info(f'partially building system library: {self.get_filename()} ({len(commands)} of {len(files)} sources)')
+      run_build_commands(commands, num_inputs=len(commands), build_dir=build_dir)
+    elif os.path.exists(partial_path):
+      return False
+
+    objects = [os.path.join(build_dir, f) for f in os.listdir(build_dir) if f.endswith('.o')]
+    utils.safe_ensure_dirs(os.path.dirname(partial_path))
+    # Replace the archive atomically since other processes may be linking with
+    # it without holding the cache lock.
+    create_lib(partial_path + '.tmp.a', objects)
+    os.replace(partial_path + '.tmp.a', partial_path)
+    return bool(commands)
+
   @classmethod
   def _inherit_list(cls, attr):
     # Some properties, like cflags and includes, makes more sense to inherit
@@ -2322,7 +2579,7 @@ def get_libs_to_link(options):
     logger.debug('including %s (%s)' % (lib.name, lib.get_filename()))
 
     need_whole_archive = lib.name in force_include and lib.get_ext() == '.a'
-    libs_to_link.append((lib.get_link_flag(), whole_archive or need_whole_archive))
+    libs_to_link.append((lib, whole_archive or need_whole_archive))
 
   if not options.nostartfiles:
     if settings.SHARED_MEMORY:
@@ -2453,8 +2710,27 @@ def get_libs_to_link(options):
   return libs_to_link
 
 
-def calculate(options):
-  libs_to_link = get_libs_to_link(options)
+def get_link_flags(libs_to_link, partial_roots):
+  """Builds the given libraries (as needed) and returns their link flags.
+
+  If `partial_roots` (the symbols that the link needs from the system
+  libraries) is given then libraries that can be built partially (see
+  EMCC_PARTIAL_LIBS) are only built as far as needed for these.
+  """
+  partial = []
+  if partial_roots is not None:
+    partial = [lib for lib, whole_archive in libs_to_link if not whole_archive and lib.can_build_partially()]
+  flags = {lib: lib.get_link_flag() for lib, _ in libs_to_link if lib not in partial}
+  if partial:
+    other_libs = [lib for lib, _ in libs_to_link if lib not in partial]
+    for lib, path in build_partial_libraries(partial, other_libs, partial_roots).items():
+      flags[lib] = path
+      partial_libs[path] = lib
+  return [(flags[lib], whole_archive) for lib, whole_archive in libs_to_link]
+
+
+def calculate(options, partial_roots=None):
+  libs_to_link = get_link_flags(get_libs_to_link(options), partial_roots)
 
   # When LINKABLE is set the entire link command line is wrapped in --whole-archive by
   # building.link_ldd.  And since --whole-archive/--no-whole-archive processing does not nest we
@@ -2480,23 +2756,171 @@ def calculate(options):
   return ret
 
 
-def safe_copytree(src, dst, excludes=None):
-  # We cannot use `shutil.copytree` there because we need to ensure the
-  # output tree is writable, and in some cases the emscripten tree
-  # itself is readonly (e.g. NixOS).
-  # Even if we pass copy_function=safe_copy python's `shutil.copytree`
-  # will use its internal logic for copying directories and it will
-  # unconditionally copy the source directory's mode bits.
-  os.makedirs(dst, exist_ok=True)
-  for entry in os.scandir(src):
-    if excludes and entry.name in excludes:
-      continue
-    srcname = os.path.join(src, entry.name)
-    dstname = os.path.join(dst, entry.name)
-    if entry.is_dir():
-      safe_copytree(srcname, dstname, excludes)
+# Setting EMCC_SYSROOT_LINK to `hardlink` or `reflink` installs the system
+# headers into the sysroot by hard linking or cloning (on filesystems that
+# support it, e.g. btrfs or XFS) the files in the emscripten tree rather than
+# copying them.  This falls back to copying when the cache is on another
+# filesystem.  Note that with `hardlink` modifying the installed headers in
+# place would modify the emscripten tree.
+SYSROOT_LINK = os.environ.get('EMCC_SYSROOT_LINK')
+
+# Serializes updates to the install manifest between threads, e.g. embuilder
+# installing the headers of several ports at once.
+install_manifest_lock = threading.Lock()
+
+
+def reflink_file(src, dst):
+  """Clones the contents of `src` into `dst` using the FICLONE ioctl (Linux
+  only).  Raises OSError if that is not supported."""
+  try:
+    import fcntl
+  except ImportError:
+    raise OSError('reflinks are not supported on this platform') from None
+  FICLONE = 0x40049409
+  with open(src, 'rb') as s, open(dst, 'wb') as d:
+    fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class InstallManifest:
+  """Tracks the files that are installed into the sysroot so that installing
+  them again only touches the files that changed.
+
+  For each installed file (keyed by its path relative to the sysroot) the
+  manifest records the source path, the size, mtime and sha256 of the source
+  and the size and mtime of the installed file.  A file is skipped if its
+  installed copy is unchanged and its source either has the same size and
+  mtime or, failing that, the same hash.  Files that are not in the manifest
+  yet are compared by content before being overwritten.
+
+  Skipping unchanged files also avoids racing with other processes that read
+  the headers without holding the cache lock (e.g. normal compile steps) while
+  a new flavor of a port is built and its headers are "re-installed".  Files
+  that did change are replaced atomically rather than rewritten in place.
+
+  The system headers (and their entries) are kept when the cache is cleared
+  because the configuration changed (see `cache.erase`), so that they are not
+  all rewritten when they are installed again.
+  """
+
+  def __init__(self):
+    self.sysroot = cache.get_sysroot_dir()
+    self.filename = os.path.join(self.sysroot, cache.INSTALL_MANIFEST)
+    self.entries = {}
+    if os.path.exists(self.filename):
+      self.entries = json.loads(read_file(self.filename))
+    self.updated = {}
+    self.link_failed = False
+
+  def get_key(self, dest):
+    key = os.path.relpath(dest, self.sysroot)
+    if key.startswith('..'):
+      return None
+    return utils.normalize_path(key)
+
+  def is_installed(self, src, dest, key, src_stat):
+    entry = self.entries.get(key)
+    try:
+      dest_stat = os.stat(dest)
+    except FileNotFoundError:
+      return False
+    if entry and entry[0] == utils.normalize_path(src):
+      if entry[4:] != [dest_stat.st_size, dest_stat.st_mtime_ns]:
+        # The installed file was changed by something else
+        return False
+      if entry[1:3] == [src_stat.st_size, src_stat.st_mtime_ns]:
+        return True
+      return hash_file(src) == entry[3]
+    return src_stat.st_size == dest_stat.st_size and utils.read_binary(src) == utils.read_binary(dest)
+
+  def install(self, src, dest, link=None):
+    """Installs `src` as `dest` (if needed).  `link` can be `hardlink` or
+    `reflink`.  Returns True if the file was (re)installed."""
+    key = self.get_key(dest)
+    src_stat = os.stat(src)
+    if key and self.is_installed(src, dest, key, src_stat):
+      self.record(key, src, src_stat, dest)
+      return False
+
+    tmp = dest + '.tmp'
+    utils.delete_file(tmp)
+    linked = False
+    if link and not self.link_failed:
+      try:
+        if link == 'hardlink':
+          os.link(src, tmp)
+        else:
+          reflink_file(src, tmp)
+        linked = True
+      except OSError as e:
+        logger.debug(f'unable to {link} {src} (falling back to copying): {e}')
+        utils.delete_file(tmp)
+        self.link_failed = True
+    if not linked:
+      shared.safe_copy(src, tmp)
+    os.replace(tmp, dest)
+    if key:
+      self.record(key, src, src_stat, dest)
+    return True
+
+  def record(self, key, src, src_stat, dest):
+    entry = self.entries.get(key)
+    if entry and entry[:3] == [utils.normalize_path(src), src_stat.st_size, src_stat.st_mtime_ns]:
+      digest = entry[3]
     else:
-      shared.safe_copy(srcname, dstname)
+      digest = hash_file(src)
+    dest_stat = os.stat(dest)
+    entry = [utils.normalize_path(src), src_stat.st_size, src_stat.st_mtime_ns, digest, dest_stat.st_size, dest_stat.st_mtime_ns]
+    if self.entries.get(key) != entry:
+      self.updated[key] = entry
+    self.entries[key] = entry
+
+  def remove_stale(self, src_dir, installed):
+    """Deletes installed files that came from `src_dir` but were not part of
+    `installed` (e.g. headers that were removed from emscripten)."""
+    src_dir = utils.normalize_path(src_dir) + '/'
+    installed = set(installed)
+    for key, entry in list(self.entries.items()):
+      if entry[0].startswith(src_dir) and key not in installed:
+        logger.debug(f'removing stale installed file: {key}')
+        utils.delete_file(os.path.join(self.sysroot, key))
+        del self.entries[key]
+        self.updated[key] = None
+
+  def save(self):
+    if not self.updated:
+      return
+    with install_manifest_lock:
+      # Merge with any updates made by other threads since we loaded it.
+      entries = {}
+      if os.path.exists(self.filename):
+        entries = json.loads(read_file(self.filename))
+      for key, entry in self.updated.items():
+        if entry is None:
+          entries.pop(key, None)
+        else:
+          entries[key] = entry
+      utils.safe_ensure_dirs(self.sysroot)
+      utils.write_file(self.filename + '.tmp', json.dumps(entries, sort_keys=True))
+      os.replace(self.filename + '.tmp', self.filename)
+    self.updated = {}
+
+
+def hash_file(filename):
+  return hashlib.sha256(utils.read_binary(filename)).hexdigest()
+
+
+def list_tree_files(src_dir, dest_dir, excludes=None):
+  """Maps the destination path of each file under `src_dir` (when installed
+  into `dest_dir`) to its source path."""
+  files = {}
+  for root, dirs, filenames in os.walk(src_dir):
+    if excludes:
+      dirs[:] = [d for d in dirs if d not in excludes]
+    target = os.path.join(dest_dir, os.path.relpath(root, src_dir))
+    for f in filenames:
+      if not excludes or f not in excludes:
+        files[os.path.normpath(os.path.join(target, f))] = os.path.join(root, f)
+  return files
 
 
 def install_system_headers(stamp):
@@ -2515,28 +2939,52 @@ def install_system_headers(stamp):
     'system/lib/mimalloc/include': '',
   }
 
+  # Later directories are overlaid on top of earlier ones, so each file is
+  # installed from the last directory that has it.
+  files = {}
   target_include_dir = cache.get_include_dir()
   for src, dest in install_dirs.items():
     src = utils.path_from_root(src)
     dest = os.path.join(target_include_dir, dest)
-    safe_copytree(src, dest, excludes={'alltypes.h.in'})
+    files.update(list_tree_files(src, dest, excludes={'alltypes.h.in'}))
 
   pkgconfig_src = utils.path_from_root('system/lib/pkgconfig')
   pkgconfig_dest = cache.get_sysroot_dir('lib/pkgconfig')
-  safe_copytree(pkgconfig_src, pkgconfig_dest)
+  files.update(list_tree_files(pkgconfig_src, pkgconfig_dest))
 
   bin_src = utils.path_from_root('system/bin')
   bin_dest = cache.get_sysroot_dir('bin')
-  safe_copytree(bin_src, bin_dest)
+  files.update(list_tree_files(bin_src, bin_dest))
 
-  # Create a version header based on the emscripten-version.txt
+  # The real version.h is generated below.  The one in the source tree is a
+  # placeholder that must never be installed (or linked to).
   version_file = cache.get_include_dir('emscripten/version.h')
-  utils.write_file(version_file, textwrap.dedent(f'''\
+  files.pop(os.path.normpath(version_file), None)
+
+  manifest = InstallManifest()
+  installed = []
+  changed = 0
+  dirs = set()
+  for dest, src in files.items():
+    if os.path.dirname(dest) not in dirs:
+      dirs.add(os.path.dirname(dest))
+      utils.safe_ensure_dirs(os.path.dirname(dest))
+    if manifest.install(src, dest, link=SYSROOT_LINK):
+      changed += 1
+    installed.append(manifest.get_key(dest))
+  logger.debug(f'installed {changed} of {len(files)} sysroot files')
+  manifest.remove_stale(utils.path_from_root('system'), installed)
+  manifest.save()
+
+  # Create a version header based on the emscripten-version.txt
+  version_header = textwrap.dedent(f'''\
   /* Automatically generated by tools/system_libs.py */
   #define __EMSCRIPTEN_major__ {utils.EMSCRIPTEN_VERSION_MAJOR}
   #define __EMSCRIPTEN_minor__ {utils.EMSCRIPTEN_VERSION_MINOR}
   #define __EMSCRIPTEN_tiny__ {utils.EMSCRIPTEN_VERSION_TINY}
-  '''))
+  ''')
+  if not os.path.exists(version_file) or read_file(version_file) != version_header:
+    utils.write_file(version_file, version_header)
 
   # Create a stamp file that signal that the headers have been installed
   # Removing this file, or running `emcc --clear-cache` or running
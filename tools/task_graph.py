@@ -0,0 +1,76 @@
+# Copyright 2025 The Emscripten Authors.  All rights reserved.
+# Emscripten is available under two separate licenses, the MIT license and the
+# University of Illinois/NCSA Open Source License.  Both these licenses can be
+# found in the LICENSE file.
+
+"""Runs a graph of tasks concurrently, as allowed by the data they share."""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .toolchain_profiler import ToolchainProfiler
+
+
+class TaskGraph:
+  """Runs tasks on a pool of threads, as soon as the tasks they depend on are
+  done.
+
+  Each task declares the resources (usually files) that it reads (`inputs`)
+  and writes (`outputs`).  A task depends on the tasks added before it that
+  write any of the resources that it uses, and on those that read any of the
+  resources that it writes.  As a result, running the graph has the same
+  effect as running the tasks one at a time in the order they were added.
+
+  The tasks are expected to spend most of their time in subprocesses, so that
+  running them on threads lets them overlap.  With a single job the tasks
+  are run as soon as they are added.
+  """
+
+  def __init__(self, jobs):
+    self.executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    self.futures = []
+    self.writers = {}
+    self.readers = {}
+
+  def add(self, name, func, inputs=(), outputs=()):
+    deps = set()
+    for resource in set(inputs) | set(outputs):
+      if resource in self.writers:
+        deps.add(self.writers[resource])
+    for resource in outputs:
+      deps.update(self.readers.pop(resource, []))
+
+    def run():
+      for dep in deps:
+        dep.result()
+      with ToolchainProfiler.profile_block(name):
+        return func()
+
+    if self.executor:
+      future = self.executor.submit(run)
+    else:
+      future = Future()
+      future.set_result(run())
+    self.futures.append(future)
+    for resource in inputs:
+      self.readers.setdefault(resource, []).append(future)
+    for resource in outputs:
+      self.writers[resource] = future
+    return future
+
+  def wait(self, *resources):
+    """Waits for the tasks that use the given resources, or all tasks if none
+    are given, and raises the first error that any of them raised."""
+    if resources:
+      futures = []
+      for resource in resources:
+        if resource in self.writers:
+          futures.append(self.writers[resource])
+        futures += self.readers.get(resource, [])
+    else:
+      futures = self.futures
+    for future in futures:
+      future.result()
+
+  def shutdown(self):
+    if self.executor:
+      self.executor.shutdown()
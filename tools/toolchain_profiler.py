@@ -9,6 +9,7 @@ import os
 import sys
 import subprocess
 import tempfile
+import threading
 import time
 from contextlib import ContextDecorator
 
@@ -122,8 +123,14 @@ if EMPROFILE == 1:
     # don't know what the actual process ID is
     imaginary_pid_ = 0
     profiler_logs_path = None # Log file not opened yet
+    # The log file is kept open for the lifetime of the process, and writes to
+    # it are buffered.
+    log_file = None
+    log_file_pid = None
 
-    block_stack = []
+    # The blocks that are open on each thread (e.g. the tasks of a TaskGraph
+    # run on a pool of threads), see get_block_stack().
+    thread_state = threading.local()
 
     # Track if record_process_exit and record_process_start have been called
     # so we can assert they are only ever called once.
@@ -146,6 +153,29 @@ if EMPROFILE == 1:
       # treated as if they were performed by the parent PID.
       return open(os.path.join(ToolchainProfiler.profiler_logs_path, 'toolchain_profiler.pid_' + str(os.getpid()) + '.json'), 'a')
 
+    @staticmethod
+    def write_log(entry):
+      if os.getpid() != ToolchainProfiler.log_file_pid:
+        # Forked subprocessing pool workers exit without running atexit
+        # handlers, so they cannot buffer their writes.
+        with ToolchainProfiler.log_access() as f:
+          f.write(entry)
+        return
+      if ToolchainProfiler.log_file is None:
+        ToolchainProfiler.log_file = ToolchainProfiler.log_access()
+      ToolchainProfiler.log_file.write(entry)
+
+    @staticmethod
+    def flush_log():
+      if ToolchainProfiler.log_file and os.getpid() == ToolchainProfiler.log_file_pid:
+        ToolchainProfiler.log_file.flush()
+
+    @staticmethod
+    def close_log():
+      if ToolchainProfiler.log_file and os.getpid() == ToolchainProfiler.log_file_pid:
+        ToolchainProfiler.log_file.close()
+        ToolchainProfiler.log_file = None
+
     @staticmethod
     def escape_string(arg):
       return arg.replace('\\', '\\\\').replace('"', '\\"')
@@ -167,11 +197,16 @@ if EMPROFILE == 1:
       ToolchainProfiler.profiler_logs_path = os.path.join(tempfile.gettempdir(), 'emscripten_toolchain_profiler_logs')
       os.makedirs(ToolchainProfiler.profiler_logs_path, exist_ok=True)
 
-      ToolchainProfiler.block_stack = []
+      ToolchainProfiler.thread_state = threading.local()
+
+      ToolchainProfiler.log_file_pid = os.getpid()
+      # Flush any buffered log entries before forking, so that they do not get
+      # written a second time by the child process.
+      if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(before=ToolchainProfiler.flush_log)
 
       if write_log_entry:
-        with ToolchainProfiler.log_access() as f:
-          f.write('[\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"start","time":' + ToolchainProfiler.timestamp() + ',"cmdLine":["' + '","'.join(ToolchainProfiler.escape_args(sys.argv)) + '"]}')
+        ToolchainProfiler.write_log('[\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"start","time":' + ToolchainProfiler.timestamp() + ',"cmdLine":["' + '","'.join(ToolchainProfiler.escape_args(sys.argv)) + '"]}')
 
     @staticmethod
     def record_process_exit():
@@ -180,11 +215,11 @@ if EMPROFILE == 1:
       ToolchainProfiler.process_exit_recorded = True
 
       ToolchainProfiler.exit_all_blocks()
-      with ToolchainProfiler.log_access() as f:
-        returncode = process_returncode
-        if returncode is None:
-          returncode = '"MISSING EXIT CODE"'
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"exit","time":' + ToolchainProfiler.timestamp() + ',"returncode":' + str(returncode) + '}\n]\n')
+      returncode = process_returncode
+      if returncode is None:
+        returncode = '"MISSING EXIT CODE"'
+      ToolchainProfiler.write_log(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"exit","time":' + ToolchainProfiler.timestamp() + ',"returncode":' + str(returncode) + '}\n]\n')
+      ToolchainProfiler.close_log()
 
     @staticmethod
     def record_subprocess_spawn(process_pid, process_cmdline):
@@ -195,25 +230,35 @@ if EMPROFILE == 1:
         # throw an exception, but profile the bad input command line as-is
         expanded_cmdline = process_cmdline
 
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"spawn","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + ',"cmdLine":["' + '","'.join(ToolchainProfiler.escape_args(expanded_cmdline)) + '"]}')
+      ToolchainProfiler.write_log(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"tid":' + ToolchainProfiler.thread_id() + ',"op":"spawn","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + ',"cmdLine":["' + '","'.join(ToolchainProfiler.escape_args(expanded_cmdline)) + '"]}')
 
     @staticmethod
     def record_subprocess_wait(process_pid):
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"wait","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + '}')
+      ToolchainProfiler.write_log(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"tid":' + ToolchainProfiler.thread_id() + ',"op":"wait","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + '}')
 
     @staticmethod
     def record_subprocess_finish(process_pid, returncode):
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"finish","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + ',"returncode":' + str(returncode) + '}')
+      ToolchainProfiler.write_log(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"tid":' + ToolchainProfiler.thread_id() + ',"op":"finish","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + ',"returncode":' + str(returncode) + '}')
+
+    @staticmethod
+    def thread_id():
+      # Events on the main thread are recorded as being on the thread with the
+      # ID of the process, as they were before threads were tracked.
+      if threading.current_thread() is threading.main_thread():
+        return str(os.getpid())
+      return str(threading.get_native_id())
+
+    @staticmethod
+    def get_block_stack():
+      if not hasattr(ToolchainProfiler.thread_state, 'block_stack'):
+        ToolchainProfiler.thread_state.block_stack = []
+      return ToolchainProfiler.thread_state.block_stack
 
     @staticmethod
     def enter_block(block_name):
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"enterBlock","name":"' + block_name + '","time":' + ToolchainProfiler.timestamp() + '}')
+      ToolchainProfiler.write_log(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"tid":' + ToolchainProfiler.thread_id() + ',"op":"enterBlock","name":"' + block_name + '","time":' + ToolchainProfiler.timestamp() + '}')
 
-      ToolchainProfiler.block_stack.append(block_name)
+      ToolchainProfiler.get_block_stack().append(block_name)
 
     @staticmethod
     def remove_last_occurrence_if_exists(lst, item):
@@ -225,13 +270,12 @@ if EMPROFILE == 1:
 
     @staticmethod
     def exit_block(block_name):
-      if ToolchainProfiler.remove_last_occurrence_if_exists(ToolchainProfiler.block_stack, block_name):
-        with ToolchainProfiler.log_access() as f:
-          f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"exitBlock","name":"' + block_name + '","time":' + ToolchainProfiler.timestamp() + '}')
+      if ToolchainProfiler.remove_last_occurrence_if_exists(ToolchainProfiler.get_block_stack(), block_name):
+        ToolchainProfiler.write_log(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"tid":' + ToolchainProfiler.thread_id() + ',"op":"exitBlock","name":"' + block_name + '","time":' + ToolchainProfiler.timestamp() + '}')
 
     @staticmethod
     def exit_all_blocks():
-      for b in ToolchainProfiler.block_stack[::-1]:
+      for b in ToolchainProfiler.get_block_stack()[::-1]:
         ToolchainProfiler.exit_block(b)
 
     class ProfileBlock(Logger):
@@ -269,6 +313,10 @@ else:
     def exit_block(block_name):
       pass
 
+    @staticmethod
+    def flush_log():
+      pass
+
     @staticmethod
     def profile_block(block_name):
       return Logger(block_name)
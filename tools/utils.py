@@ -4,6 +4,7 @@
 # found in the LICENSE file.
 
 import os
+import re
 import shutil
 import sys
 import functools
@@ -78,6 +79,19 @@ def write_file(file_path, text, line_endings=None):
       fh.write(text)
 
 
+def write_file_with_replacement(file_path, text, placeholder, write_replacement, line_endings=None):
+  """Like `write_file(file_path, text.replace(placeholder, replacement))`, but
+  each replacement is written by calling `write_replacement(fh)`, so that
+  large replacements can be streamed into the file rather than built up in
+  memory."""
+  parts = text.split(placeholder)
+  with open(file_path, 'w', encoding='utf-8', newline=line_endings) as fh:
+    fh.write(parts[0])
+    for part in parts[1:]:
+      write_replacement(fh)
+      fh.write(part)
+
+
 def write_binary(file_path, contents):
   """Write to a file opened in binary mode"""
   with open(file_path, 'wb') as fh:
@@ -112,6 +126,22 @@ def delete_contents(dirname, exclude=None):
       delete_file(entry)
 
 
+def expand_byte_size_suffixes(value):
+  """Given a string with KB/MB size suffixes, such as "32MB", computes how
+  many bytes that is and returns it as an integer.
+  """
+  value = value.strip()
+  match = re.match(r'^(\d+)\s*([kmgt]?b)?$', value, re.I)
+  if not match:
+    exit_with_error("invalid byte size `%s`.  Valid suffixes are: kb, mb, gb, tb" % value)
+  value, suffix = match.groups()
+  value = int(value)
+  if suffix:
+    size_suffixes = {suffix: 1024 ** i for i, suffix in enumerate(['b', 'kb', 'mb', 'gb', 'tb'])}
+    value *= size_suffixes[suffix.lower()]
+  return value
+
+
 def get_num_cores():
   # Prefer `os.process_cpu_count` when available (3.13 and above) since
   # it takes into account thread affinity.
@@ -10,6 +10,7 @@ https://emscripten.org/docs/porting/connecting_cpp_and_javascript/WebIDL-Binder.
 """
 
 import argparse
+import hashlib
 import os
 import sys
 from typing import List
@@ -18,7 +19,7 @@ __scriptdir__ = os.path.dirname(os.path.abspath(__file__))
 __rootdir__ = os.path.dirname(__scriptdir__)
 sys.path.insert(0, __rootdir__)
 
-from tools import utils
+from tools import cache, config, filelock, utils
 
 sys.path.append(utils.path_from_root('third_party'))
 sys.path.append(utils.path_from_root('third_party/ply'))
@@ -40,6 +41,27 @@ def dbg(*args):
     print(*args, file=sys.stderr)
 
 
+def create_parser():
+  """Creates the WebIDL parser.  Generating the parser tables takes longer than
+  generating most bindings, so they are kept in the cache, keyed by the hash of
+  the grammar in WebIDL.py."""
+  if config.FROZEN_CACHE:
+    return WebIDL.Parser()
+  webidl_hash = hashlib.sha256(utils.read_binary(WebIDL.__file__)).hexdigest()
+  picklefile = str(cache.get_path(f'webidl/parsetab_{webidl_hash}.pickle'))
+  utils.safe_ensure_dirs(os.path.dirname(picklefile))
+  with filelock.FileLock(picklefile + '.lock'):
+    return WebIDL.Parser(picklefile=picklefile)
+
+
+def write_if_changed(filename, text):
+  """Writes a file unless it already has the given contents, so that build
+  systems don't rebuild what depends on it."""
+  if os.path.exists(filename) and utils.read_file(filename) == text:
+    return
+  utils.write_file(filename, text)
+
+
 dbg(f'Debug print ON, CHECKS=${CHECKS}')
 
 # We need to avoid some closure errors on the constructors we define here.
@@ -69,10 +91,7 @@ output_base = options.outfile
 cpp_output = output_base + '.cpp'
 js_output = output_base + '.js'
 
-utils.delete_file(cpp_output)
-utils.delete_file(js_output)
-
-p = WebIDL.Parser()
+p = create_parser()
 p.parse('''
 interface VoidPtr {
 };
@@ -925,12 +944,5 @@ if len(deferred_js):
 
 # Write
 
-with open(cpp_output, 'w') as c:
-  for x in pre_c:
-    c.write(x)
-  for x in mid_c:
-    c.write(x)
-
-with open(js_output, 'w') as js:
-  for x in mid_js:
-    js.write(x)
+write_if_changed(cpp_output, ''.join(pre_c + mid_c))
+write_if_changed(js_output, ''.join(mid_js))